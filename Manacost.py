@@ -11,12 +11,34 @@ import shutil
 import yt_dlp
 import io
 import hashlib 
-
-from logging.handlers import RotatingFileHandler, MemoryHandler
+import sqlite3
+import glob
+import heapq
+import itertools
+import html
+import tempfile
+import queue
+import subprocess
+import atexit
+import ssl
+import hmac
+import secrets
+
+from logging.handlers import RotatingFileHandler, MemoryHandler, QueueHandler, QueueListener
 from bs4 import BeautifulSoup
 from telebot import types
 from telebot.apihelper import ApiTelegramException
 from urllib.parse import urlparse, urljoin # Добавлен urljoin
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib3.util.retry import Retry
+
+try:
+    from PIL import Image # Необязательно: уменьшение миниатюр видео (без Pillow используется ffmpeg, если он установлен)
+except ImportError:
+    Image = None
 
 try:
     import config as config
@@ -46,12 +68,53 @@ memory_handler = MemoryHandler(capacity=200, flushLevel=logging.CRITICAL, target
 memory_handler.setFormatter(log_formatter_info)
 memory_handler.setLevel(logging.ERROR)
 
+# Потоки опроса VK и отправки только кладут записи в очередь: форматирование и запись в файл/консоль
+# выполняет отдельный поток QueueListener
+LOG_IMMEDIATE_ARG_TYPES = (str, int, float, bool, type(None))
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler без форматирования в вызывающем потоке. Сообщение собирается заранее, только если среди аргументов
+    есть изменяемые объекты (их содержимое могло бы поменяться до обработки записи в потоке логирования).
+    """
+    def prepare(self, record):
+        if record.args and not (isinstance(record.args, tuple) and all(isinstance(a, LOG_IMMEDIATE_ARG_TYPES) for a in record.args)):
+            record.msg = record.getMessage(); record.args = None
+        return record
+
+log_queue = queue.Queue() # Queue, а не SimpleQueue: QueueListener вызывает task_done() после обработки записи
+queue_handler = DeferredQueueHandler(log_queue)
+log_listener = QueueListener(log_queue, rotating_handler, stream_handler, memory_handler, respect_handler_level=True)
+
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
 if logger.hasHandlers(): logger.handlers.clear()
-logger.addHandler(rotating_handler)
-logger.addHandler(stream_handler)
-logger.addHandler(memory_handler)
+logger.addHandler(queue_handler)
+
+def sync_root_log_level():
+    """Уровень корневого логгера = самый подробный из уровней обработчиков: отключенные вызовы отсекаются сразу."""
+    logger.setLevel(min(rotating_handler.level, stream_handler.level, memory_handler.level))
+
+def wait_for_log_queue(timeout=2.0):
+    """
+    Ждет, пока поток логирования обработает все записи (например, перед чтением буфера ошибок memory_handler).
+    Пустой очереди мало: запись уже извлечена, но еще не передана обработчикам, поэтому ждем unfinished_tasks == 0.
+    """
+    deadline = time.monotonic() + timeout
+    while log_queue.unfinished_tasks and time.monotonic() < deadline: time.sleep(0.01)
+
+def take_buffered_errors():
+    """
+    Забирает накопленные memory_handler записи, подменяя буфер под блокировкой обработчика: записи, которые поток
+    логирования добавит в это время, попадут в новый буфер, а не потеряются между копированием и очисткой.
+    """
+    memory_handler.acquire()
+    try: records, memory_handler.buffer = memory_handler.buffer, []
+    finally: memory_handler.release()
+    return records
+
+sync_root_log_level()
+log_listener.start()
+atexit.register(log_listener.stop)
 
 logging.getLogger("telebot").setLevel(logging.WARNING)
 logging.getLogger("vk_api").setLevel(logging.WARNING)
@@ -65,6 +128,99 @@ PHOTO_DOWNLOAD_DIR = 'vk_photos_temp'
 CAPTION_LIMIT = 1024
 TELEGRAM_PHOTO_SIZE_LIMIT_MB = 10
 
+# --- Ограничение частоты запросов к VK API ---
+class TokenBucket:
+    """Потокобезопасный ограничитель "ведро маркеров": rate маркеров в секунду, не более capacity подряд."""
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens=1):
+        """Блокирует поток до появления маркеров. Возвращает время ожидания в секундах."""
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class VkRateLimitBackoff(Exception):
+    """Метод VK API временно не вызывается после ошибки 6/29 (вместо глобальной паузы всего потока)."""
+    def __init__(self, method, remaining_seconds):
+        super().__init__(f"Метод {method} на паузе после превышения лимита VK API, осталось {remaining_seconds:.0f} сек.")
+        self.method = method
+        self.remaining_seconds = remaining_seconds
+
+class RateLimitedVkApi(vk_api.VkApi):
+    """
+    Сессия vk_api с общим ограничителем частоты для всех вызовов (wall.get, groups.getById, execute и др.).
+    При ошибках 6 (слишком много запросов в секунду) и 29 (лимит метода) ставится на паузу только этот метод,
+    повторные вызовы во время паузы сразу завершаются VkRateLimitBackoff.
+    """
+    RPS_DELAY = 0 # Частота ограничивается rate_limiter, а не встроенной задержкой vk_api
+    BACKOFF_BASE_SECONDS = {6: 1, 29: 300}
+    BACKOFF_MAX_SECONDS = {6: 30, 29: 3600}
+
+    def __init__(self, *args, rate=3, burst=3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.error_handlers.pop(vk_api.vk_api.TOO_MANY_RPS_CODE, None) # Встроенный обработчик спит и повторяет запрос
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.backoff_lock = threading.Lock()
+        self.backoff_until = {} # метод -> время окончания паузы
+        self.backoff_streak = {} # метод -> количество ошибок лимита подряд
+        self.stats = {'calls': 0, 'throttled': 0, 'waiting': 0, 'wait_seconds': 0.0, 'backoff_rejected': 0, 'error_6': 0, 'error_29': 0}
+
+    def backoff_remaining(self, method):
+        with self.backoff_lock: return max(0.0, self.backoff_until.get(method, 0) - time.monotonic())
+
+    def register_rate_limit_error(self, method, error_code):
+        with self.backoff_lock:
+            streak = self.backoff_streak.get(method, 0)
+            delay = min(self.BACKOFF_BASE_SECONDS[error_code] * (2 ** streak), self.BACKOFF_MAX_SECONDS[error_code])
+            self.backoff_until[method] = time.monotonic() + delay
+            self.backoff_streak[method] = streak + 1
+            self.stats[f'error_{error_code}'] += 1
+        logger.warning(f"Лимит VK API (код {error_code}) для метода {method}. Метод на паузе {delay} сек.")
+
+    def method(self, method, values=None, **kwargs):
+        if (remaining := self.backoff_remaining(method)) > 0:
+            with self.backoff_lock: self.stats['backoff_rejected'] += 1
+            raise VkRateLimitBackoff(method, remaining)
+
+        with self.backoff_lock: self.stats['calls'] += 1; self.stats['waiting'] += 1
+        try: waited = self.rate_limiter.acquire()
+        finally:
+            with self.backoff_lock: self.stats['waiting'] -= 1
+        if waited:
+            with self.backoff_lock: self.stats['throttled'] += 1; self.stats['wait_seconds'] += waited
+
+        try:
+            response = super().method(method, values, **kwargs)
+        except vk_api.ApiError as e:
+            if e.code in self.BACKOFF_BASE_SECONDS: self.register_rate_limit_error(method, e.code)
+            raise
+        with self.backoff_lock: self.backoff_streak.pop(method, None)
+        return response
+
+    def get_stats(self):
+        with self.backoff_lock:
+            stats = dict(self.stats)
+            stats['methods_in_backoff'] = sorted(m for m, until in self.backoff_until.items() if until > time.monotonic())
+        return stats
+
 # --- Инициализация VK и Telegram ---
 try:
     bot = telebot.TeleBot(config.TELEGRAM_BOT_TOKEN, parse_mode='Markdown')
@@ -76,8 +232,23 @@ except Exception as e:
     except Exception: pass
     exit()
 
+# Другой адрес Bot API (локальный Bot API сервер или fake_telegram_server.py для проверки) задается в TELEGRAM_API_URL
+TELEGRAM_API_URL = (getattr(config, 'TELEGRAM_API_URL', None) or '').rstrip('/')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + '/file/bot{0}/{1}'
+    logger.info("Bot API: %s", TELEGRAM_API_URL)
+
+def telegram_api_url(method):
+    """URL метода Bot API с учетом TELEGRAM_API_URL (для запросов в обход telebot)."""
+    return (telebot.apihelper.API_URL or "https://api.telegram.org/bot{0}/{1}").format(config.TELEGRAM_BOT_TOKEN, method)
+
 try:
-    vk_session = vk_api.VkApi(token=config.VK_SERVICE_TOKEN)
+    vk_session = RateLimitedVkApi(
+        token=config.VK_SERVICE_TOKEN,
+        rate=getattr(config, 'VK_API_RATE_PER_SECOND', 3),
+        burst=getattr(config, 'VK_API_BURST', 3),
+    )
     vk = vk_session.get_api()
 except vk_api.AuthError as e:
     logger.critical(f"Ошибка аутентификации VK: {e}")
@@ -97,40 +268,194 @@ except Exception as e:
 # --- Фильтры и состояние постов ---
 filter_words = []
 filter_words_file_path = getattr(config, 'FILTER_WORDS_FILE', 'filter_words.json')
+filter_words_lock = threading.Lock() # Сериализует изменения списка из команд /filter и /remove
+
+class FilterMatcher:
+    """Слова-фильтры, скомпилированные в одно регулярное выражение: текст поста проверяется за один проход."""
+    def __init__(self, words):
+        self.words = tuple(words)
+        unique_words = sorted({str(w).lower() for w in self.words if w}, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(map(re.escape, unique_words))) if unique_words else None
+
+    def search(self, text):
+        """Возвращает первое найденное слово-фильтр или None."""
+        if not self.pattern or not text: return None
+        match = self.pattern.search(text.lower())
+        return match.group(0) if match else None
+
+filter_matcher = FilterMatcher([])
+
+def set_filter_words(words):
+    """Заменяет список и автомат фильтров целиком: читающие потоки видят либо старую, либо новую версию."""
+    global filter_words, filter_matcher
+    new_words = list(words)
+    new_matcher = FilterMatcher(new_words)
+    filter_words, filter_matcher = new_words, new_matcher
 
 def load_filter_words():
-    global filter_words
     try:
         if os.path.exists(filter_words_file_path):
-            with open(filter_words_file_path, 'r', encoding='utf-8') as f: filter_words = json.load(f)
-            logger.info(f"Слова-фильтры загружены: {filter_words}")
-        else: filter_words = []; logger.info("Файл фильтров не найден.")
-    except Exception as e: logger.error(f"Не удалось загрузить слова-фильтры: {e}"); filter_words = []
+            with open(filter_words_file_path, 'r', encoding='utf-8') as f: set_filter_words(json.load(f))
+            logger.info("Слова-фильтры загружены: %s", filter_words)
+        else: set_filter_words([]); logger.info("Файл фильтров не найден.")
+    except Exception as e: logger.error(f"Не удалось загрузить слова-фильтры: {e}"); set_filter_words([])
 
 def save_filter_words():
-    global filter_words
     try:
         with open(filter_words_file_path, 'w', encoding='utf-8') as f: json.dump(filter_words, f, ensure_ascii=False, indent=4)
-        logger.info(f"Слова-фильтры сохранены: {filter_words}")
+        logger.info("Слова-фильтры сохранены: %s", filter_words)
     except Exception as e: logger.error(f"Не удалось сохранить слова-фильтры: {e}")
 
-posts_state = {}
+# Состояние обработанных постов и отметки групп хранятся в одной базе SQLite (режим WAL).
+# Проверка "пост уже обработан?" - поиск по первичному ключу (group_key, post_id), запись - одна вставка.
 post_state_prefix = getattr(config, 'POST_STATE_FILE_PREFIX', 'posts_state')
+post_state_db_path = getattr(config, 'POST_STATE_DB', 'posts_state.db')
+
+class PostStateStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS processed_posts (
+                group_key TEXT NOT NULL,
+                post_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                post_date INTEGER,
+                processed_at REAL NOT NULL,
+                PRIMARY KEY (group_key, post_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_processed_posts_processed_at ON processed_posts (processed_at);
+            CREATE TABLE IF NOT EXISTS group_cursors (
+                group_key TEXT PRIMARY KEY,
+                post_id INTEGER NOT NULL,
+                post_date INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        self.conn.commit()
+
+    def get_status(self, group_key, post_id):
+        with self.lock:
+            row = self.conn.execute("SELECT status FROM processed_posts WHERE group_key = ? AND post_id = ?", (group_key, int(post_id))).fetchone()
+        return row[0] if row else None
+
+    def mark_processed(self, group_key, post_id, status, post_date=None, processed_at=None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO processed_posts (group_key, post_id, status, post_date, processed_at) VALUES (?, ?, ?, ?, ?)",
+                (group_key, int(post_id), status, post_date, processed_at or time.time())
+            )
+
+    def get_cursor(self, group_key):
+        with self.lock:
+            row = self.conn.execute("SELECT post_id, post_date FROM group_cursors WHERE group_key = ?", (group_key,)).fetchone()
+        return {'post_id': row[0], 'date': row[1]} if row else None
+
+    def set_cursor(self, group_key, post_id, post_date):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO group_cursors (group_key, post_id, post_date) VALUES (?, ?, ?)",
+                (group_key, int(post_id), int(post_date or 0))
+            )
+        logger.debug("Отметка последнего поста для %s сохранена: %s.", group_key, post_id)
+
+    def count_recent_posts(self, group_key, window_days):
+        """Количество постов группы, опубликованных за последние window_days дней."""
+        since = time.time() - window_days * 86400
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM processed_posts WHERE group_key = ? AND COALESCE(post_date, processed_at) >= ?", (group_key, since)
+            ).fetchone()[0]
+
+    def prune(self, max_age_days):
+        """Удаляет записи об обработанных постах старше max_age_days дней."""
+        cutoff = time.time() - max_age_days * 86400
+        with self.lock, self.conn:
+            deleted = self.conn.execute("DELETE FROM processed_posts WHERE processed_at < ?", (cutoff,)).rowcount
+        if deleted: logger.info("Из истории постов удалено %s записей старше %s дн.", deleted, max_age_days)
+        return deleted
+
+    def import_legacy_json(self, prefix, cursor_file_path):
+        """Однократный перенос состояния из файлов {prefix}_{group_key}.json и файла отметок в базу."""
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_json_imported'").fetchone(): return 0
+        imported = 0
+        for file_path in glob.glob(f"{glob.escape(prefix)}_*.json"):
+            group_key = os.path.basename(file_path)[len(os.path.basename(prefix)) + 1:-len('.json')]
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f: legacy_state = json.load(f)
+                rows = []
+                for post_id, value in legacy_state.items():
+                    if not post_id.lstrip('-').isdigit(): continue
+                    status, _, ts = str(value).rpartition('_')
+                    try: processed_at = float(ts)
+                    except ValueError: status, processed_at = str(value), time.time()
+                    rows.append((group_key, int(post_id), status or str(value), None, processed_at))
+                with self.lock, self.conn:
+                    self.conn.executemany("INSERT OR IGNORE INTO processed_posts (group_key, post_id, status, post_date, processed_at) VALUES (?, ?, ?, ?, ?)", rows)
+                imported += len(rows)
+                logger.info("Импортировано %s записей состояния из %s (группа %s).", len(rows), file_path, group_key)
+            except Exception as e: logger.error(f"Не удалось импортировать состояние из {file_path}: {e}")
+        if cursor_file_path and os.path.exists(cursor_file_path):
+            try:
+                with open(cursor_file_path, 'r', encoding='utf-8') as f: legacy_cursors = json.load(f)
+                for group_key, cursor in legacy_cursors.items():
+                    if not self.get_cursor(group_key): self.set_cursor(group_key, cursor['post_id'], cursor.get('date'))
+                logger.info("Импортировано %s отметок групп из %s.", len(legacy_cursors), cursor_file_path)
+            except Exception as e: logger.error(f"Не удалось импортировать отметки из {cursor_file_path}: {e}")
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_json_imported', ?)", (str(time.time()),))
+        return imported
 
-def load_posts_state(group_key):
-    file_path = f"{post_state_prefix}_{group_key}.json"
-    try:
-        if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f: return json.load(f)
-        else: return {}
-    except Exception as e: logger.error(f"Не удалось загрузить состояние постов для {group_key}: {e}"); return {}
+try:
+    post_state_store = PostStateStore(post_state_db_path)
+except Exception as e:
+    logger.critical(f"Не удалось открыть базу состояния постов {post_state_db_path}: {e}")
+    exit()
 
-def save_posts_state(group_key, state_dict):
-    file_path = f"{post_state_prefix}_{group_key}.json"
-    try:
-        with open(file_path, 'w', encoding='utf-8') as f: json.dump(state_dict, f, ensure_ascii=False, indent=4)
-        logger.debug(f"Состояние постов для {group_key} сохранено.")
-    except Exception as e: logger.error(f"Не удалось сохранить состояние постов для {group_key}: {e}")
+def get_wall_fetch_count(group_key):
+    """Количество постов для первого запроса: короткая проба для групп с отметкой, полная страница для новых."""
+    if post_state_store.get_cursor(group_key):
+        return getattr(config, 'VK_PROBE_COUNT', 2)
+    return getattr(config, 'VK_POSTS_COUNT', 20)
+
+# --- Кэш метаданных групп VK ---
+class GroupInfoCache:
+    """
+    Кэш метаданных групп (name, screen_name, photo) с временем жизни.
+    Заполняется из массива groups ответа wall.get(extended=1), поэтому отправка поста не требует вызова groups.getById.
+    """
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries = {} # group_id -> (info, время истечения)
+
+    def put(self, group):
+        if not group or 'id' not in group: return
+        info = {
+            'name': group.get('name'),
+            'screen_name': group.get('screen_name'),
+            'photo': group.get('photo_200') or group.get('photo_100') or group.get('photo_50'),
+        }
+        with self.lock: self.entries[abs(int(group['id']))] = (info, time.time() + self.ttl_seconds)
+
+    def update_from_response(self, response):
+        groups = response.get('groups', []) if isinstance(response, dict) else []
+        for group in groups: self.put(group)
+        if groups: logger.debug("Кэш групп обновлен из ответа wall.get: %s записей.", len(groups))
+
+    def get(self, group_id):
+        group_id = abs(int(group_id))
+        with self.lock:
+            entry = self.entries.get(group_id)
+            if entry and entry[1] > time.time(): return entry[0]
+            if entry: del self.entries[group_id]
+        return None
+
+group_info_cache = GroupInfoCache(getattr(config, 'GROUP_INFO_CACHE_TTL_SECONDS', 6 * 3600))
 
 # --- Функции отправки сообщений админу и обработки URL ---
 def send_error_to_admin(error_message, is_critical=False):
@@ -157,7 +482,7 @@ def send_error_summary_to_admin(error_records):
         logger.info("Нет ошибок для отправки в сводке.")
         return
 
-    logger.info(f"Подготовка сводки из {len(error_records)} ошибок для админа {admin_chat_id}...")
+    logger.info("Подготовка сводки из %s ошибок для админа %s...", len(error_records), admin_chat_id)
     summary_header = f"⚠️ Обнаружены ошибки за цикл проверки ({len(error_records)} шт.):\n{'-'*20}\n"
     error_lines = [log_formatter_info.format(record) for record in error_records]
     full_summary_text = summary_header + "\n".join(error_lines)
@@ -173,7 +498,7 @@ def send_error_summary_to_admin(error_records):
         full_summary_text = summary_header + truncated_errors + "\n\n[...и другие ошибки...]"
 
     try:
-        logger.info(f"Отправка сводки ошибок админу ({admin_chat_id})...")
+        logger.info("Отправка сводки ошибок админу (%s)...", admin_chat_id)
         bot.send_message(admin_chat_id, full_summary_text, parse_mode=None)
         logger.info("Сводка ошибок успешно отправлена.")
     except Exception as e:
@@ -181,306 +506,727 @@ def send_error_summary_to_admin(error_records):
         try: bot.send_message(admin_chat_id, f"⚠️ Не удалось отправить сводку ошибок ({len(error_records)} шт.). Ошибка: {e}", parse_mode=None)
         except Exception: logger.critical(f"Не удалось отправить уведомление об ошибке отправки сводки админу {admin_chat_id}.")
 
-def get_unshortened_url(url, max_hops=7, timeout=10):
+# --- Общий HTTP-клиент (фото, миниатюры, разворачивание ссылок) ---
+# Одна сессия requests на все запросы вне yt-dlp: keep-alive и пул соединений на каждый хост
+# (в основном одни и те же серверы userapi.com), повторы при сетевых сбоях и ответах 5xx
+class HttpClient:
+    def __init__(self, pool_connections, pool_maxsize, retries, backoff_factor, connect_timeout, read_timeout):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor,
+                           status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset({'GET', 'HEAD'}), raise_on_status=False)
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=self.retry)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'Mozilla/5.0'
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.lock = threading.Lock()
+        self.requests_sent = 0
+
+    def get(self, url, timeout=None, **kwargs):
+        """GET через общий пул. timeout - таймаут чтения в секундах (таймаут соединения берется из настроек)."""
+        with self.lock: self.requests_sent += 1
+        return self.session.get(url, timeout=(self.connect_timeout, timeout or self.read_timeout), **kwargs)
+
+    def get_stats(self):
+        """Сколько запросов прошло через пулы хостов и сколько для них открыто новых соединений."""
+        connections = pool_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            if (pool := pools.get(key)) is not None:
+                connections += pool.num_connections; pool_requests += pool.num_requests
+        reused = max(pool_requests - connections, 0)
+        with self.lock: requests_sent = self.requests_sent
+        return {'requests': requests_sent, 'pool_requests': pool_requests, 'connections': connections, 'hosts': len(pools),
+                'reuse_percent': 100.0 * reused / pool_requests if pool_requests else 0.0}
+
+http_client = HttpClient(
+    pool_connections=getattr(config, 'HTTP_POOL_HOSTS', 20),
+    pool_maxsize=getattr(config, 'HTTP_POOL_MAXSIZE', 10),
+    retries=getattr(config, 'HTTP_RETRIES', 2),
+    backoff_factor=getattr(config, 'HTTP_RETRY_BACKOFF', 0.5),
+    connect_timeout=getattr(config, 'HTTP_CONNECT_TIMEOUT', 5),
+    read_timeout=getattr(config, 'HTTP_READ_TIMEOUT', 15),
+)
+
+# Признаки HTML-редиректа ищутся потоково в первых URL_SNIFF_BYTES байтах страницы, без полного разбора BeautifulSoup
+URL_SNIFF_BYTES = getattr(config, 'URL_SNIFF_BYTES', 16384)
+HTML_META_REFRESH_RE = re.compile(r'<meta\b[^>]*\bhttp-equiv\s*=\s*["\']?refresh\b[^>]*>', re.IGNORECASE)
+HTML_INPUT_TAG_RE = re.compile(r'<input\b[^>]*>', re.IGNORECASE)
+HTML_ATTR_RE = re.compile(r'\b([a-zA-Z_:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+META_REFRESH_URL_RE = re.compile(r'url\s*=\s*([\'"]?)(.*?)\1(?:;|$)', re.IGNORECASE)
+
+def _html_tag_attrs(tag):
+    return {m.group(1).lower(): html.unescape(m.group(2) if m.group(2) is not None else m.group(3) if m.group(3) is not None else m.group(4)) for m in HTML_ATTR_RE.finditer(tag)}
+
+def _meta_refresh_target(content_value):
+    if content_value and (match := META_REFRESH_URL_RE.search(content_value)):
+        return match.group(2).strip().strip("'\"")
+    return None
+
+def _sniff_html_redirect(html_text):
+    """Ищет meta refresh и скрытый input redirect_url скомпилированными выражениями. Возвращает (URL, вид) или (None, None)."""
+    if meta_tag := HTML_META_REFRESH_RE.search(html_text):
+        if next_url := _meta_refresh_target(_html_tag_attrs(meta_tag.group(0)).get('content')):
+            return next_url, 'meta'
+    for input_tag in HTML_INPUT_TAG_RE.finditer(html_text):
+        attrs = _html_tag_attrs(input_tag.group(0))
+        if attrs.get('type') == 'hidden' and attrs.get('id') == 'redirect_url' and attrs.get('name') == 'to' and attrs.get('value'):
+            return attrs['value'].strip().strip("'\""), 'input'
+    return None, None
+
+def _soup_html_redirect(html_text):
+    """Полный разбор страницы BeautifulSoup - используется, только если потокового фрагмента недостаточно."""
+    soup = BeautifulSoup(html_text, 'lxml')
+    meta_refresh = soup.find('meta', attrs={'http-equiv': re.compile(r'refresh', re.IGNORECASE)})
+    if meta_refresh and (next_url := _meta_refresh_target(meta_refresh.get('content'))):
+        return next_url, 'meta'
+    input_tag = soup.find('input', {'type': 'hidden', 'id': 'redirect_url', 'name': 'to'})
+    if input_tag and input_tag.get('value'):
+        return input_tag.get('value').strip().strip("'\""), 'input'
+    return None, None
+
+def _find_html_redirect(response, page_url):
+    """Читает начало страницы потоком и ищет HTML-редирект; остаток тела скачивается только при необходимости."""
+    content_type = response.headers.get('content-type', '').lower()
+    if content_type and 'html' not in content_type:
+        logger.debug("Страница %s не HTML (%s), тело не читается.", page_url, content_type)
+        return None, None
+
+    head_chunks, head_size, truncated = [], 0, False
+    body_iter = response.iter_content(chunk_size=4096)
+    for chunk in body_iter:
+        head_chunks.append(chunk); head_size += len(chunk)
+        if head_size >= URL_SNIFF_BYTES: truncated = True; break
+    head_bytes = b"".join(head_chunks)
+    encoding = response.encoding or 'utf-8'
+    head_text = head_bytes.decode(encoding, errors='replace')
+
+    next_url, kind = _sniff_html_redirect(head_text)
+    if next_url or not truncated: return next_url, kind
+
+    # meta refresh может быть только в <head>, а input redirect_url встречается на страницах-переходниках VK
+    host = (urlparse(page_url).hostname or '').lower()
+    is_vk_host = host.endswith(('vk.com', 'vk.ru', 'vk.cc'))
+    if '</head>' in head_text.lower() and not is_vk_host:
+        logger.debug("HTML-редирект не найден в первых %s байтах %s, страница дальше не читается.", head_size, page_url)
+        return None, None
+
+    logger.debug("Полный разбор страницы %s: маркер редиректа не найден в первых %s байтах.", page_url, head_size)
+    full_html = (head_bytes + b"".join(body_iter)).decode(encoding, errors='replace')
+    return _soup_html_redirect(full_html)
+
+def _unshorten_url(url, max_hops=7, timeout=10):
     """
     Итеративно разворачивает URL, следуя HTTP-редиректам и некоторым HTML-редиректам.
+    Возвращает (конечный URL, True если разворачивание завершилось без сетевых ошибок).
     """
     current_url = url.strip().strip("'\"")
     visited_urls = {current_url} 
     headers = {'User-Agent': 'Mozilla/5.0'}
-    logger.info(f"Начало разворачивания URL: {current_url}")
+    logger.info("Начало разворачивания URL: %s", current_url)
 
     for hop_count in range(max_hops):
-        logger.debug(f"Попытка {hop_count + 1}/{max_hops}: Запрос к {current_url}")
+        logger.debug("Попытка %s/%s: Запрос к %s", hop_count + 1, max_hops, current_url)
         try:
-            response = requests.get(current_url, timeout=timeout, allow_redirects=False, headers=headers)
-            time.sleep(0.3) 
-            response.raise_for_status()
-
-            if response.status_code in (301, 302, 303, 307, 308) and 'Location' in response.headers:
-                next_url = response.headers['Location'].strip().strip("'\"")
-                if not urlparse(next_url).scheme: 
-                    next_url = urljoin(current_url, next_url)
-                
-                logger.debug(f"Обнаружен HTTP редирект: {current_url} -> {next_url}")
-                if next_url in visited_urls:
-                    logger.warning(f"Обнаружен цикл редиректа на {next_url}. Прерывание.")
-                    return current_url 
-                current_url = next_url
-                visited_urls.add(current_url)
-                continue 
-
-            if response.status_code == 200:
-                final_url_from_request = response.url.strip().strip("'\"")
-                soup = BeautifulSoup(response.text, 'lxml')
-                
-                meta_refresh = soup.find('meta', attrs={'http-equiv': re.compile(r'refresh', re.IGNORECASE)})
-                if meta_refresh and meta_refresh.get('content'):
-                    content_value = meta_refresh['content']
-                    match = re.search(r'url\s*=\s*([\'"]?)(.*?)\1(?:;|$)', content_value, re.IGNORECASE)
-                    if match:
-                        next_url = match.group(2).strip().strip("'\"")
+            with http_client.get(current_url, timeout=timeout, allow_redirects=False, headers=headers, stream=True) as response:
+                time.sleep(0.3) 
+                response.raise_for_status()
+
+                if response.status_code in (301, 302, 303, 307, 308) and 'Location' in response.headers:
+                    next_url = response.headers['Location'].strip().strip("'\"")
+                    if not urlparse(next_url).scheme: 
+                        next_url = urljoin(current_url, next_url)
+                    
+                    logger.debug("Обнаружен HTTP редирект: %s -> %s", current_url, next_url)
+                    if next_url in visited_urls:
+                        logger.warning(f"Обнаружен цикл редиректа на {next_url}. Прерывание.")
+                        return current_url, True
+                    current_url = next_url
+                    visited_urls.add(current_url)
+                    continue 
+
+                if response.status_code == 200:
+                    final_url_from_request = response.url.strip().strip("'\"")
+                    next_url, redirect_kind = _find_html_redirect(response, final_url_from_request)
+                    if next_url:
                         if not urlparse(next_url).scheme:
                             next_url = urljoin(final_url_from_request, next_url)
-                        
-                        logger.debug(f"Обнаружен Meta refresh: {final_url_from_request} -> {next_url}")
+
+                        logger.debug("Обнаружен HTML-редирект (%s): %s -> %s", redirect_kind, final_url_from_request, next_url)
                         if next_url in visited_urls:
-                            logger.warning(f"Обнаружен цикл редиректа (meta) на {next_url}. Прерывание.")
-                            return final_url_from_request 
+                            logger.warning(f"Обнаружен цикл редиректа ({redirect_kind}) на {next_url}. Прерывание.")
+                            return final_url_from_request, True
                         current_url = next_url
                         visited_urls.add(current_url)
                         continue 
+                    
+                    logger.info("Конечный URL после %s попыток: %s", hop_count + 1, final_url_from_request)
+                    return final_url_from_request, True
 
-                input_tag = soup.find('input', {'type': 'hidden', 'id': 'redirect_url', 'name': 'to'})
-                if input_tag and input_tag.get('value'):
-                    next_url = input_tag.get('value').strip().strip("'\"")
-                    if not urlparse(next_url).scheme:
-                        next_url = urljoin(final_url_from_request, next_url)
-
-                    logger.debug(f"Обнаружен URL в input-теге: {final_url_from_request} -> {next_url}")
-                    if next_url in visited_urls:
-                        logger.warning(f"Обнаружен цикл редиректа (input) на {next_url}. Прерывание.")
-                        return final_url_from_request
-                    current_url = next_url
-                    visited_urls.add(current_url)
-                    continue 
-                
-                logger.info(f"Конечный URL после {hop_count + 1} попыток: {final_url_from_request}")
-                return final_url_from_request
-
-            logger.warning(f"Неожиданный статус-код {response.status_code} для {current_url} на попытке {hop_count + 1}.")
-            return current_url 
+                logger.warning(f"Неожиданный статус-код {response.status_code} для {current_url} на попытке {hop_count + 1}.")
+                return current_url, False
 
         except requests.exceptions.Timeout:
             logger.error(f"Таймаут при запросе к {current_url} на попытке {hop_count + 1}.")
-            return current_url 
+            return current_url, False
         except requests.exceptions.RequestException as e:
             logger.error(f"Сетевая ошибка при запросе к {current_url} на попытке {hop_count + 1}: {e}")
-            return current_url
+            return current_url, False
         except Exception as e:
             logger.error(f"Неизвестная ошибка при обработке {current_url} на попытке {hop_count + 1}: {e}", exc_info=True)
-            return current_url
+            return current_url, False
 
     logger.warning(f"Превышено максимальное количество переходов ({max_hops}) для исходного URL: {url}. Возвращается последний известный URL: {current_url}")
-    return current_url
+    return current_url, True
 
-def prepare_text(text):
-    """Подготавливает текст поста для отправки в Telegram."""
-    if not text: return ""
-    processed_text = text
-    logger.debug(f"Исходный текст для prepare_text: {text[:100]}...")
-
-    # Шаг 1: Разворачивание vk.cc ссылок
-    try:
-        # Ищем все http/https ссылки, чтобы потом проверить, не vk.cc ли они
-        # Используем более общее регулярное выражение для поиска URL-ов
-        potential_urls = re.findall(r'https?://[^\s<>"\'`\]\[()*]+', processed_text)
-        processed_vk_cc_links = set()
-
-        for p_url in potential_urls:
-            if 'vk.cc/' in p_url and p_url not in processed_vk_cc_links:
-                # Извлекаем именно vk.cc часть, если она часть большего URL (маловероятно, но для безопасности)
-                vk_cc_match = re.search(r'(https?://vk\.cc/[a-zA-Z0-9]+)', p_url)
-                if vk_cc_match:
-                    actual_vk_cc_url = vk_cc_match.group(1)
-                    if actual_vk_cc_url in processed_vk_cc_links:
-                        continue
-
-                    logger.debug(f"Найдена vk.cc ссылка для обработки: {actual_vk_cc_url}")
-                    full_url = get_unshortened_url(actual_vk_cc_url) # Используем улучшенную функцию
-                    if full_url != actual_vk_cc_url:
-                        # Экранируем обратные слеши в full_url перед использованием в re.sub, если они там есть
-                        replacement_url = full_url.replace('\\', '\\\\')
-                        processed_text = re.sub(re.escape(actual_vk_cc_url), replacement_url, processed_text)
-                        logger.info(f"Замена vk.cc в тексте: {actual_vk_cc_url} -> {full_url}")
-                    else:
-                        logger.debug(f"Ссылка vk.cc не изменилась или не удалось развернуть: {actual_vk_cc_url}")
-                    processed_vk_cc_links.add(actual_vk_cc_url)
-    except Exception as e: 
-        logger.error(f"Ошибка замены vk.cc в тексте: {e}", exc_info=True)
+# Кэш развернутых коротких ссылок: одни и те же vk.cc ссылки повторяются в десятках постов
+class UrlExpansionCache:
+    """
+    LRU-кэш "короткий URL -> конечный URL" с временем жизни записей и сохранением на диск.
+    Неудачные разворачивания кэшируются на более короткий срок (negative_ttl_seconds).
+    """
+    def __init__(self, file_path, max_entries, ttl_seconds, negative_ttl_seconds):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.entries = OrderedDict() # короткий URL -> (конечный URL, время истечения, успешно ли развернут)
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'expired': 0}
+
+    def load(self):
+        try:
+            if not os.path.exists(self.file_path): return
+            with open(self.file_path, 'r', encoding='utf-8') as f: stored = json.load(f)
+            now = time.time()
+            with self.lock:
+                for short_url, (final_url, expires_at, ok) in stored.items():
+                    if expires_at > now: self.entries[short_url] = (final_url, expires_at, ok)
+                while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+            logger.info("Кэш ссылок загружен: %s записей.", len(self.entries))
+        except Exception as e: logger.error(f"Не удалось загрузить кэш ссылок {self.file_path}: {e}")
+
+    def save(self):
+        with self.lock:
+            if not self.dirty: return
+            snapshot = {url: list(entry) for url, entry in self.entries.items()}
+            self.dirty = False
+        try:
+            tmp_path = f"{self.file_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.file_path)
+            logger.debug("Кэш ссылок сохранен: %s записей.", len(snapshot))
+        except Exception as e: logger.error(f"Не удалось сохранить кэш ссылок {self.file_path}: {e}")
+
+    def get(self, short_url):
+        with self.lock:
+            entry = self.entries.get(short_url)
+            if entry is None:
+                self.stats['misses'] += 1; return None
+            if entry[1] <= time.time():
+                del self.entries[short_url]; self.dirty = True
+                self.stats['expired'] += 1; self.stats['misses'] += 1; return None
+            self.entries.move_to_end(short_url)
+            self.stats['hits' if entry[2] else 'negative_hits'] += 1
+            return entry[0]
+
+    def put(self, short_url, final_url, ok):
+        ttl = self.ttl_seconds if ok else self.negative_ttl_seconds
+        with self.lock:
+            self.entries[short_url] = (final_url, time.time() + ttl, ok)
+            self.entries.move_to_end(short_url)
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+            self.dirty = True
+
+    def get_stats(self):
+        with self.lock: return dict(self.stats, size=len(self.entries))
+
+url_cache = UrlExpansionCache(
+    getattr(config, 'URL_CACHE_FILE', 'url_cache.json'),
+    max_entries=getattr(config, 'URL_CACHE_MAX_ENTRIES', 5000),
+    ttl_seconds=getattr(config, 'URL_CACHE_TTL_SECONDS', 30 * 86400),
+    negative_ttl_seconds=getattr(config, 'URL_CACHE_NEGATIVE_TTL_SECONDS', 600),
+)
 
+# Разворачивание ссылок поста выполняется параллельно в ограниченном пуле потоков через общий http_client
+LINK_EXPAND_WORKERS = getattr(config, 'LINK_EXPAND_WORKERS', 6)
+link_expansion_pool = ThreadPoolExecutor(max_workers=LINK_EXPAND_WORKERS, thread_name_prefix="LinkExpand")
 
-    # Шаг 2: Обработка VK-специфичных ссылок [url|text] и [id|text]
-    try:
-        def escape_md_brackets(match):
-            link_text_raw = match.group(2)
-            url_raw = match.group(1)
-            link_text_escaped = link_text_raw.replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]')
-            url_escaped_for_md_syntax = url_raw.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
-            logger.debug(f"Замена [url|text]: [{url_raw}|{link_text_raw}] -> [{link_text_escaped}]({url_escaped_for_md_syntax})")
-            return f'[{link_text_escaped}]({url_escaped_for_md_syntax})'
-        processed_text = re.sub(r'\[(https?://[^\|\]]+)\|([^\]]+)\]', escape_md_brackets, processed_text)
-
-        def escape_mention(match):
-            mention_text_raw = match.group(1)
-            mention_text_escaped = mention_text_raw.replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]')
-            mention_text_escaped = mention_text_escaped.replace('_', '\\_').replace('*', '\\*').replace('`', '\\`')
-            logger.debug(f"Замена [id|text]: [{match.group(0)}] -> {mention_text_escaped}")
-            return mention_text_escaped
-        processed_text = re.sub(r'\[(?:id|club)\d+\|([^\]]+)\]', escape_mention, processed_text)
-    except Exception as e: logger.error(f"Ошибка замены [url|text] или [id|text]: {e}")
-
-    # Шаг 3: Экранирование остальных символов Markdown (*, _, `) и начальных точек, ИЗБЕГАЯ URL
-    try:
-        # Обновленный паттерн для URL, чтобы он был более "жадным" и корректно обрабатывал скобки в URL, если они не являются частью Markdown-разметки ссылки
-        url_pattern_for_escape = re.compile(
-            r'(\bhttps?://(?:www\.)?[a-zA-Z0-9@:%._\+~#=/-]{2,256}\.[a-zA-Z0-9()]{1,6}\b(?:[-a-zA-Z0-9()@:%_\+.~#?&/=]*))' # Более общий URL pattern
-            r'|(\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b)' # Email pattern
-            r'|(\[[^\]]+\]\([^)]+\))' # Markdown links [text](url) - их не трогаем
-        )
-        
-        parts = []
-        last_end = 0
-        for match in url_pattern_for_escape.finditer(processed_text):
-            start, end = match.span()
-            
-            pre_text = processed_text[last_end:start]
-            # Экранируем только *, _, ` вне URL и не в Markdown ссылках
-            pre_text_escaped = re.sub(r'(?<![\\`*_])([*_`])(?![`*_])', r'\\\1', pre_text)
-            pre_text_escaped = re.sub(r'^\.', r'\\.', pre_text_escaped, flags=re.MULTILINE)
-            parts.append(pre_text_escaped)
-            
-            # URL, email или Markdown-ссылку добавляем как есть
-            parts.append(match.group(0))
-            
-            last_end = end
-        
-        post_text = processed_text[last_end:]
-        post_text_escaped = re.sub(r'(?<![\\`*_])([*_`])(?![`*_])', r'\\\1', post_text)
-        post_text_escaped = re.sub(r'^\.', r'\\.', post_text_escaped, flags=re.MULTILINE)
-        parts.append(post_text_escaped)
-        
-        processed_text = "".join(parts)
-        logger.debug("Markdown символы (*, _, `) и начальные точки экранированы с учетом URL и Markdown-ссылок.")
-
+def get_unshortened_url(url, max_hops=7, timeout=10):
+    """Разворачивает короткую ссылку, используя кэш url_cache."""
+    cache_key = url.strip().strip("'\"")
+    if (cached_url := url_cache.get(cache_key)) is not None:
+        logger.debug("URL из кэша: %s -> %s", cache_key, cached_url)
+        return cached_url
+    final_url, resolved = _unshorten_url(cache_key, max_hops=max_hops, timeout=timeout)
+    url_cache.put(cache_key, final_url, resolved)
+    return final_url
+
+def expand_short_urls(urls, time_budget=None):
+    """
+    Разворачивает все ссылки одновременно в пуле link_expansion_pool.
+    Ссылки, не успевшие развернуться за time_budget секунд, остаются исходными
+    (их разворачивание продолжается в фоне и попадет в кэш для следующих постов).
+    Возвращает словарь {исходный URL: конечный URL}.
+    """
+    unique_urls = list(dict.fromkeys(u for u in urls if u))
+    if not unique_urls: return {}
+    if time_budget is None: time_budget = getattr(config, 'LINK_EXPAND_TIME_BUDGET_SECONDS', 15)
+    futures = {link_expansion_pool.submit(get_unshortened_url, u): u for u in unique_urls}
+    done, not_done = wait(futures, timeout=time_budget)
+    expanded = {}
+    for future, short_url in futures.items():
+        if future in done:
+            try: expanded[short_url] = future.result()
+            except Exception as e: logger.error(f"Ошибка разворачивания {short_url}: {e}"); expanded[short_url] = short_url
+        else: expanded[short_url] = short_url
+    if not_done: logger.warning(f"Не уложились в {time_budget} сек. при разворачивании {len(not_done)} из {len(unique_urls)} ссылок, оставлены исходные URL.")
+    return expanded
+
+# Разметка текста поста: один проход скомпилированным выражением по тексту, из каждого фрагмента сразу
+# получаются вариант для Markdown и простой вариант. Экранирование - через таблицы str.translate
+MD_TEXT_ESCAPE = str.maketrans({c: '\\' + c for c in '\\[]_*`'}) # Названия, заголовки, упоминания
+MD_LINK_TEXT_ESCAPE = str.maketrans({c: '\\' + c for c in '\\[]'}) # Текст внутри [...] ссылки
+MD_URL_ESCAPE = str.maketrans({c: '\\' + c for c in '\\()'}) # Адрес внутри (...) ссылки
+VK_CC_URL_RE = re.compile(r'https?://vk\.cc/[a-zA-Z0-9]+')
+VK_LINK_RE = re.compile(r'\[(https?://[^|\]]+)\|([^\]]+)\]') # [url|текст]
+VK_MENTION_RE = re.compile(r'\[(?:id|club)\d+\|([^\]]+)\]') # [id123|текст]
+POST_TEXT_TOKEN_PATTERNS = (
+    r'(?P<url>\bhttps?://(?:www\.)?[a-zA-Z0-9@:%._\+~#=/-]{2,256}\.[a-zA-Z0-9()]{1,6}\b[-a-zA-Z0-9()@:%_\+.~#?&/=]*)',
+    r'(?P<email>\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b)',
+    r'(?P<md_link>\[[^\]]+\]\([^)]+\))', # Готовые Markdown-ссылки [текст](url) не трогаем
+)
+# Опережающая проверка первого символа отсекает большинство позиций до перебора вариантов.
+# Вариант для e-mail (самый дорогой) подключается, только если в тексте есть "@"
+POST_TEXT_TOKEN_RE = re.compile(r'(?=[\[a-zA-Z0-9._%+-])(?:' + '|'.join(POST_TEXT_TOKEN_PATTERNS) + ')')
+POST_TEXT_TOKEN_NO_EMAIL_RE = re.compile(r'(?=[\[h])(?:' + '|'.join(p for p in POST_TEXT_TOKEN_PATTERNS if not p.startswith('(?P<email>')) + ')')
+# Текст между токенами: одиночные *, _, ` (не рядом с другими такими символами и не после \) и точка в начале строки
+# или сразу после токена экранируются. Сначала берется сам символ, потом проверяется окружение - так быстрее,
+# чем проверять lookbehind в каждой позиции
+POST_TEXT_ESCAPE_RE = re.compile(r'[*_`.](?:(?<=[*_`])(?<![\\`*_].)(?![`*_])|(?<=^\.))', re.MULTILINE)
+
+def find_vk_cc_urls(text):
+    """Находит все vk.cc ссылки в тексте."""
+    return VK_CC_URL_RE.findall(text) if text else []
+
+def render_post_text(text, expanded_urls):
+    """
+    Возвращает (текст для Markdown, простой текст): vk.cc ссылки заменены развернутыми, [url|текст] - ссылкой,
+    [id|текст] - текстом упоминания; одиночные *, _, ` и начальные точки строк экранированы вне URL, e-mail
+    и Markdown-ссылок (как и прежде, точка сразу после URL, e-mail или ссылки тоже экранируется).
+    Подстановки выполняются до разбора, как в прежнем prepare_text, поэтому результат для "склеенного" текста
+    (адрес сразу после слова, e-mail или упоминания) не меняется; сам разбор - один проход POST_TEXT_TOKEN_RE,
+    текст между токенами экранируется одной заранее скомпилированной заменой.
+    """
+    if 'vk.cc/' in text:
+        for short_url in dict.fromkeys(VK_CC_URL_RE.findall(text)):
+            if (full_url := expanded_urls.get(short_url, short_url)) != short_url: text = text.replace(short_url, full_url)
+    plain_text = text
+    if '|' in text:
+        text = VK_LINK_RE.sub(lambda m: f"[{m.group(2).translate(MD_LINK_TEXT_ESCAPE)}]({m.group(1).translate(MD_URL_ESCAPE)})", text)
+        text = VK_MENTION_RE.sub(lambda m: m.group(1).translate(MD_TEXT_ESCAPE), text)
+        plain_text = VK_MENTION_RE.sub(r'\1', VK_LINK_RE.sub(r'\2 (\1)', plain_text))
+
+    md_parts = []
+    last_end = 0
+    token_re = POST_TEXT_TOKEN_RE if '@' in text else POST_TEXT_TOKEN_NO_EMAIL_RE
+    for match in token_re.finditer(text):
+        if match.start() > last_end: md_parts.append(POST_TEXT_ESCAPE_RE.sub(r'\\\g<0>', text[last_end:match.start()]))
+        md_parts.append(match.group(0))
+        last_end = match.end()
+    md_parts.append(POST_TEXT_ESCAPE_RE.sub(r'\\\g<0>', text[last_end:]))
+    return "".join(md_parts).strip(), plain_text.strip()
+
+def prepare_text(text, expanded_urls=None):
+    """
+    Подготавливает текст поста для отправки в Telegram (вариант для Markdown).
+    expanded_urls - заранее развернутые ссылки {vk.cc URL: конечный URL}; если не переданы, разворачиваются здесь.
+    """
+    if not text: return ""
+    if expanded_urls is None: expanded_urls = expand_short_urls(find_vk_cc_urls(text))
+    try: return render_post_text(text, expanded_urls)[0]
     except Exception as e:
-        logger.error(f"Ошибка экранирования Markdown с учетом URL: {e}", exc_info=True)
-
-    logger.debug(f"Результат prepare_text: {processed_text[:100]}...")
-    return processed_text.strip()
+        logger.error(f"Ошибка подготовки текста поста: {e}", exc_info=True)
+        return text.strip()
 
 
 # --- Функции очистки папок скачивания ---
 def clear_download_folder(folder_path):
     if not folder_path: return
-    logger.info(f"Очистка папки: {folder_path}")
-    if not os.path.exists(folder_path): logger.info(f"Папка {folder_path} не существует."); return
+    logger.info("Очистка папки: %s", folder_path)
+    if not os.path.exists(folder_path): logger.info("Папка %s не существует.", folder_path); return
     if not os.path.isdir(folder_path): logger.error(f"Путь {folder_path} не папка."); return
     try:
         for filename in os.listdir(folder_path):
             file_path = os.path.join(folder_path, filename)
             try:
-                if os.path.isfile(file_path) or os.path.islink(file_path): os.unlink(file_path); logger.debug(f"Удален файл: {file_path}")
-                elif os.path.isdir(file_path): shutil.rmtree(file_path); logger.debug(f"Удалена папка: {file_path}")
+                if os.path.isfile(file_path) or os.path.islink(file_path): os.unlink(file_path); logger.debug("Удален файл: %s", file_path)
+                elif os.path.isdir(file_path): shutil.rmtree(file_path); logger.debug("Удалена папка: %s", file_path)
             except Exception as e: logger.error(f"Не удалось удалить {file_path}: {e}")
-        logger.info(f"Папка {folder_path} очищена.")
+        logger.info("Папка %s очищена.", folder_path)
     except OSError as e: logger.error(f"Ошибка доступа/очистки папки {folder_path}: {e}")
 
+# --- Локальный кэш скачанных медиа ---
+# Файлы хранятся под именем-хэшем ключа (id экстрактора или URL). Скачивание идет во временную папку,
+# в кэш файл попадает только целиком через os.replace. Старые файлы вытесняются по квоте (LRU по mtime)
+MEDIA_CACHE_SIDECAR_EXT = '.json'
+MEDIA_CACHE_STAGING_DIR = '.incoming'
+
+class MediaCache:
+    """Кэш медиафайлов в папке root_dir с квотой max_bytes и вытеснением давно не использованных файлов."""
+    def __init__(self, root_dir, max_bytes):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'size_bytes': 0}
+
+    def _base_path(self, cache_key):
+        return os.path.join(self.root_dir, hashlib.sha1(cache_key.encode()).hexdigest())
+
+    def lookup(self, cache_key):
+        """Путь к готовому файлу в кэше или None. Попадание обновляет mtime файла (для LRU)."""
+        base_path = self._base_path(cache_key)
+        for path in glob.glob(glob.escape(base_path) + '.*'):
+            if path.endswith((MEDIA_CACHE_SIDECAR_EXT, '.tmp')): continue # метаданные и остатки прерванной записи
+            try: os.utime(path)
+            except OSError: continue
+            with self.lock: self.stats['hits'] += 1
+            return path
+        with self.lock: self.stats['misses'] += 1
+        return None
+
+    def get_metadata(self, cache_key):
+        try:
+            with open(self._base_path(cache_key) + MEDIA_CACHE_SIDECAR_EXT, 'r', encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError): return {}
+
+    def create_staging_dir(self):
+        """Отдельная временная папка для одного скачивания; файлы из нее никогда не отдаются из кэша."""
+        staging_root = os.path.join(self.root_dir, MEDIA_CACHE_STAGING_DIR)
+        os.makedirs(staging_root, exist_ok=True)
+        return tempfile.mkdtemp(dir=staging_root)
+
+    def commit(self, cache_key, downloaded_path, metadata=None):
+        """Атомарно переносит скачанный файл в кэш. Возвращает итоговый путь или None."""
+        base_path = self._base_path(cache_key)
+        final_path = base_path + (os.path.splitext(downloaded_path)[1] or '.bin')
+        try:
+            with self.lock:
+                if metadata is not None:
+                    # Временный файл метаданных пишется в папку скачивания, а не в корень кэша: lookup не должен его видеть
+                    tmp_sidecar = os.path.join(os.path.dirname(downloaded_path), f"metadata{MEDIA_CACHE_SIDECAR_EXT}.tmp")
+                    with open(tmp_sidecar, 'w', encoding='utf-8') as f: json.dump(metadata, f, ensure_ascii=False)
+                    os.replace(tmp_sidecar, base_path + MEDIA_CACHE_SIDECAR_EXT)
+                os.replace(downloaded_path, final_path)
+                self.stats['stored'] += 1
+        except OSError as e:
+            logger.error(f"Не удалось поместить {downloaded_path} в кэш {self.root_dir}: {e}")
+            return None
+        logger.debug("Файл %s помещен в кэш как %s (ключ %s).", downloaded_path, final_path, cache_key)
+        return final_path
+
+    def enforce_quota(self, stale_staging_seconds=3600):
+        """Удаляет самые давно использованные файлы сверх квоты и брошенные временные папки."""
+        if not os.path.isdir(self.root_dir): return
+        now = time.time()
+        entries = []
+        total_bytes = 0
+        with os.scandir(self.root_dir) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name == MEDIA_CACHE_STAGING_DIR: self._remove_stale_staging(entry.path, now - stale_staging_seconds)
+                        continue
+                    if entry.name.endswith('.tmp'): os.remove(entry.path); continue # остаток прерванной записи метаданных
+                    stat = entry.stat()
+                except OSError: continue
+                total_bytes += stat.st_size
+                if not entry.name.endswith(MEDIA_CACHE_SIDECAR_EXT): entries.append((stat.st_mtime, stat.st_size, entry.path))
+        evicted = 0
+        if total_bytes > self.max_bytes:
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_bytes: break
+                try: os.remove(path)
+                except OSError as e: logger.error(f"Не удалось удалить {path} из кэша: {e}"); continue
+                total_bytes -= size; evicted += 1
+                sidecar_path = os.path.splitext(path)[0] + MEDIA_CACHE_SIDECAR_EXT
+                try: total_bytes -= os.path.getsize(sidecar_path); os.remove(sidecar_path)
+                except OSError: pass
+            logger.info("Кэш %s: вытеснено %s файлов, занято %.1f MB из %.0f MB.", self.root_dir, evicted, total_bytes / (1024 * 1024), self.max_bytes / (1024 * 1024))
+        with self.lock:
+            self.stats['evicted'] += evicted; self.stats['size_bytes'] = total_bytes
+
+    def clear(self):
+        """
+        Удаляет все готовые файлы кэша и их метаданные. Временные папки текущих скачиваний (MEDIA_CACHE_STAGING_DIR)
+        не трогаются, поэтому скачивания, идущие в фоне, спокойно попадут в кэш после очистки.
+        """
+        if not os.path.isdir(self.root_dir): return 0
+        removed = 0
+        with self.lock:
+            with os.scandir(self.root_dir) as it:
+                for entry in it:
+                    if entry.name == MEDIA_CACHE_STAGING_DIR or not entry.is_file(follow_symlinks=False): continue
+                    try: os.remove(entry.path)
+                    except OSError as e: logger.error(f"Не удалось удалить {entry.path} из кэша: {e}"); continue
+                    if not entry.name.endswith((MEDIA_CACHE_SIDECAR_EXT, '.tmp')): removed += 1
+            self.stats['size_bytes'] = 0
+        logger.info("Кэш %s очищен: удалено %s файлов.", self.root_dir, removed)
+        return removed
+
+    def _remove_stale_staging(self, staging_root, older_than):
+        for entry in os.scandir(staging_root):
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < older_than:
+                    shutil.rmtree(entry.path) if entry.is_dir(follow_symlinks=False) else os.remove(entry.path)
+                    logger.debug("Удалены брошенные временные файлы скачивания: %s", entry.path)
+            except OSError as e: logger.error(f"Не удалось удалить временные файлы {entry.path}: {e}")
+
+    def get_stats(self):
+        with self.lock: return dict(self.stats)
+
+video_cache = MediaCache(DOWNLOAD_DIR, getattr(config, 'VIDEO_CACHE_MAX_MB', 2048) * 1024 * 1024)
+photo_cache = MediaCache(PHOTO_DOWNLOAD_DIR, getattr(config, 'PHOTO_CACHE_MAX_MB', 256) * 1024 * 1024)
+
+def video_cache_key(video_url):
+    """Ключ кэша видео: id VK-видео, если его можно извлечь из ссылки, иначе сам URL."""
+    if match := re.search(r'video(-?\d+_\d+)', video_url): return f"VK:{match.group(1)}"
+    return f"url:{video_url}"
+
 # --- Функция скачивания фото ---
-def download_photo_to_file(photo_url, output_dir=PHOTO_DOWNLOAD_DIR, max_size_mb=TELEGRAM_PHOTO_SIZE_LIMIT_MB):
-    logger.debug(f"Попытка скачивания фото в файл: {photo_url} -> {output_dir}")
-    if not os.path.exists(output_dir):
-        try: os.makedirs(output_dir); logger.info(f"Создана папка для временных фото: {output_dir}")
-        except OSError as e: logger.exception(f"Не удалось создать папку '{output_dir}': {e}"); return None
+# Фото для fallback медиагруппы берутся из photo_cache, а при промахе скачиваются в память; буфер больше
+# PHOTO_SPOOL_MAX_KB переносится во временный файл в папке скачиваний кэша фото
+PHOTO_SPOOL_MAX_BYTES = getattr(config, 'PHOTO_SPOOL_MAX_KB', 2048) * 1024
+PHOTO_FALLBACK_RETRIES = getattr(config, 'PHOTO_FALLBACK_RETRIES', 1) # Повторы только для фото, которые не скачались
 
+def download_photo_to_buffer(photo_url, max_size_mb=TELEGRAM_PHOTO_SIZE_LIMIT_MB):
+    """
+    Открывает фото из photo_cache или скачивает его в SpooledTemporaryFile и сохраняет копию в кэш (позиция - в начале).
+    Возвращает файловый объект, None при временной ошибке (стоит повторить) или False, если фото больше лимита.
+    """
+    cache_key = photo_media_key(photo_url)
+    if cached_path := photo_cache.lookup(cache_key):
+        try:
+            cached_file = open(cached_path, 'rb')
+            logger.debug("Фото %s взято из кэша: %s", photo_url, cached_path)
+            return cached_file
+        except OSError as e: logger.warning(f"Не удалось открыть фото из кэша {cached_path}: {e}. Скачивание заново.")
+    logger.debug("Попытка скачивания фото в буфер: %s", photo_url)
+    response = None
+    buffer = None
     try:
-        response = requests.get(photo_url, stream=True, timeout=15, headers={'User-Agent': 'Mozilla/5.0'})
+        response = http_client.get(photo_url, stream=True, timeout=15)
         response.raise_for_status()
 
         content_length = response.headers.get('content-length')
         max_bytes = max_size_mb * 1024 * 1024
         if content_length:
             try:
-                file_size = int(content_length)
-                file_size_mb = file_size / (1024 * 1024)
-                logger.debug(f"Размер фото (Content-Length): {file_size_mb:.2f} MB")
+                file_size_mb = int(content_length) / (1024 * 1024)
+                logger.debug("Размер фото (Content-Length): %.2f MB", file_size_mb)
                 if file_size_mb > max_size_mb:
                     logger.warning(f"Фото {photo_url} ({file_size_mb:.2f} MB) превышает лимит {max_size_mb} MB. Скачивание отменено.")
-                    return None
+                    return False
             except ValueError: logger.warning(f"Не удалось распознать Content-Length: {content_length}")
 
-        try:
-            parsed_url = urlparse(photo_url)
-            base_name = os.path.basename(parsed_url.path)
-            name_part, ext_part = os.path.splitext(base_name)
-            if not ext_part: 
-                 content_type = response.headers.get('content-type')
-                 if content_type and 'image/' in content_type:
-                      ext_part = '.' + content_type.split('image/')[-1].split(';')[0] 
-                 else: ext_part = '.jpg' 
-            url_hash = hashlib.md5(photo_url.encode()).hexdigest()[:8]
-            safe_name_part = re.sub(r'[^\w\-]+', '_', name_part)[:50] 
-            filename = f"{url_hash}_{safe_name_part}{ext_part}"
-        except Exception as e_fname:
-            logger.warning(f"Ошибка генерации имени файла для {photo_url}: {e_fname}. Используем только хэш.")
-            filename = f"{hashlib.md5(photo_url.encode()).hexdigest()}.jpg"
-
-        file_path = os.path.join(output_dir, filename)
-        logger.debug(f"Фото будет сохранено как: {file_path}")
-
+        spool_dir = os.path.join(photo_cache.root_dir, MEDIA_CACHE_STAGING_DIR)
+        os.makedirs(spool_dir, exist_ok=True)
+        buffer = tempfile.SpooledTemporaryFile(max_size=PHOTO_SPOOL_MAX_BYTES, dir=spool_dir)
         bytes_downloaded = 0
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                bytes_downloaded += len(chunk)
-                if bytes_downloaded > max_bytes:
-                     logger.warning(f"Фото {photo_url} превышает лимит {max_size_mb} MB во время скачивания в файл. Скачивание прервано.")
-                     f.close() 
-                     try: os.remove(file_path); logger.info(f"Удален частично скачанный файл: {file_path}") 
-                     except OSError as del_err: logger.error(f"Не удалось удалить частично скачанный файл {file_path}: {del_err}")
-                     return None
-                f.write(chunk)
-
-        final_size_mb = bytes_downloaded / (1024 * 1024)
-        logger.info(f"Фото успешно скачано и сохранено: {file_path} ({final_size_mb:.2f} MB)")
-        return file_path
-
-    except requests.exceptions.Timeout: logger.error(f"Таймаут при скачивании фото {photo_url}"); return None
-    except requests.exceptions.RequestException as e: logger.error(f"Ошибка сети при скачивании фото {photo_url}: {e}"); return None
-    except Exception as e: logger.exception(f"Неизвестная ошибка при скачивании фото {photo_url} в файл: {e}"); return None
+        for chunk in response.iter_content(chunk_size=8192):
+            bytes_downloaded += len(chunk)
+            if bytes_downloaded > max_bytes:
+                logger.warning(f"Фото {photo_url} превышает лимит {max_size_mb} MB во время скачивания. Скачивание прервано.")
+                buffer.close(); return False
+            buffer.write(chunk)
+        logger.info("Фото успешно скачано: %s (%.2f MB%s)", photo_url, bytes_downloaded / (1024 * 1024), ', на диске' if bytes_downloaded > PHOTO_SPOOL_MAX_BYTES else '')
+        _store_photo_in_cache(cache_key, photo_url, buffer)
+        buffer.seek(0)
+        return buffer
+
+    except requests.exceptions.Timeout: logger.error(f"Таймаут при скачивании фото {photo_url}")
+    except requests.exceptions.RequestException as e: logger.error(f"Ошибка сети при скачивании фото {photo_url}: {e}")
+    except Exception as e: logger.exception(f"Неизвестная ошибка при скачивании фото {photo_url}: {e}")
+    finally:
+        if response is not None: response.close() # Возвращает соединение в пул и при досрочном выходе
+    if buffer is not None: buffer.close()
+    return None
+
+def _store_photo_in_cache(cache_key, photo_url, buffer):
+    """Копирует скачанное фото в photo_cache, чтобы повторная fallback-отправка не скачивала его снова."""
+    try: staging_dir = photo_cache.create_staging_dir()
+    except OSError as e: logger.error(f"Не удалось создать временную папку в '{photo_cache.root_dir}': {e}"); return
+    try:
+        staged_path = os.path.join(staging_dir, 'photo' + (os.path.splitext(urlparse(photo_url).path)[1] or '.jpg'))
+        buffer.seek(0)
+        with open(staged_path, 'wb') as f: shutil.copyfileobj(buffer, f)
+        photo_cache.commit(cache_key, staged_path)
+    except OSError as e: logger.error(f"Не удалось сохранить фото {photo_url} в кэш: {e}")
+    finally: shutil.rmtree(staging_dir, ignore_errors=True)
+
+# --- Пул долгоживущих экземпляров yt-dlp ---
+# Создание YoutubeDL на каждое видео заново инициализирует экстракторы, cookie и HTTP-обработчики
+# и теряет keep-alive соединения с CDN VK. Экземпляры создаются по требованию и переиспользуются
+TELEGRAM_VIDEO_SIZE_LIMIT_MB = 50
+YTDLP_BASE_OPTIONS = {
+    # Формат, который не требует ffmpeg для слияния,
+    # но при этом старается получить лучший MP4, не превышающий лимит по размеру.
+    'format': f'best[ext=mp4][filesize<=?{TELEGRAM_VIDEO_SIZE_LIMIT_MB}M]/best[ext=mp4]/best',
+    'quiet': True, 'noprogress': True, 'noplaylist': True,
+    'logger': logger, 'verbose': False, 'no_warnings': True,
+}
+
+class YtDlpEnginePool:
+    """
+    Не более size экземпляров yt_dlp.YoutubeDL с общими базовыми опциями.
+    checkout() выдает экземпляр в монопольное пользование; переданные опции действуют только на время выдачи.
+    """
+    def __init__(self, base_options, size):
+        self.base_options = base_options
+        self.size = max(1, size)
+        self.idle = queue.LifoQueue() # последний возвращенный экземпляр - с самыми "теплыми" соединениями
+        self.lock = threading.Lock()
+        self.created = 0
+        self.stats = {'checkouts': 0, 'created': 0, 'waited': 0}
+
+    def _acquire(self):
+        try: return self.idle.get_nowait()
+        except queue.Empty: pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1; self.stats['created'] += 1
+                create = True
+            else:
+                self.stats['waited'] += 1
+                create = False
+        if not create: return self.idle.get()
+        try:
+            logger.debug("Создание экземпляра yt-dlp (%s/%s).", self.created, self.size)
+            return yt_dlp.YoutubeDL(dict(self.base_options))
+        except Exception:
+            with self.lock: self.created -= 1
+            raise
+
+    @contextmanager
+    def checkout(self, **overrides):
+        ydl = self._acquire()
+        with self.lock: self.stats['checkouts'] += 1
+        saved_params = {key: ydl.params[key] for key in overrides if key in ydl.params}
+        missing_params = [key for key in overrides if key not in ydl.params]
+        saved_format_selector = ydl.format_selector
+        try:
+            for key, value in overrides.items():
+                if key == 'outtmpl' and not isinstance(value, dict):
+                    value = {**ydl.params.get('outtmpl', {}), 'default': value}
+                ydl.params[key] = value
+            if 'format' in overrides: ydl.format_selector = ydl.build_format_selector(overrides['format'])
+            yield ydl
+        finally:
+            ydl.params.update(saved_params)
+            for key in missing_params: ydl.params.pop(key, None)
+            ydl.format_selector = saved_format_selector
+            self.idle.put(ydl)
+
+    def close(self):
+        while True:
+            try: ydl = self.idle.get_nowait()
+            except queue.Empty: break
+            try: ydl.close()
+            except Exception as e: logger.debug("Ошибка закрытия экземпляра yt-dlp: %s", e)
+            with self.lock: self.created -= 1
+
+    def get_stats(self):
+        with self.lock: return dict(self.stats, size=self.created, idle=self.idle.qsize())
+
+ytdlp_engine_pool = YtDlpEnginePool(YTDLP_BASE_OPTIONS, getattr(config, 'YTDLP_ENGINE_POOL_SIZE', 3))
 
 # --- Функция скачивания видео ---
-def download_vk_video(video_url, output_dir=DOWNLOAD_DIR):
-    logger.info(f"Скачивание видео: {video_url} -> {output_dir}")
+def download_vk_video(video_url, media_cache=None):
+    """Возвращает (путь к видео в кэше или None, метаданные), скачивая видео только при промахе кэша."""
+    media_cache = media_cache or video_cache
+    cache_key = video_cache_key(video_url)
+    if cached_path := media_cache.lookup(cache_key):
+        logger.info("Видео %s взято из кэша: %s", video_url, cached_path)
+        return cached_path, media_cache.get_metadata(cache_key)
+    try: staging_dir = media_cache.create_staging_dir()
+    except OSError as e: logger.exception(f"Не удалось создать временную папку в '{media_cache.root_dir}': {e}"); return None, {}
+    try:
+        downloaded_path, video_metadata = _download_vk_video_to(video_url, staging_dir) or (None, {})
+        if downloaded_path: downloaded_path = media_cache.commit(cache_key, downloaded_path, video_metadata)
+        return downloaded_path, video_metadata
+    finally: shutil.rmtree(staging_dir, ignore_errors=True)
+
+def estimate_format_size(fmt, duration):
+    """Размер формата в байтах: filesize, filesize_approx или битрейт (tbr, Кбит/с) x длительность. None - неизвестен."""
+    if size := fmt.get('filesize') or fmt.get('filesize_approx'): return size
+    if fmt.get('tbr') and duration: return int(fmt['tbr'] * 1000 / 8 * duration)
+    return None
+
+def choose_video_format(info_dict, max_bytes):
+    """
+    Выбирает лучший формат с видео и звуком, который по оценке помещается в max_bytes (предпочтительно mp4).
+    Возвращает (format_id, 'fits'), (None, 'too_large') если известны размеры всех форматов и ни один не подходит,
+    или (None, 'unknown') если оценить размеры нельзя - тогда используется формат по умолчанию.
+    """
+    formats = [f for f in (info_dict or {}).get('formats') or []
+               if f.get('format_id') and f.get('vcodec') != 'none' and f.get('acodec') != 'none']
+    if not formats: return None, 'unknown'
+    duration = info_dict.get('duration')
+    sized = [(estimate_format_size(f, duration), f) for f in formats]
+    fitting = [(size, f) for size, f in sized if size is not None and size <= max_bytes]
+    if fitting:
+        _, best = max(fitting, key=lambda item: (item[1].get('ext') == 'mp4', item[1].get('height') or 0, item[1].get('tbr') or 0, item[0]))
+        return best['format_id'], 'fits'
+    if all(size is not None for size, _ in sized): return None, 'too_large'
+    return None, 'unknown'
+
+def _download_vk_video_to(video_url, output_dir):
+    logger.info("Скачивание видео: %s -> %s", video_url, output_dir)
     if not os.path.exists(output_dir):
-        try: os.makedirs(output_dir); logger.info(f"Создана папка: {output_dir}")
+        try: os.makedirs(output_dir); logger.info("Создана папка: %s", output_dir)
         except OSError as e: logger.exception(f"Не удалось создать папку '{output_dir}': {e}"); return None
 
     output_template = os.path.join(output_dir, '%(id)s_%(title).100s.%(ext)s')
-    telegram_max_mb = 50
-    ydl_opts = {
-        'outtmpl': output_template,
-        # Возвращаемся к формату, который не требует ffmpeg для слияния,
-        # но при этом старается получить лучший MP4, не превышающий лимит по размеру.
-        'format': f'best[ext=mp4][filesize<=?{telegram_max_mb}M]/best[ext=mp4]/best',
-        'quiet': True, 'noprogress': True, 'noplaylist': True,
-        'logger': logger, 'verbose': False, 'no_warnings': True,
-    }
+    telegram_max_mb = TELEGRAM_VIDEO_SIZE_LIMIT_MB
 
     downloaded_file_path = None
     info_dict = {} # Инициализируем info_dict
     try:
-        logger.debug(f"Вызов yt_dlp для {video_url} с опциями: {ydl_opts}")
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(video_url, download=True)
-            logger.debug(f"yt_dlp info_dict (частично) для {video_url}: id={info_dict.get('id')}, title={info_dict.get('title', 'N/A')[:50]}, filename={info_dict.get('_filename', 'N/A')}, width={info_dict.get('width')}, height={info_dict.get('height')}, duration={info_dict.get('duration')}")
+        logger.debug("Вызов yt_dlp для %s, шаблон имени: %s", video_url, output_template)
+        with ytdlp_engine_pool.checkout(outtmpl=output_template) as ydl:
+            # Сначала только метаданные: формат выбирается по оценке размера, чтобы не скачивать заведомо большие файлы
+            info_dict = ydl.extract_info(video_url, download=False)
+            format_id, size_verdict = choose_video_format(info_dict, telegram_max_mb * 1024 * 1024)
+            if size_verdict == 'too_large':
+                logger.warning(f"yt-dlp: Все форматы {video_url} больше {telegram_max_mb} MB. Скачивание пропущено.")
+                return None, _video_metadata(info_dict)
+            if format_id:
+                logger.debug("Выбран формат %s для %s по оценке размера.", format_id, video_url)
+                ydl.format_selector = ydl.build_format_selector(format_id)
+            else:
+                logger.debug("Размеры форматов %s неизвестны, используется формат по умолчанию.", video_url)
+            info_dict = ydl.process_ie_result(info_dict, download=True)
+            logger.debug("yt_dlp info_dict (частично) для %s: id=%s, title=%s, filename=%s, width=%s, height=%s, duration=%s", video_url, info_dict.get('id'), info_dict.get('title', 'N/A')[:50], info_dict.get('_filename', 'N/A'), info_dict.get('width'), info_dict.get('height'), info_dict.get('duration'))
 
             expected_filename = ydl.prepare_filename(info_dict) if info_dict else None
-            logger.debug(f"Ожидаемый путь файла от ydl.prepare_filename: {expected_filename}")
+            logger.debug("Ожидаемый путь файла от ydl.prepare_filename: %s", expected_filename)
             actual_filepath = info_dict.get('requested_downloads', [{}])[0].get('filepath') or info_dict.get('_filename')
-            logger.debug(f"Фактический путь из info_dict (requested_downloads/ _filename): {actual_filepath}")
+            logger.debug("Фактический путь из info_dict (requested_downloads/ _filename): %s", actual_filepath)
             final_filename = actual_filepath or expected_filename
 
             if final_filename and os.path.exists(final_filename):
                  downloaded_file_path = final_filename
-                 logger.info(f"Видео скачано/существует: {downloaded_file_path}")
+                 logger.info("Видео скачано/существует: %s", downloaded_file_path)
                  try:
                      file_size_mb = os.path.getsize(downloaded_file_path) / (1024 * 1024)
                      if file_size_mb > telegram_max_mb:
                          logger.warning(f"Файл {downloaded_file_path} ({file_size_mb:.2f} MB) > {telegram_max_mb} MB.")
-                         try: os.remove(downloaded_file_path); logger.info(f"Удален большой файл: {downloaded_file_path}")
+                         try: os.remove(downloaded_file_path); logger.info("Удален большой файл: %s", downloaded_file_path)
                          except OSError as del_err: logger.error(f"Не удалось удалить большой файл {downloaded_file_path}: {del_err}")
                          return None
-                     else: logger.info(f"Размер файла {downloaded_file_path}: {file_size_mb:.2f} MB.")
+                     else: logger.info("Размер файла %s: %.2f MB.", downloaded_file_path, file_size_mb)
                  except OSError as size_err:
                       logger.error(f"Ошибка проверки размера {downloaded_file_path}: {size_err}")
                       try: os.remove(downloaded_file_path)
@@ -493,14 +1239,14 @@ def download_vk_video(video_url, output_dir=DOWNLOAD_DIR):
                          possible = [f for f in os.listdir(output_dir) if f.startswith(str(video_id)) and f.lower().endswith('.mp4')]
                          if possible:
                              found = os.path.join(output_dir, possible[0])
-                             logger.debug(f"Найдены возможные файлы по ID {video_id}: {possible}. Выбран: {found}")
+                             logger.debug("Найдены возможные файлы по ID %s: %s. Выбран: %s", video_id, possible, found)
                              if os.path.exists(found):
                                  if (fs := os.path.getsize(found) / (1024*1024)) <= telegram_max_mb:
                                      downloaded_file_path = found
-                                     logger.info(f"Найден файл по ID: {found} ({fs:.2f} MB)")
+                                     logger.info("Найден файл по ID: %s (%.2f MB)", found, fs)
                                  else:
                                      logger.warning(f"Файл по ID {found} ({fs:.2f}MB) > {telegram_max_mb} MB.")
-                                     try: os.remove(found); logger.info(f"Удален большой файл по ID: {found}")
+                                     try: os.remove(found); logger.info("Удален большой файл по ID: %s", found)
                                      except OSError as del_err: logger.error(f"Не удалось удалить большой файл по ID {found}: {del_err}")
                              else:
                                  logger.error(f"Файл {found}, найденный по ID, не существует.")
@@ -518,23 +1264,459 @@ def download_vk_video(video_url, output_dir=DOWNLOAD_DIR):
         else: logger.error(f"Ошибка скачивания yt-dlp {video_url}: {e}")
     except Exception as e: logger.exception(f"Неизвестная ошибка скачивания {video_url}: {e}")
 
-    logger.debug(f"Результат download_vk_video для {video_url}: {downloaded_file_path}")
-    video_metadata = {
+    logger.debug("Результат download_vk_video для %s: %s", video_url, downloaded_file_path)
+    return downloaded_file_path, _video_metadata(info_dict)
+
+def _video_metadata(info_dict):
+    return {
         'width': info_dict.get('width'),
         'height': info_dict.get('height'),
         'duration': info_dict.get('duration'),
         'thumbnail': info_dict.get('thumbnail') # Добавляем URL миниатюры
     } if info_dict else {}
-    return downloaded_file_path, video_metadata
 
+def fetch_video_thumbnail(thumbnail_url):
+    """Скачивает миниатюру видео. Возвращает байты или None."""
+    try:
+        response = http_client.get(thumbnail_url, timeout=10)
+        response.raise_for_status()
+        logger.debug("Миниатюра успешно загружена. URL: %s", thumbnail_url)
+        return response.content
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Не удалось загрузить миниатюру с URL {thumbnail_url}: {e}")
+    except Exception as e:
+        logger.exception(f"Неизвестная ошибка при обработке миниатюры {thumbnail_url}: {e}")
+    return None
+
+# --- Миниатюры видео ---
+# Telegram принимает миниатюру только в JPEG не больше 320px по большей стороне и до 200 KB.
+# Миниатюра готовится один раз при предзагрузке видео (превью VK, уменьшенное Pillow или ffmpeg,
+# либо кадр из скачанного файла, если превью нет) и хранится в кэше по id видео
+THUMBNAIL_MAX_SIDE = 320
+THUMBNAIL_MAX_BYTES = 200 * 1024
+FFMPEG_PATH = shutil.which('ffmpeg')
+thumbnail_cache = MediaCache(getattr(config, 'THUMBNAIL_CACHE_DIR', 'vk_thumbs'), getattr(config, 'THUMBNAIL_CACHE_MAX_MB', 50) * 1024 * 1024)
+
+def _jpeg_dimensions(image_bytes):
+    """(ширина, высота) JPEG по заголовку SOF или None, если это не JPEG."""
+    if not image_bytes.startswith(b'\xff\xd8'): return None
+    pos = 2
+    while pos + 9 <= len(image_bytes):
+        if image_bytes[pos] != 0xFF: return None
+        marker = image_bytes[pos + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7: pos += 2; continue
+        segment_length = int.from_bytes(image_bytes[pos + 2:pos + 4], 'big')
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return int.from_bytes(image_bytes[pos + 7:pos + 9], 'big'), int.from_bytes(image_bytes[pos + 5:pos + 7], 'big')
+        pos += 2 + segment_length
+    return None
+
+def _ffmpeg_thumbnail(input_path, output_path, seek_seconds=None):
+    """Один кадр (или картинка) в JPEG, вписанный в THUMBNAIL_MAX_SIDE."""
+    command = [FFMPEG_PATH, '-y', '-loglevel', 'error']
+    if seek_seconds: command += ['-ss', f"{seek_seconds:.2f}"]
+    command += ['-i', input_path, '-frames:v', '1',
+                '-vf', f"scale='min({THUMBNAIL_MAX_SIDE},iw)':'min({THUMBNAIL_MAX_SIDE},ih)':force_original_aspect_ratio=decrease",
+                '-q:v', '5', output_path]
+    subprocess.run(command, check=True, capture_output=True, timeout=30)
+    with open(output_path, 'rb') as f: return f.read()
+
+def fit_thumbnail(image_bytes, work_dir):
+    """Приводит картинку к требованиям Telegram к миниатюре. Возвращает байты JPEG или None."""
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                image = image.convert('RGB')
+                image.thumbnail((THUMBNAIL_MAX_SIDE, THUMBNAIL_MAX_SIDE))
+                for quality in (85, 70, 55, 40):
+                    output = io.BytesIO()
+                    image.save(output, 'JPEG', quality=quality, optimize=True)
+                    if output.tell() <= THUMBNAIL_MAX_BYTES: return output.getvalue()
+        except Exception as e: logger.warning(f"Pillow не смог обработать миниатюру: {e}")
+    dimensions = _jpeg_dimensions(image_bytes)
+    if dimensions and max(dimensions) <= THUMBNAIL_MAX_SIDE and len(image_bytes) <= THUMBNAIL_MAX_BYTES:
+        return image_bytes
+    if FFMPEG_PATH:
+        source_path = os.path.join(work_dir, 'source')
+        with open(source_path, 'wb') as f: f.write(image_bytes)
+        try:
+            if len(thumb_bytes := _ffmpeg_thumbnail(source_path, os.path.join(work_dir, 'scaled.jpg'))) <= THUMBNAIL_MAX_BYTES: return thumb_bytes
+        except (subprocess.SubprocessError, OSError) as e: logger.warning(f"ffmpeg не смог уменьшить миниатюру: {e}")
+    logger.debug("Миниатюра не приведена к требованиям Telegram (размер %s, %s байт; Pillow и ffmpeg недоступны).", dimensions, len(image_bytes))
+    return None
+
+def prepare_video_thumbnail(video_url, thumbnail_url=None, video_path=None, duration=None):
+    """Путь к готовой миниатюре видео в кэше или None."""
+    cache_key = video_cache_key(video_url)
+    if cached_path := thumbnail_cache.lookup(cache_key): return cached_path
+    try: work_dir = thumbnail_cache.create_staging_dir()
+    except OSError as e: logger.error(f"Не удалось создать временную папку для миниатюры: {e}"); return None
+    try:
+        thumb_bytes = None
+        if thumbnail_url and (source_bytes := fetch_video_thumbnail(thumbnail_url)):
+            thumb_bytes = fit_thumbnail(source_bytes, work_dir)
+        if thumb_bytes is None and video_path and FFMPEG_PATH:
+            logger.debug("Миниатюра %s: кадр из скачанного файла.", video_url)
+            try:
+                thumb_bytes = _ffmpeg_thumbnail(video_path, os.path.join(work_dir, 'frame.jpg'), seek_seconds=min(1.0, duration / 2) if duration else None)
+                if len(thumb_bytes) > THUMBNAIL_MAX_BYTES: thumb_bytes = None
+            except (subprocess.SubprocessError, OSError) as e: logger.warning(f"ffmpeg не смог получить кадр из {video_path}: {e}")
+        if not thumb_bytes: return None
+        thumb_path = os.path.join(work_dir, 'thumb.jpg')
+        with open(thumb_path, 'wb') as f: f.write(thumb_bytes)
+        return thumbnail_cache.commit(cache_key, thumb_path)
+    except Exception as e:
+        logger.exception(f"Ошибка подготовки миниатюры для {video_url}: {e}")
+        return None
+    finally: shutil.rmtree(work_dir, ignore_errors=True)
+
+# --- Пулы предзагрузки вложений ---
+# Видео (вместе с миниатюрами) скачиваются в фоне, пока отправляются текст и фотоальбом поста.
+# Фото для fallback медиагруппы качаются в отдельном пуле, чтобы не ждать за долгими загрузками видео
+ATTACHMENT_PREFETCH_WORKERS = getattr(config, 'ATTACHMENT_PREFETCH_WORKERS', 3)
+PHOTO_DOWNLOAD_WORKERS = getattr(config, 'PHOTO_DOWNLOAD_WORKERS', 4)
+attachment_prefetch_pool = ThreadPoolExecutor(max_workers=ATTACHMENT_PREFETCH_WORKERS, thread_name_prefix="AttachPrefetch")
+photo_download_pool = ThreadPoolExecutor(max_workers=PHOTO_DOWNLOAD_WORKERS, thread_name_prefix="PhotoDownload")
+
+def prefetch_vk_video(video_url):
+    """Задача пула предзагрузки: скачивает видео и его миниатюру. Возвращает (путь или None, метаданные)."""
+    downloaded_path, video_metadata = download_vk_video(video_url)
+    if downloaded_path:
+        video_metadata['thumb_path'] = prepare_video_thumbnail(video_url, video_metadata.get('thumbnail'), downloaded_path, video_metadata.get('duration'))
+    return downloaded_path, video_metadata
+
+
+# --- Кэш file_id загруженных в Telegram медиа ---
+# Повторная отправка того же видео или фото (повтор, кросспост в другой чат) идет по file_id без скачивания и загрузки
+class TelegramFileIdCache:
+    """
+    LRU-кэш "ключ медиа VK -> file_id Telegram" с сохранением на диск.
+    Записи, которые Telegram отклонил, удаляются через invalidate().
+    """
+    def __init__(self, file_path, max_entries):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # ключ медиа -> file_id
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'invalidated': 0}
+
+    def load(self):
+        try:
+            if not os.path.exists(self.file_path): return
+            with open(self.file_path, 'r', encoding='utf-8') as f: stored = json.load(f)
+            with self.lock:
+                self.entries.update(stored)
+                while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+            logger.info("Кэш file_id загружен: %s записей.", len(self.entries))
+        except Exception as e: logger.error(f"Не удалось загрузить кэш file_id {self.file_path}: {e}")
+
+    def save(self):
+        with self.lock:
+            if not self.dirty: return
+            snapshot = dict(self.entries)
+            self.dirty = False
+        try:
+            tmp_path = f"{self.file_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.file_path)
+            logger.debug("Кэш file_id сохранен: %s записей.", len(snapshot))
+        except Exception as e: logger.error(f"Не удалось сохранить кэш file_id {self.file_path}: {e}")
+
+    def get(self, media_key):
+        with self.lock:
+            file_id = self.entries.get(media_key)
+            if file_id is None:
+                self.stats['misses'] += 1; return None
+            self.entries.move_to_end(media_key)
+            self.stats['hits'] += 1
+            return file_id
+
+    def contains(self, media_key):
+        """Проверка без учета в статистике - для решения, нужно ли скачивать медиа заранее."""
+        with self.lock: return media_key in self.entries
+
+    def put(self, media_key, file_id):
+        if not media_key or not file_id: return
+        with self.lock:
+            if self.entries.get(media_key) != file_id:
+                self.entries[media_key] = file_id; self.dirty = True
+                self.stats['stored'] += 1
+            self.entries.move_to_end(media_key)
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+    def invalidate(self, media_key):
+        """Вызывается только при отказе Telegram принять file_id (is_file_id_rejection), не при сетевых ошибках."""
+        with self.lock:
+            if self.entries.pop(media_key, None) is not None:
+                self.dirty = True; self.stats['invalidated'] += 1
+                logger.info("file_id для %s отклонен Telegram и удален из кэша.", media_key)
+
+    def get_stats(self):
+        with self.lock: return dict(self.stats, size=len(self.entries))
+
+telegram_file_cache = TelegramFileIdCache(
+    getattr(config, 'TELEGRAM_FILE_ID_CACHE_FILE', 'telegram_file_ids.json'),
+    max_entries=getattr(config, 'TELEGRAM_FILE_ID_CACHE_MAX_ENTRIES', 20000),
+)
 
-# --- Вспомогательные функции для отправки ---
-def _safe_send_tg_message(func, chat_id, *args, **kwargs):
-    func_name = func.__name__
-    text_plain = kwargs.pop('text_plain', None)
-    caption_plain = kwargs.pop('caption_plain', None)
-    current_kwargs = kwargs.copy()
+def video_media_key(owner_id, video_id):
+    return f"video{owner_id}_{video_id}"
+
+def photo_media_key(photo_url):
+    """Ключ фото по URL без параметров запроса (у VK они меняются при каждой выдаче ссылки)."""
+    parsed = urlparse(photo_url)
+    return "photo" + hashlib.md5(f"{parsed.scheme}://{parsed.netloc}{parsed.path}".encode()).hexdigest()
+
+# Описания ответа 400, которыми Telegram отклоняет сам file_id (а не запрос целиком)
+TELEGRAM_FILE_ID_REJECTION_MARKERS = ('wrong file identifier', 'wrong remote file identifier', 'file_reference', 'file reference', 'file_id')
+
+def is_file_id_rejection(e_tg):
+    """True, если Telegram отклонил file_id (удален, устарел, чужой бот) - только тогда запись кэша file_id неверна."""
+    description = (getattr(e_tg, 'description', None) or str(e_tg)).lower()
+    return e_tg.error_code == 400 and any(marker in description for marker in TELEGRAM_FILE_ID_REJECTION_MARKERS)
+
+def _sent_media_file_id(message):
+    """file_id из отправленного сообщения: самое большое фото, либо видео/анимация/документ."""
+    if message is None: return None
+    if getattr(message, 'photo', None): return message.photo[-1].file_id
+    for attr in ('video', 'animation', 'document'):
+        if media := getattr(message, attr, None): return media.file_id
+    return None
+
+# --- Потоковая загрузка видео в Telegram ---
+# bot.send_video собирает multipart-тело целиком в памяти (через requests), поэтому пиковая память росла
+# на размер каждого отправляемого видео. Здесь тело отдается из файла кусками по TELEGRAM_UPLOAD_CHUNK_KB
+# с заранее вычисленным Content-Length: в памяти одновременно находится только один кусок на загрузку
+TELEGRAM_UPLOAD_CHUNK_BYTES = getattr(config, 'TELEGRAM_UPLOAD_CHUNK_KB', 256) * 1024
+
+class StreamingMultipartBody:
+    """
+    Файлоподобное multipart/form-data тело: текстовые поля и файлы, которые читаются с диска по мере отправки.
+    Файлы передаются открытыми объектами с seek/tell и отдаются с начала. len() - точный размер тела в байтах.
+    """
+    def __init__(self, fields, files, chunk_size=TELEGRAM_UPLOAD_CHUNK_BYTES):
+        self.boundary = f"----VkBotUpload{os.urandom(16).hex()}"
+        self.chunk_size = chunk_size
+        self.parts = [] # байты заголовков/полей или (файл, размер)
+        for name, value in fields.items():
+            if value is None: continue
+            self.parts.append(self._part_header(name) + str(value).encode('utf-8') + b"\r\n")
+        for name, (filename, file_obj) in files.items():
+            file_obj.seek(0, os.SEEK_END); size = file_obj.tell(); file_obj.seek(0)
+            self.parts.append(self._part_header(name, filename, 'application/octet-stream'))
+            self.parts.append((file_obj, size))
+            self.parts.append(b"\r\n")
+        self.parts.append(f"--{self.boundary}--\r\n".encode('ascii'))
+        self.length = sum(len(p) if isinstance(p, bytes) else p[1] for p in self.parts)
+        self.part_index = 0
+        self.part_offset = 0
+
+    def _part_header(self, name, filename=None, content_type=None):
+        disposition = f'form-data; name="{name}"'
+        if filename is not None: disposition += f'; filename="{filename.replace(chr(34), "%22")}"'
+        header = f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n"
+        if content_type: header += f"Content-Type: {content_type}\r\n"
+        return (header + "\r\n").encode('utf-8')
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        """Возвращает следующий кусок тела (не больше size и chunk_size байт), b"" - тело закончилось."""
+        limit = self.chunk_size if size is None or size < 0 else min(size, self.chunk_size)
+        while self.part_index < len(self.parts):
+            part = self.parts[self.part_index]
+            if isinstance(part, bytes):
+                chunk = part[self.part_offset:self.part_offset + limit]
+            else:
+                chunk = part[0].read(min(limit, part[1] - self.part_offset))
+                if not chunk and self.part_offset < part[1]:
+                    raise IOError(f"Файл {getattr(part[0], 'name', '?')} укоротился во время загрузки.")
+            if chunk:
+                self.part_offset += len(chunk)
+                return chunk
+            self.part_index += 1; self.part_offset = 0
+        return b""
+
+    def __iter__(self):
+        while chunk := self.read(self.chunk_size): yield chunk
+
+class TelegramUploadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {'uploads': 0, 'bytes': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+    @contextmanager
+    def track(self, body_length):
+        with self.lock:
+            self.stats['uploads'] += 1; self.stats['in_flight'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+        try: yield
+        finally:
+            with self.lock: self.stats['in_flight'] -= 1; self.stats['bytes'] += body_length
+
+    def get_stats(self):
+        with self.lock: return dict(self.stats)
+
+telegram_upload_stats = TelegramUploadStats()
+
+def send_video_streaming(chat_id, video, caption=None, parse_mode=None, supports_streaming=None, width=None, height=None,
+                         duration=None, thumbnail=None, reply_to_message_id=None, timeout=None):
+    """
+    sendVideo с потоковой загрузкой файла video (и миниатюры thumbnail) через общий http_client.
+    Ошибки API поднимаются как ApiTelegramException, поэтому _safe_send_tg_message обрабатывает их как у bot.send_video.
+    """
+    fields = {
+        'chat_id': chat_id, 'caption': caption, 'parse_mode': parse_mode or None,
+        'supports_streaming': 'true' if supports_streaming else None,
+        'width': width, 'height': height, 'duration': int(duration) if duration else None,
+        'reply_to_message_id': reply_to_message_id,
+    }
+    files = {'video': (os.path.basename(getattr(video, 'name', None) or 'video.mp4'), video)}
+    if thumbnail is not None: files['thumbnail'] = ('thumb.jpg', thumbnail)
+    body = StreamingMultipartBody(fields, files)
+    url = telegram_api_url('sendVideo')
+    logger.debug("Потоковая загрузка видео %s в chat_id=%s: %.2f MB кусками по %s KB.", files['video'][0], chat_id, len(body) / (1024 * 1024), body.chunk_size // 1024)
+    with telegram_upload_stats.track(len(body)):
+        response = http_client.session.post(
+            url, data=body, headers={'Content-Type': body.content_type, 'Content-Length': str(len(body))},
+            timeout=(http_client.connect_timeout, timeout or 180)
+        )
+    try: result_json = telebot.apihelper._check_result('sendVideo', response)
+    finally: response.close()
+    return types.Message.de_json(result_json['result'])
+
+# --- Планировщик исходящих запросов к Telegram ---
+# Все safe_send_* идут через один планировщик: общий лимит бота и лимит на каждый чат (личные чаты и группы/каналы
+# ограничиваются по-разному), а после ответа 429 чат ставится на паузу ровно на retry_after из ответа.
+# Фиксированные паузы между сообщениями не нужны: отправка ждет, только когда лимит действительно исчерпан
+class TelegramSendScheduler:
+    def __init__(self, global_rate, global_burst, private_chat_rate, group_chat_rate, chat_burst, max_429_retries):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_429_retries = max_429_retries
+        self.lock = threading.Lock()
+        self.chat_buckets = {} # chat_id -> TokenBucket
+        self.paused_until = {} # chat_id -> время окончания паузы после 429
+        self.stats = {'requests': 0, 'throttled': 0, 'wait_seconds': 0.0, 'error_429': 0, 'retry_after_seconds': 0.0}
+
+    def _chat_bucket(self, chat_id):
+        chat_key = str(chat_id)
+        with self.lock:
+            if (bucket := self.chat_buckets.get(chat_key)) is None:
+                # Отрицательные ID - группы и каналы, у них лимит ниже, чем у личных чатов
+                rate = self.group_chat_rate if chat_key.startswith('-') else self.private_chat_rate
+                bucket = self.chat_buckets[chat_key] = TokenBucket(rate, self.chat_burst)
+            return bucket
+
+    def _wait_turn(self, chat_id, messages):
+        waited = 0.0
+        with self.lock: pause = self.paused_until.get(str(chat_id), 0) - time.monotonic()
+        if pause > 0:
+            logger.debug("Чат %s на паузе после 429, ожидание %.1f сек.", chat_id, pause)
+            time.sleep(pause); waited += pause
+        waited += self._chat_bucket(chat_id).acquire(messages)
+        waited += self.global_bucket.acquire(messages)
+        with self.lock:
+            self.stats['requests'] += 1
+            if waited: self.stats['throttled'] += 1; self.stats['wait_seconds'] += waited
+
+    def call(self, func, chat_id, *args, **kwargs):
+        """Вызывает метод бота в пределах лимитов; при 429 ждет retry_after и повторяет до max_429_retries раз."""
+        media = kwargs.get('media', args[0] if args and func.__name__ == 'send_media_group' else None)
+        messages = len(media) if isinstance(media, list) and media else 1 # Альбом считается Telegram как несколько сообщений
+        for attempt in range(self.max_429_retries + 1):
+            self._wait_turn(chat_id, messages)
+            try: return func(chat_id, *args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt >= self.max_429_retries: raise
+                retry_after = _telegram_retry_after(e)
+                with self.lock:
+                    self.paused_until[str(chat_id)] = max(self.paused_until.get(str(chat_id), 0), time.monotonic() + retry_after)
+                    self.stats['error_429'] += 1; self.stats['retry_after_seconds'] += retry_after
+                logger.warning(f"Telegram 429 ({func.__name__}, чат {chat_id}): повтор через {retry_after} сек. (попытка {attempt + 2}/{self.max_429_retries + 1}).")
+                _rewind_send_payload(args, kwargs)
+
+    def get_stats(self):
+        with self.lock: return dict(self.stats, chats=len(self.chat_buckets))
+
+def _telegram_retry_after(error, default=5):
+    parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+    try: return max(float(parameters.get('retry_after', default)), 0.0)
+    except (TypeError, ValueError): return default
+
+def _rewind_send_payload(args, kwargs):
+    """Перематывает файлы запроса в начало перед повторной отправкой (в том числе файлы внутри InputMedia)."""
+    for value in (*args, *kwargs.values()):
+        for item in value if isinstance(value, list) else [value]:
+            file_obj = getattr(item, 'media', item)
+            if hasattr(file_obj, 'seek') and not isinstance(file_obj, str):
+                try: file_obj.seek(0)
+                except (OSError, ValueError): pass
+
+telegram_send_scheduler = TelegramSendScheduler(
+    global_rate=getattr(config, 'TELEGRAM_GLOBAL_RATE_PER_SECOND', 30),
+    global_burst=getattr(config, 'TELEGRAM_GLOBAL_BURST', 30),
+    private_chat_rate=getattr(config, 'TELEGRAM_PRIVATE_CHAT_RATE_PER_SECOND', 1),
+    group_chat_rate=getattr(config, 'TELEGRAM_GROUP_CHAT_RATE_PER_MINUTE', 20) / 60,
+    chat_burst=getattr(config, 'TELEGRAM_CHAT_BURST', 3),
+    max_429_retries=getattr(config, 'TELEGRAM_429_MAX_RETRIES', 3),
+)
 
+# --- Локальная проверка Markdown ---
+# Повторяет разбор parse_mode='Markdown' на стороне Telegram: после \ экранируются только _ * ` [,
+# сущность *...*, _..._, `...`, ```...``` или [...] должна быть закрыта, иначе сервер отвечает "can't parse entities".
+# Текст с ошибкой разметки сразу отправляется в простом варианте, без заведомо неудачного запроса (и повторной загрузки медиа)
+MARKDOWN_ENTITY_CHARS = frozenset('_*`[')
+markdown_check_lock = threading.Lock()
+markdown_check_stats = {'checked': 0, 'retries_avoided': 0, 'api_parse_errors': 0}
+
+def find_markdown_error(text):
+    """Позиция незакрытой сущности Markdown в text или None, если Telegram примет разметку."""
+    if not text: return None
+    i, size = 0, len(text)
+    while i < size:
+        c = text[i]
+        if c == '\\' and i + 1 < size and text[i + 1] in MARKDOWN_ENTITY_CHARS: i += 2; continue
+        if c not in MARKDOWN_ENTITY_CHARS: i += 1; continue
+        begin_pos = i
+        is_pre = c == '`' and text.startswith('``', i + 1)
+        i += 3 if is_pre else 1
+        if c == '[': end_pos = text.find(']', i)
+        elif is_pre: end_pos = text.find('```', i)
+        else: end_pos = text.find(c, i)
+        if end_pos == -1: return begin_pos
+        i = end_pos + (3 if is_pre else 1)
+        if c == '[' and text.startswith('(', i):
+            url_end = text.find(')', i + 1)
+            if url_end == -1: return None # Адрес без ")" Telegram не считает ошибкой: он занимает остаток текста
+            i = url_end + 1
+    return None
+
+def _use_plain_if_markdown_invalid(func_name, chat_id, send_kwargs, text_plain, caption_plain):
+    """Заменяет текст/подпись на простой вариант, если разметка не пройдет разбор Telegram. Меняет send_kwargs на месте."""
+    if send_kwargs.get('parse_mode') != 'Markdown': return
+    field, plain = ('caption', caption_plain) if 'caption' in send_kwargs else ('text', text_plain)
+    if plain is None: return
+    error_pos = find_markdown_error(send_kwargs.get(field))
+    with markdown_check_lock:
+        markdown_check_stats['checked'] += 1
+        if error_pos is not None: markdown_check_stats['retries_avoided'] += 1
+    if error_pos is None: return
+    logger.warning(f"Незакрытая разметка Markdown в {field} ({func_name}, чат {chat_id}) на позиции {error_pos}: отправка без MD.")
+    send_kwargs[field] = plain
+    send_kwargs['parse_mode'] = '' # None означает parse_mode бота по умолчанию (Markdown)
+
+# --- Вспомогательные функции для отправки ---
+def _describe_send_call(args, kwargs):
+    """Краткое представление аргументов отправки для отладочного лога (медиа-данные не печатаются целиком)."""
     log_args_repr_list = []
     if args:
         for arg in args:
@@ -555,8 +1737,8 @@ def _safe_send_tg_message(func, chat_id, *args, **kwargs):
     log_args_repr = f"args=({', '.join(log_args_repr_list)})" if log_args_repr_list else ""
 
     log_kwargs_repr_list = []
-    if current_kwargs:
-        for k, v in current_kwargs.items():
+    if kwargs:
+        for k, v in kwargs.items():
             if k == 'media' and isinstance(v, list):
                  media_repr = []
                  for item in v:
@@ -573,17 +1755,30 @@ def _safe_send_tg_message(func, chat_id, *args, **kwargs):
                  log_kwargs_repr_list.append(f"{k}={repr(v)}")
     log_kwargs_repr = f"kwargs={{{', '.join(log_kwargs_repr_list)}}}" if log_kwargs_repr_list else ""
 
-    logger.debug(f"Попытка вызова {func_name} для chat_id={chat_id}. {log_args_repr} {log_kwargs_repr}. Передаваемые kwargs: {current_kwargs}")
+    return " ".join(part for part in (log_args_repr, log_kwargs_repr) if part)
+
+
+def _safe_send_tg_message(func, chat_id, *args, **kwargs):
+    func_name = func.__name__
+    text_plain = kwargs.pop('text_plain', None)
+    caption_plain = kwargs.pop('caption_plain', None)
+    raise_file_id_rejection = kwargs.pop('raise_file_id_rejection', False) # отправка по file_id из кэша: отказ поднимается наружу
+    current_kwargs = kwargs.copy()
+    _use_plain_if_markdown_invalid(func_name, chat_id, current_kwargs, text_plain, caption_plain)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Попытка вызова %s для chat_id=%s. %s", func_name, chat_id, _describe_send_call(args, current_kwargs))
 
     try:
-        message = func(chat_id, *args, **current_kwargs)
-        logger.debug(f"Успешно вызван {func_name} для chat_id={chat_id}.")
+        message = telegram_send_scheduler.call(func, chat_id, *args, **current_kwargs)
+        logger.debug("Успешно вызван %s для chat_id=%s.", func_name, chat_id)
         return message
     except ApiTelegramException as e_tg:
         if 'parse error' in str(e_tg).lower() or 'can\'t parse entities' in str(e_tg).lower():
             logger.warning(f"Ошибка Markdown ({func_name}, чат {chat_id}): {e_tg}. Попытка без MD.")
+            with markdown_check_lock: markdown_check_stats['api_parse_errors'] += 1
             retry_kwargs = kwargs.copy()
-            retry_kwargs.pop('parse_mode', None)
+            retry_kwargs['parse_mode'] = ''
             if 'caption' in retry_kwargs and caption_plain is not None:
                  retry_kwargs['caption'] = caption_plain
                  logger.debug("Замена caption на caption_plain для повторной отправки.")
@@ -591,15 +1786,17 @@ def _safe_send_tg_message(func, chat_id, *args, **kwargs):
                  retry_kwargs['text'] = text_plain
                  logger.debug("Замена text на text_plain для повторной отправки.")
             try:
-                retry_log_args_repr = f"{args=}" if args else ""
-                retry_log_kwargs_repr = f"{retry_kwargs=}" if retry_kwargs else ""
-                logger.debug(f"Повторная попытка {func_name} для chat_id={chat_id} без Markdown. {retry_log_args_repr} {retry_log_kwargs_repr}")
-                message = func(chat_id, *args, **retry_kwargs)
-                logger.info(f"Отправлено без MD ({func_name}, чат {chat_id}).")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Повторная попытка %s для chat_id=%s без Markdown. %s", func_name, chat_id, _describe_send_call(args, retry_kwargs))
+                message = telegram_send_scheduler.call(func, chat_id, *args, **retry_kwargs)
+                logger.info("Отправлено без MD (%s, чат %s).", func_name, chat_id)
                 return message
             except Exception as e_plain:
                 logger.error(f"Не удалось отправить ({func_name}, чат {chat_id}) даже без MD: {e_plain}")
                 return None
+        elif raise_file_id_rejection and is_file_id_rejection(e_tg):
+             logger.warning(f"Telegram отклонил file_id ({func_name}, чат {chat_id}): {e_tg}")
+             raise e_tg
         elif 'request entity too large' in str(e_tg).lower() or e_tg.error_code == 413:
              logger.error(f"Файл слишком большой ({func_name}, чат {chat_id}): {e_tg}")
              return None
@@ -608,11 +1805,10 @@ def _safe_send_tg_message(func, chat_id, *args, **kwargs):
             retry_kwargs = kwargs.copy()
             retry_kwargs.pop('reply_to_message_id', None)
             try:
-                retry_log_args_repr = f"{args=}" if args else ""
-                retry_log_kwargs_repr = f"{retry_kwargs=}" if retry_kwargs else ""
-                logger.debug(f"Повторная попытка {func_name} для chat_id={chat_id} без ответа. {retry_log_args_repr} {retry_log_kwargs_repr}")
-                message = func(chat_id, *args, **retry_kwargs)
-                logger.info(f"Отправлено без ответа ({func_name}, чат {chat_id}).")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Повторная попытка %s для chat_id=%s без ответа. %s", func_name, chat_id, _describe_send_call(args, retry_kwargs))
+                message = telegram_send_scheduler.call(func, chat_id, *args, **retry_kwargs)
+                logger.info("Отправлено без ответа (%s, чат %s).", func_name, chat_id)
                 return message
             except Exception as e_no_reply:
                 logger.error(f"Не удалось отправить ({func_name}, чат {chat_id}) даже без ответа: {e_no_reply}")
@@ -649,49 +1845,91 @@ def safe_send_message(chat_id, text_md, text_plain, **kwargs):
     if len(text_plain) > limit: safe_limit_plain = text_plain.rfind('\n', 0, limit - 4); safe_limit_plain = limit - 4 if safe_limit_plain == -1 else safe_limit_plain; text_plain = text_plain[:safe_limit_plain] + "..."
     return _safe_send_tg_message(bot.send_message, chat_id, text=text_md, parse_mode='Markdown', text_plain=text_plain, **kwargs)
 
-def safe_send_photo(chat_id, photo_data, caption_md=None, caption_plain=None, **kwargs):
+def safe_send_photo(chat_id, photo_data, caption_md=None, caption_plain=None, media_key=None, **kwargs):
     limit = CAPTION_LIMIT
     if caption_md and len(caption_md) > limit: safe_limit = caption_md.rfind('\n', 0, limit - 4); safe_limit = limit - 4 if safe_limit == -1 else safe_limit; caption_md = caption_md[:safe_limit] + "..."; logger.warning(f"Подпись к фото для chat_id={chat_id} обрезана до {limit} символов.")
     if caption_plain and len(caption_plain) > limit: safe_limit_plain = caption_plain.rfind('\n', 0, limit - 4); safe_limit_plain = limit - 4 if safe_limit_plain == -1 else safe_limit_plain; caption_plain = caption_plain[:safe_limit_plain] + "..."
-    return _safe_send_tg_message(bot.send_photo, chat_id, photo_data, caption=caption_md, parse_mode='Markdown', caption_plain=caption_plain, **kwargs)
-
-def safe_send_video(chat_id, video_file, caption_md=None, caption_plain=None, video_metadata=None, **kwargs):
+    if media_key is None and isinstance(photo_data, str): media_key = photo_media_key(photo_data)
+    if media_key and (cached_file_id := telegram_file_cache.get(media_key)):
+        logger.debug("Отправка фото %s по file_id из кэша.", media_key)
+        try:
+            if sent_msg := _safe_send_tg_message(bot.send_photo, chat_id, cached_file_id, caption=caption_md, parse_mode='Markdown', caption_plain=caption_plain, raise_file_id_rejection=True, **kwargs):
+                return sent_msg
+        except ApiTelegramException as e_cached:
+            if not is_file_id_rejection(e_cached): raise
+            telegram_file_cache.invalidate(media_key)
+    sent_msg = _safe_send_tg_message(bot.send_photo, chat_id, photo_data, caption=caption_md, parse_mode='Markdown', caption_plain=caption_plain, **kwargs)
+    if media_key: telegram_file_cache.put(media_key, _sent_media_file_id(sent_msg))
+    return sent_msg
+
+def safe_send_video(chat_id, video_file, caption_md=None, caption_plain=None, video_metadata=None, media_key=None, **kwargs):
     limit = CAPTION_LIMIT
     if caption_md and len(caption_md) > limit: safe_limit = caption_md.rfind('\n', 0, limit - 4); safe_limit = limit - 4 if safe_limit == -1 else safe_limit; caption_md = caption_md[:safe_limit] + "..."; logger.warning(f"Подпись к видео для chat_id={chat_id} обрезана до {limit} символов.")
     if caption_plain and len(caption_plain) > limit: safe_limit_plain = caption_plain.rfind('\n', 0, limit - 4); safe_limit_plain = limit - 4 if safe_limit_plain == -1 else safe_limit_plain; caption_plain = caption_plain[:safe_limit_plain] + "..."
+    # При попадании в кэш видео отправляется по file_id; если отправка не удалась, используется файл (если он передан).
+    # Запись кэша удаляется, только если Telegram отклонил сам file_id, а не при сетевой ошибке или исчерпанных 429
+    if media_key and (cached_file_id := telegram_file_cache.get(media_key)):
+        logger.debug("Отправка видео %s по file_id из кэша в chat_id=%s", media_key, chat_id)
+        try:
+            if sent_msg := _safe_send_tg_message(bot.send_video, chat_id, cached_file_id, caption=caption_md, parse_mode='Markdown', supports_streaming=True, caption_plain=caption_plain, raise_file_id_rejection=True, **kwargs):
+                return sent_msg
+        except ApiTelegramException as e_cached:
+            if not is_file_id_rejection(e_cached): raise
+            telegram_file_cache.invalidate(media_key)
+    if video_file is None: return None
+
     file_repr = getattr(video_file, 'name', str(video_file))
-    logger.debug(f"Попытка отправки видеофайла: {file_repr} в chat_id={chat_id}")
+    logger.debug("Попытка отправки видеофайла: %s в chat_id=%s", file_repr, chat_id)
 
     if video_metadata:
         if 'width' in video_metadata: kwargs['width'] = video_metadata['width']
         if 'height' in video_metadata: kwargs['height'] = video_metadata['height']
         if 'duration' in video_metadata: kwargs['duration'] = video_metadata['duration']
-        if 'thumbnail' in video_metadata and video_metadata['thumbnail']:
+        # Миниатюра готовится заранее при предзагрузке видео (prepare_video_thumbnail)
+        if thumb_path := video_metadata.get('thumb_path'):
             try:
-                thumbnail_url = video_metadata['thumbnail']
-                response = requests.get(thumbnail_url, stream=True, timeout=10)
-                response.raise_for_status()
-                thumbnail_bytes = io.BytesIO(response.content)
-                kwargs['thumb'] = thumbnail_bytes
-                logger.debug(f"Миниатюра успешно загружена и добавлена для видео. URL: {thumbnail_url}")
-            except requests.exceptions.RequestException as e:
-                logger.warning(f"Не удалось загрузить миниатюру с URL {thumbnail_url}: {e}")
-            except Exception as e:
-                logger.exception(f"Неизвестная ошибка при обработке миниатюры {thumbnail_url}: {e}")
-        logger.debug(f"Добавлены метаданные видео: {video_metadata}. Итоговые kwargs для _safe_send_tg_message: {kwargs}")
+                with open(thumb_path, 'rb') as thumb_file: kwargs['thumbnail'] = io.BytesIO(thumb_file.read())
+                logger.debug("Миниатюра %s добавлена для видео.", thumb_path)
+            except OSError as e: logger.warning(f"Не удалось прочитать миниатюру {thumb_path}: {e}")
+        logger.debug("Добавлены метаданные видео: %s. Итоговые kwargs для _safe_send_tg_message: %s", video_metadata, kwargs)
+
+    # Файл загружается потоково (send_video_streaming), без сборки всего запроса в памяти
+    sent_msg = _safe_send_tg_message(send_video_streaming, chat_id, video_file, caption=caption_md, parse_mode='Markdown', supports_streaming=True, caption_plain=caption_plain, **kwargs)
+    if media_key: telegram_file_cache.put(media_key, _sent_media_file_id(sent_msg))
+    return sent_msg
 
-    return _safe_send_tg_message(bot.send_video, chat_id, video_file, caption=caption_md, parse_mode='Markdown', supports_streaming=True, caption_plain=caption_plain, **kwargs)
+def _remember_media_group_file_ids(media_keys, sent_messages):
+    if len(sent_messages) != len(media_keys): return
+    for key, message in zip(media_keys, sent_messages): telegram_file_cache.put(key, _sent_media_file_id(message))
 
 def safe_send_media_group(chat_id, media_url_list, **kwargs):
     if not isinstance(media_url_list, list) or not all(isinstance(item, types.InputMediaPhoto) and isinstance(item.media, str) for item in media_url_list):
         logger.error(f"Неверный формат media_url_list для safe_send_media_group (ожидался список InputMediaPhoto с URL): {media_url_list}")
         return None
 
-    logger.info(f"Попытка отправки медиагруппы ({len(media_url_list)} фото по URL) в чат {chat_id}...")
+    media_keys = [photo_media_key(item.media) for item in media_url_list]
+    cached_file_ids = [telegram_file_cache.get(key) for key in media_keys]
+    if any(cached_file_ids):
+        logger.info("Отправка медиагруппы в чат %s: %s из %s фото по file_id из кэша.", chat_id, sum(1 for f in cached_file_ids if f), len(media_url_list))
+        cached_media = [types.InputMediaPhoto(media=file_id or item.media, caption=item.caption, parse_mode=item.parse_mode) for item, file_id in zip(media_url_list, cached_file_ids)]
+        try: sent_messages = _safe_send_tg_message(bot.send_media_group, chat_id, media=cached_media, raise_file_id_rejection=True, **kwargs)
+        except ApiTelegramException as e_cached:
+            logger.warning(f"Медиагруппа с file_id из кэша отклонена: {e_cached}")
+            sent_messages = None
+            # Telegram не сообщает, какой из file_id альбома неверен, поэтому при отказе удаляются все записи группы
+            if is_file_id_rejection(e_cached):
+                for key, file_id in zip(media_keys, cached_file_ids):
+                    if file_id: telegram_file_cache.invalidate(key)
+        if sent_messages:
+            _remember_media_group_file_ids(media_keys, sent_messages)
+            return sent_messages
+
+    logger.info("Попытка отправки медиагруппы (%s фото по URL) в чат %s...", len(media_url_list), chat_id)
     try:
         sent_messages = _safe_send_tg_message(bot.send_media_group, chat_id, media=media_url_list, **kwargs)
         if sent_messages:
-            logger.info(f"Медиагруппа ({len(media_url_list)} фото) успешно отправлена по URL.")
+            logger.info("Медиагруппа (%s фото) успешно отправлена по URL.", len(media_url_list))
+            _remember_media_group_file_ids(media_keys, sent_messages)
             return sent_messages
         else:
             logger.error(f"Не удалось отправить медиагруппу по URL (ошибка не WEBPAGE_MEDIA_EMPTY или не API, см. логи выше).")
@@ -700,68 +1938,57 @@ def safe_send_media_group(chat_id, media_url_list, **kwargs):
         if 'webpage_media_empty' in str(e_url).lower() or (e_url.error_code == 400 and 'webpage_media_empty' in e_url.description.lower()):
             logger.warning(f"Ошибка WEBPAGE_MEDIA_EMPTY при отправке по URL. Запуск fallback: скачивание и отправка файлами...")
 
-            media_files_list = []
-            download_successful = True
-            opened_files = [] 
-            for i, item_url in enumerate(media_url_list):
-                original_url = item_url.media
-                logger.info(f"Fallback: Скачивание фото #{i+1}: {original_url}")
-                downloaded_path = download_photo_to_file(original_url, output_dir=PHOTO_DOWNLOAD_DIR)
-
-                if downloaded_path:
-                    logger.info(f"Fallback: Фото #{i+1} скачано: {downloaded_path}")
-                    try:
-                        file_stream = open(downloaded_path, 'rb')
-                        opened_files.append(file_stream)
-                        media_files_list.append(types.InputMediaPhoto(
-                            media=file_stream,
-                            caption=item_url.caption,
-                            parse_mode=item_url.parse_mode
-                        ))
-                    except FileNotFoundError:
-                         logger.error(f"Fallback: Скачанный файл не найден: {downloaded_path}")
-                         download_successful = False; break
-                    except Exception as e_create_media:
-                         logger.exception(f"Fallback: Ошибка создания InputMediaPhoto из файла {downloaded_path}: {e_create_media}")
-                         download_successful = False
-                         if 'file_stream' in locals() and file_stream and file_stream in opened_files:
-                              try: file_stream.close(); opened_files.remove(file_stream)
-                              except Exception: pass
-                         break
-                else:
-                    logger.error(f"Fallback: Не удалось скачать фото #{i+1} ({original_url}). Отправка медиагруппы файлами отменена.")
-                    download_successful = False; break
-
-            if not download_successful or not media_files_list:
-                logger.error("Fallback: Не удалось подготовить все фото для отправки файлами.")
-                for f in opened_files: 
-                    if not f.closed:
-                        try: f.close()
-                        except Exception: pass
+            # Все фото скачиваются одновременно в буферы; повторно скачиваются только неудавшиеся
+            photo_buffers = [None] * len(media_url_list)
+            for attempt in range(1 + PHOTO_FALLBACK_RETRIES):
+                pending = [i for i, buffer in enumerate(photo_buffers) if buffer is None]
+                if not pending: break
+                if attempt: logger.info("Fallback: Повторное скачивание %s фото (попытка %s).", len(pending), attempt + 1)
+                download_futures = {i: photo_download_pool.submit(download_photo_to_buffer, media_url_list[i].media) for i in pending}
+                for i, download_future in download_futures.items(): photo_buffers[i] = download_future.result()
+
+            kept_indexes = [i for i, buffer in enumerate(photo_buffers) if buffer]
+            opened_files = [photo_buffers[i] for i in kept_indexes]
+            if len(kept_indexes) < len(media_url_list):
+                skipped = [f"#{i+1}" for i in range(len(media_url_list)) if i not in kept_indexes]
+                logger.warning(f"Fallback: Фото {', '.join(skipped)} не скачаны и будут пропущены.")
+            if not kept_indexes:
+                logger.error("Fallback: Не удалось скачать ни одного фото для отправки файлами.")
                 return None
 
-            logger.info(f"Fallback: Попытка отправки медиагруппы ({len(media_files_list)} фото файлами)...")
-            sent_messages_files = None
+            # Подпись альбома (у первого фото) переносится на первое из оставшихся
+            caption_item = next((item for item in media_url_list if item.caption), None)
+            media_files_list = [types.InputMediaPhoto(
+                media=photo_buffers[i],
+                caption=caption_item.caption if caption_item and n == 0 else None,
+                parse_mode=caption_item.parse_mode if caption_item and n == 0 else media_url_list[i].parse_mode
+            ) for n, i in enumerate(kept_indexes)]
+            kept_media_keys = [media_keys[i] for i in kept_indexes]
+
+            logger.info("Fallback: Попытка отправки %s фото файлами...", len(media_files_list))
             try:
-                sent_messages_files = _safe_send_tg_message(bot.send_media_group, chat_id, media=media_files_list, timeout=120, **kwargs)
+                if len(media_files_list) == 1:
+                    # Медиагруппа требует минимум 2 элемента - одно фото отправляется обычным сообщением
+                    single = media_files_list[0]
+                    sent_photo = _safe_send_tg_message(bot.send_photo, chat_id, single.media, caption=single.caption, parse_mode=single.parse_mode, timeout=120, **kwargs)
+                    sent_messages_files = [sent_photo] if sent_photo else None
+                else:
+                    sent_messages_files = _safe_send_tg_message(bot.send_media_group, chat_id, media=media_files_list, timeout=120, **kwargs)
                 if sent_messages_files:
-                    logger.info(f"Fallback: Медиагруппа ({len(media_files_list)} фото) успешно отправлена файлами.")
+                    logger.info("Fallback: %s фото из %s успешно отправлены файлами.", len(media_files_list), len(media_url_list))
+                    _remember_media_group_file_ids(kept_media_keys, sent_messages_files)
                     return sent_messages_files
                 else:
-                    logger.error(f"Fallback: Не удалось отправить медиагруппу файлами (ошибка залогирована в _safe_send_tg_message).")
+                    logger.error(f"Fallback: Не удалось отправить фото файлами (ошибка залогирована в _safe_send_tg_message).")
                     return None
             except Exception as e_files:
                  logger.exception(f"Fallback: Исключение при отправке медиагруппы файлами: {e_files}")
                  return None
             finally:
-                 logger.debug("Fallback: Закрытие файловых потоков...")
+                 logger.debug("Fallback: Закрытие буферов фото...")
                  for f in opened_files:
-                     if not f.closed:
-                         try:
-                              f.close()
-                              logger.debug(f"Закрыт поток для: {getattr(f, 'name', 'N/A')}")
-                         except Exception as close_err:
-                              logger.error(f"Ошибка закрытия потока для {getattr(f, 'name', 'N/A')}: {close_err}")
+                     try: f.close()
+                     except Exception as close_err: logger.error(f"Ошибка закрытия буфера фото: {close_err}")
         else:
             logger.error(f"Не удалось отправить медиагруппу по URL (ошибка ApiTelegramException, но не WEBPAGE_MEDIA_EMPTY, код {e_url.error_code}).")
             return None
@@ -771,11 +1998,16 @@ def safe_send_media_group(chat_id, media_url_list, **kwargs):
         return None
 
 # --- Основная функция отправки поста ---
-def send_post_to_telegram(post, target_chat_id):
+def prepare_post(post, group_info=None):
+    """
+    Первая стадия отправки поста: название группы, текст с развернутыми ссылками, разбор вложений
+    и запуск фоновой загрузки видео. Ничего не отправляет в Telegram, поэтому может выполняться
+    заранее и параллельно для нескольких постов. Возвращает подготовленный пост или None при ошибке.
+    """
     post_id = post.get('id', 'N/A'); owner_id = post.get('owner_id', 'N/A')
     post_link = f"https://vk.com/wall{owner_id}_{post_id}"
-    logger.info(f"Обработка поста {post_link} -> {target_chat_id}")
-    logger.debug(f"Полные данные поста (начало): {str(post)[:500]}...")
+    logger.info("Подготовка поста %s", post_link)
+    if logger.isEnabledFor(logging.DEBUG): logger.debug("Полные данные поста (начало): %s...", str(post)[:500])
 
     photo_urls = [] 
 
@@ -783,38 +2015,51 @@ def send_post_to_telegram(post, target_chat_id):
         group_name = "Группа VK"
         try:
             if isinstance(owner_id, int) and owner_id < 0:
-                 if group_info_list := vk.groups.getById(group_id=abs(owner_id), fields='name'):
-                     group_name = group_info_list[0].get('name', group_name)
-                     logger.debug(f"Название группы получено: {group_name}")
+                 if group_info is None: group_info = group_info_cache.get(owner_id)
+                 if group_info is None:
+                     logger.debug("Группы %s нет в кэше, запрос groups.getById.", owner_id)
+                     if group_info_list := vk.groups.getById(group_id=abs(owner_id), fields='name,screen_name,photo_200'):
+                         group_info_cache.put(group_info_list[0])
+                         group_info = group_info_cache.get(owner_id)
+                 if group_info and group_info.get('name'):
+                     group_name = group_info['name']
+                     logger.debug("Название группы получено: %s", group_name)
         except Exception as e: logger.warning(f"Не удалось получить инфо о группе {owner_id}: {e}")
 
-        escaped_group_name = group_name.replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]').replace('_', '\\_').replace('*', '\\*').replace('`', '\\`')
-        escaped_post_link = post_link.replace('(', r'\(').replace(')', r'\)')
+        escaped_group_name = group_name.translate(MD_TEXT_ESCAPE)
+        escaped_post_link = post_link.translate(MD_URL_ESCAPE)
         first_text_md = f'[{escaped_group_name}]({escaped_post_link})\n'
         first_text_plain = f'{group_name}: {post_link}\n'
         
         original_text = post.get('text', '')
-        prepared_text_plain = original_text 
-        prepared_text_md = prepare_text(original_text)
-
-
         attachments = post.get('attachments', [])
-        logger.debug(f"Найдено вложений: {len(attachments)} для поста {post_link}")
+        # Все vk.cc ссылки поста (из текста и вложений-ссылок) разворачиваются одновременно
+        short_urls = find_vk_cc_urls(original_text) + [
+            att['link']['url'] for att in attachments
+            if att.get('type') == 'link' and isinstance(att.get('link'), dict) and 'vk.cc/' in (att['link'].get('url') or '')
+        ]
+        expanded_urls = expand_short_urls(short_urls)
+        try: prepared_text_md, prepared_text_plain = render_post_text(original_text, expanded_urls)
+        except Exception as e:
+            logger.error(f"Ошибка подготовки текста поста {post_link}: {e}", exc_info=True)
+            prepared_text_md = prepared_text_plain = original_text.strip()
+
+        logger.debug("Найдено вложений: %s для поста %s", len(attachments), post_link)
         video_info = []
         docs = []
-        downloaded_video_files = []
+        video_downloads = {} # vk_link -> задача предзагрузки, в порядке вложений
 
         for i, att in enumerate(attachments):
             att_type = att.get('type')
-            logger.debug(f"Обработка вложения #{i+1} типа '{att_type}' поста {post_link}")
+            logger.debug("Обработка вложения #%s типа '%s' поста %s", i+1, att_type, post_link)
             try:
                 if att_type == 'photo':
                     if photo := att.get('photo'):
                         photo_id = photo.get('id', 'N/A')
-                        logger.debug(f"Обработка фото ID: {photo_id}")
+                        logger.debug("Обработка фото ID: %s", photo_id)
                         size_priority = ['w', 'z', 'y', 'x', 'r', 'q', 'p', 'o', 'm', 's']
                         available = photo.get('sizes', [])
-                        logger.debug(f"Доступные размеры фото {photo_id}: {[s.get('type') for s in available]}")
+                        if logger.isEnabledFor(logging.DEBUG): logger.debug("Доступные размеры фото %s: %s", photo_id, [s.get('type') for s in available])
 
                         best_url = next((s['url'] for size in size_priority for s in available if s.get('type') == size and s.get('url') and s.get('width',0)<=2560 and s.get('height',0)<=2560 and (s.get('width',0)+s.get('height',0))<=10000), None)
                         if not best_url:
@@ -822,7 +2067,7 @@ def send_post_to_telegram(post, target_chat_id):
                             if valid: best_url = max(valid, key=lambda s: s.get('width', 0) * s.get('height', 0)).get('url')
 
                         if best_url:
-                            logger.debug(f"Выбран URL для фото {photo_id}: {best_url}")
+                            logger.debug("Выбран URL для фото %s: %s", photo_id, best_url)
                             photo_urls.append(best_url)
                         else: logger.warning(f"Нет подходящего фото URL в посте {post_link}, вложение: {photo_id}")
                 elif att_type == 'video':
@@ -830,61 +2075,87 @@ def send_post_to_telegram(post, target_chat_id):
                         vid = video.get('id'); oid = video.get('owner_id'); key = video.get('access_key')
                         title = video.get('title', f'Видео {oid}_{vid}')
                         vk_link = f"https://vk.com/video{oid}_{vid}" + (f"?access_key={key}" if key else "")
-                        logger.debug(f"Обработка видео: {vk_link}, Title: {title}")
+                        logger.debug("Обработка видео: %s, Title: %s", vk_link, title)
                         preview = next((s['url'] for s in video.get('image', []) if s.get('url') and s.get('with_padding')), None) \
                                or next((s['url'] for s in sorted(video.get('image', []), key=lambda x: x.get('width', 0), reverse=True) if s.get('url')), None) \
                                or next((video[k] for k in ['photo_1280', 'photo_800', 'photo_640', 'photo_320', 'photo_130'] if k in video and isinstance(video[k], str)), None)
-                        logger.debug(f"Превью для видео {vk_link}: {preview}")
-                        escaped_title = title.replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]').replace('_', '\\_').replace('*', '\\*').replace('`', '\\`')
-                        escaped_url = vk_link.replace('(', r'\(').replace(')', r'\)')
+                        logger.debug("Превью для видео %s: %s", vk_link, preview)
+                        escaped_title = title.translate(MD_TEXT_ESCAPE)
+                        escaped_url = vk_link.translate(MD_URL_ESCAPE)
                         video_info.append({'vk_link': vk_link, 'title': escaped_title, 'url': escaped_url, 'preview': preview, 'plain_title': title, 'plain_url': vk_link, 'message_id': None})
-                        downloaded_path, video_metadata = download_vk_video(vk_link, DOWNLOAD_DIR)
-                        if downloaded_path:
-                            downloaded_video_files.append({'path': downloaded_path, 'vk_link': vk_link, 'title': title, 'escaped_title': escaped_title, 'metadata': video_metadata})
-                        else: logger.info(f"Видео {vk_link} не будет отправлено файлом.")
+                        # Скачивание идет в фоне; результат забирается перед отправкой видеофайлов.
+                        # Видео, уже загруженное в Telegram, не скачивается - оно отправится по file_id
+                        if vk_link not in video_downloads:
+                            media_key = video_media_key(oid, vid)
+                            video_downloads[vk_link] = {'future': None, 'media_key': media_key, 'vk_link': vk_link, 'title': title, 'escaped_title': escaped_title}
+                            if telegram_file_cache.contains(media_key):
+                                logger.debug("Видео %s есть в кэше file_id, скачивание не требуется.", vk_link)
+                            else:
+                                video_downloads[vk_link]['future'] = attachment_prefetch_pool.submit(prefetch_vk_video, vk_link)
+                                logger.debug("Скачивание видео %s поставлено в очередь предзагрузки.", vk_link)
                 elif att_type == 'doc':
                      if doc := att.get('doc'):
-                         title = doc.get('title', 'Документ').replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]').replace('_', '\\_').replace('*', '\\*').replace('`', '\\`')
-                         url = doc.get('url', '').replace('(', r'\(').replace(')', r'\)')
-                         logger.debug(f"Найден документ: Title: {title}, URL: {url}")
-                         if url: docs.append({'title': title, 'url': url})
+                         title = doc.get('title', 'Документ')
+                         url = doc.get('url', '')
+                         logger.debug("Найден документ: Title: %s, URL: %s", title, url)
+                         if url: docs.append({'title': title.translate(MD_TEXT_ESCAPE), 'url': url.translate(MD_URL_ESCAPE), 'plain_title': title, 'plain_url': url})
                 elif att_type == 'link':
                      if link_data := att.get('link'): 
                          title = link_data.get('title', link_data.get('caption', 'Ссылка'))
                          url = link_data.get('url')
-                         logger.debug(f"Найдена ссылка (из вложения): Title: {title}, URL: {url}")
+                         logger.debug("Найдена ссылка (из вложения): Title: %s, URL: %s", title, url)
 
                          if url:
                              plain_text_url = url
                              if 'vk.cc/' in url:
-                                 logger.debug(f"Обнаружена vk.cc ссылка во вложении: {url}. Попытка развернуть...")
-                                 full_url = get_unshortened_url(url) 
+                                 logger.debug("Обнаружена vk.cc ссылка во вложении: %s. Попытка развернуть...", url)
+                                 full_url = expanded_urls.get(url) or get_unshortened_url(url)
                                  if full_url and full_url != url:
                                      url = full_url 
                                      plain_text_url = full_url 
-                                     logger.info(f"Замена vk.cc (вложение): {link_data.get('url')} -> {full_url}")
-                             escaped_title_link = title.replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]').replace('_', '\\_').replace('*', '\\*').replace('`', '\\`')
-                             escaped_url_link = url.replace('(', r'\(').replace(')', r'\)') 
+                                     logger.info("Замена vk.cc (вложение): %s -> %s", link_data.get('url'), full_url)
+                             escaped_title_link = title.translate(MD_TEXT_ESCAPE)
+                             escaped_url_link = url.translate(MD_URL_ESCAPE)
                              link_md_text_to_append = f"\n\n🔗 [{escaped_title_link}]({escaped_url_link})"
                              link_plain_text_to_append = f"\n\n🔗 {title}: {plain_text_url}"
                              prepared_text_md += link_md_text_to_append
                              prepared_text_plain += link_plain_text_to_append
-                             logger.debug(f"Ссылка из вложения добавлена в текст поста: {link_plain_text_to_append[:100]}...")
+                             logger.debug("Ссылка из вложения добавлена в текст поста: %s...", link_plain_text_to_append[:100])
                 else:
-                     logger.debug(f"Пропуск неподдерживаемого типа вложения: {att_type}")
+                     logger.debug("Пропуск неподдерживаемого типа вложения: %s", att_type)
             except Exception as e: logger.exception(f"Ошибка обработки вложения {att_type} поста {post_link}: {e}")
 
+        return {
+            'post_link': post_link, 'first_text_md': first_text_md, 'first_text_plain': first_text_plain,
+            'prepared_text_md': prepared_text_md, 'prepared_text_plain': prepared_text_plain,
+            'photo_urls': photo_urls, 'video_info': video_info, 'docs': docs, 'video_downloads': video_downloads,
+        }
+    except Exception as e:
+        logger.exception(f"Критическая ошибка при подготовке поста {post_link}: {e}")
+        return None
+
+def deliver_prepared_post(prepared, target_chat_id):
+    """Вторая стадия: отправка подготовленного поста в чат. Возвращает True, если удалось отправить хоть что-то."""
+    if prepared is None: return False
+    post_link = prepared['post_link']
+    first_text_md, first_text_plain = prepared['first_text_md'], prepared['first_text_plain']
+    prepared_text_md, prepared_text_plain = prepared['prepared_text_md'], prepared['prepared_text_plain']
+    photo_urls, video_info, docs, video_downloads = prepared['photo_urls'], prepared['video_info'], prepared['docs'], prepared['video_downloads']
+    logger.info("Отправка поста %s -> %s", post_link, target_chat_id)
+
+    try:
         sent_something = False
         last_sent_message_id = None
         text_sent_separately = False
+        downloaded_video_files = []
         has_media = bool(photo_urls or video_info) 
         full_caption_md = f"{first_text_md}{prepared_text_md}".strip()
         full_caption_plain = f"{first_text_plain}{prepared_text_plain}".strip()
         can_use_full_caption = has_media and len(full_caption_md) <= CAPTION_LIMIT
-        logger.debug(f"Пост {post_link}: has_media={has_media} (URL фото: {len(photo_urls)}, видео: {len(video_info)}), len(full_caption_md)={len(full_caption_md)}, CAPTION_LIMIT={CAPTION_LIMIT}, can_use_full_caption={can_use_full_caption}")
+        logger.debug("Пост %s: has_media=%s (URL фото: %s, видео: %s), len(full_caption_md)=%s, CAPTION_LIMIT=%s, can_use_full_caption=%s", post_link, has_media, len(photo_urls), len(video_info), len(full_caption_md), CAPTION_LIMIT, can_use_full_caption)
 
         if not can_use_full_caption and (prepared_text_md or not has_media): 
-            logger.info(f"Текст поста {post_link} (возможно, с ссылками из вложений) будет отправлен отдельно.")
+            logger.info("Текст поста %s (возможно, с ссылками из вложений) будет отправлен отдельно.", post_link)
             text_to_send_md = full_caption_md if prepared_text_md else first_text_md.strip() 
             text_to_send_plain = full_caption_plain if prepared_text_plain else first_text_plain.strip()
             if text_to_send_md: 
@@ -893,7 +2164,7 @@ def send_post_to_telegram(post, target_chat_id):
                     sent_something = True
                     text_sent_separately = True 
                     last_sent_message_id = sent_text_msg.message_id
-                    logger.debug(f"Текст поста {post_link} отправлен отдельно, message_id: {last_sent_message_id}")
+                    logger.debug("Текст поста %s отправлен отдельно, message_id: %s", post_link, last_sent_message_id)
                 else:
                     logger.error(f"Не удалось отправить текст поста {post_link}.")
             elif not has_media and not prepared_text_md : 
@@ -906,16 +2177,16 @@ def send_post_to_telegram(post, target_chat_id):
             if can_use_full_caption: 
                 first_photo_caption_md = full_caption_md
                 first_photo_caption_plain = full_caption_plain
-                logger.debug(f"Текст поста {post_link} (с ссылками) будет в подписи к первому фото.")
+                logger.debug("Текст поста %s (с ссылками) будет в подписи к первому фото.", post_link)
             elif not text_sent_separately: 
                 first_photo_caption_md = first_text_md.strip()
                 first_photo_caption_plain = first_text_plain.strip()
-                logger.debug(f"Только ссылка на пост VK {post_link} будет в подписи к первому фото (основной текст отправлен или будет отправлен позже, или не поместился).")
+                logger.debug("Только ссылка на пост VK %s будет в подписи к первому фото (основной текст отправлен или будет отправлен позже, или не поместился).", post_link)
 
             for i, url in enumerate(photo_urls):
                 current_caption_md = first_photo_caption_md if i == 0 else None
                 try:
-                    logger.debug(f"Создание InputMediaPhoto из URL: {url}, caption='{str(current_caption_md)[:50]}...'")
+                    if logger.isEnabledFor(logging.DEBUG): logger.debug("Создание InputMediaPhoto из URL: %s, caption='%s...'", url, str(current_caption_md)[:50])
                     media_urls.append(types.InputMediaPhoto(media=url, caption=current_caption_md, parse_mode='Markdown'))
                 except Exception as e_mp:
                      logger.error(f"Не удалось создать InputMediaPhoto из URL ({url}) поста {post_link}: {e_mp}")
@@ -926,7 +2197,7 @@ def send_post_to_telegram(post, target_chat_id):
                 if sent_media_msgs:
                     sent_something = True
                     if not text_sent_separately and not first_photo_caption_md and prepared_text_md:
-                        logger.info(f"Отправка текста поста {post_link} после медиагруппы (не поместился в подпись).")
+                        logger.info("Отправка текста поста %s после медиагруппы (не поместился в подпись).", post_link)
                         text_after_media_md = prepared_text_md.strip() 
                         text_after_media_plain = prepared_text_plain.strip()
                         if text_after_media_md: 
@@ -941,7 +2212,7 @@ def send_post_to_telegram(post, target_chat_id):
                  logger.warning(f"Медиагруппа для поста {post_link} пуста (ошибки создания InputMediaPhoto из URL).")
 
         if video_info:
-            logger.info(f"Отправка {len(video_info)} превью/ссылок на видео поста {post_link}...")
+            logger.info("Отправка %s превью/ссылок на видео поста %s...", len(video_info), post_link)
             for i, v in enumerate(video_info):
                 sent_preview_msg = None
                 current_caption_md = None
@@ -950,18 +2221,18 @@ def send_post_to_telegram(post, target_chat_id):
                 if can_use_full_caption and is_first_media_overall:
                     current_caption_md = full_caption_md
                     current_caption_plain = full_caption_plain
-                    logger.debug(f"Текст поста {post_link} (с ссылками) будет в подписи к первому видео превью.")
+                    logger.debug("Текст поста %s (с ссылками) будет в подписи к первому видео превью.", post_link)
                 elif not text_sent_separately and is_first_media_overall: 
                      current_caption_md = first_text_md.strip()
                      current_caption_plain = first_text_plain.strip()
-                     logger.debug(f"Только ссылка на пост VK {post_link} будет в подписи к первому видео превью.")
+                     logger.debug("Только ссылка на пост VK %s будет в подписи к первому видео превью.", post_link)
                 else: 
                     current_caption_md = f"*Видео:* [{v['title']}]({v['url']})"
                     current_caption_plain = f"Видео: {v['plain_title']}: {v['plain_url']}"
-                    logger.debug(f"Стандартная подпись для видео превью #{i+1} поста {post_link}.")
+                    logger.debug("Стандартная подпись для видео превью #%s поста %s.", i+1, post_link)
 
                 if v['preview']:
-                    logger.debug(f"Отправка превью видео {v['plain_url']} через safe_send_photo.")
+                    logger.debug("Отправка превью видео %s через safe_send_photo.", v['plain_url'])
                     sent_preview_msg = safe_send_photo(target_chat_id, v['preview'], current_caption_md, current_caption_plain)
                     if not sent_preview_msg:
                         logger.error(f"Не удалось отправить превью видео {v['plain_url']}. Попытка отправить текстом.")
@@ -975,20 +2246,34 @@ def send_post_to_telegram(post, target_chat_id):
                     video_info[i]['message_id'] = sent_preview_msg.message_id
                     last_sent_message_id = sent_preview_msg.message_id
                     if not text_sent_separately and not (can_use_full_caption and is_first_media_overall) and is_first_media_overall and prepared_text_md: 
-                        logger.info(f"Отправка текста поста {post_link} после первого видео (не поместился в подпись или не был основной подписью).")
+                        logger.info("Отправка текста поста %s после первого видео (не поместился в подпись или не был основной подписью).", post_link)
                         text_after_video_md = prepared_text_md.strip()
                         text_after_video_plain = prepared_text_plain.strip()
                         if text_after_video_md:
                              sent_text_msg_after = safe_send_message(target_chat_id, text_after_video_md, text_after_video_plain, disable_web_page_preview=False)
                              if sent_text_msg_after: last_sent_message_id = sent_text_msg_after.message_id 
                              else: logger.error(f"Не удалось отправить текст поста {post_link} после первого видео.")
-                    logger.info(f"Информация о видео {v['plain_url']} отправлена, message_id: {last_sent_message_id}")
+                    logger.info("Информация о видео %s отправлена, message_id: %s", v['plain_url'], last_sent_message_id)
                 else:
                     logger.error(f"Не удалось отправить информацию о видео {v['plain_url']}")
-                time.sleep(0.5)
+
+        if video_downloads:
+            logger.info("Ожидание предзагрузки %s видео поста %s...", len(video_downloads), post_link)
+        for vid_file_info in video_downloads.values():
+            if vid_file_info['future'] is None:
+                downloaded_video_files.append({**vid_file_info, 'path': None, 'metadata': {}})
+                continue
+            try:
+                downloaded_path, video_metadata = vid_file_info['future'].result()
+            except Exception as e:
+                logger.exception(f"Ошибка предзагрузки видео {vid_file_info['vk_link']}: {e}")
+                downloaded_path, video_metadata = None, {}
+            if downloaded_path:
+                downloaded_video_files.append({**vid_file_info, 'path': downloaded_path, 'metadata': video_metadata})
+            else: logger.info("Видео %s не будет отправлено файлом.", vid_file_info['vk_link'])
 
         if downloaded_video_files:
-            logger.info(f"Отправка {len(downloaded_video_files)} скачанных видеофайлов поста {post_link}...")
+            logger.info("Отправка %s скачанных видеофайлов поста %s...", len(downloaded_video_files), post_link)
             for vid_file_info in downloaded_video_files:
                 path = vid_file_info['path']
                 title = vid_file_info['title']
@@ -999,39 +2284,46 @@ def send_post_to_telegram(post, target_chat_id):
                     if v_preview['vk_link'] == vk_link:
                         reply_to_msg_id = v_preview.get('message_id')
                         break
-                logger.debug(f"Поиск reply_to_message_id для файла {path} (ссылка {vk_link}): найдено {reply_to_msg_id}")
+                logger.debug("Поиск reply_to_message_id для файла %s (ссылка %s): найдено %s", path, vk_link, reply_to_msg_id)
                 caption_md = f"{escaped_title}"
                 caption_plain = f"{title}"
-                logger.info(f"Отправка видеофайла: {path}" + (f" (в ответ на {reply_to_msg_id})" if reply_to_msg_id else ""))
+                logger.info(f"Отправка видеофайла: {path or vk_link}" + (f" (в ответ на {reply_to_msg_id})" if reply_to_msg_id else ""))
                 send_args = {'timeout': 180}
                 if reply_to_msg_id:
                     send_args['reply_to_message_id'] = reply_to_msg_id
                 else:
-                    logger.warning(f"Не найден message_id для ответа при отправке файла {path}. Отправка без ответа.")
+                    logger.warning(f"Не найден message_id для ответа при отправке файла {path or vk_link}. Отправка без ответа.")
+                if path is None:
+                    logger.info("Отправка видео %s по file_id из кэша.", vk_link)
+                    if sent_video_msg := safe_send_video(target_chat_id, None, caption_md, caption_plain, media_key=vid_file_info['media_key'], **send_args):
+                        sent_something = True
+                        last_sent_message_id = sent_video_msg.message_id
+                        logger.info("Видео %s отправлено по file_id, message_id: %s", vk_link, last_sent_message_id)
+                        continue
+                    logger.warning(f"Не удалось отправить видео {vk_link} по file_id. Скачивание файла...")
+                    path, vid_file_info['metadata'] = prefetch_vk_video(vk_link)
+                    if not path:
+                        logger.info("Видео %s не будет отправлено файлом.", vk_link)
+                        continue
                 try:
                     with open(path, 'rb') as vf:
-                        sent_video_msg = safe_send_video(target_chat_id, vf, caption_md, caption_plain, video_metadata=vid_file_info['metadata'], **send_args)
+                        sent_video_msg = safe_send_video(target_chat_id, vf, caption_md, caption_plain, video_metadata=vid_file_info['metadata'], media_key=vid_file_info['media_key'], **send_args)
                         if sent_video_msg:
                             sent_something = True
                             last_sent_message_id = sent_video_msg.message_id
-                            logger.info(f"Видеофайл {path} отправлен, message_id: {last_sent_message_id}")
+                            logger.info("Видеофайл %s отправлен, message_id: %s", path, last_sent_message_id)
                         else:
                             logger.error(f"Не удалось отправить видеофайл {path} (ошибка залогирована выше).")
                 except FileNotFoundError:
                     logger.error(f"Видеофайл не найден: {path}.")
                 except Exception as e:
                     logger.exception(f"Критическая ошибка при отправке видеофайла {path}: {e}")
-                time.sleep(1)
 
         if docs:
             sup_md, sup_plain = "", ""
             if docs:
                 doc_md_list = [f"- [{d['title']}]({d['url']})" for d in docs]
-                doc_plain_list = []
-                for d in docs:
-                    processed_title = d['title'].replace('\\\\','\\').replace('\\[','[').replace('\\]',']').replace('\\_','_').replace('\\*','*').replace('\\`','`')
-                    processed_url = d['url'].replace('\\(','(').replace('\\)',')')
-                    doc_plain_list.append(f"- {processed_title}: {processed_url}")
+                doc_plain_list = [f"- {d['plain_title']}: {d['plain_url']}" for d in docs]
                 sup_md += "\n\n*Документы:*\n" + "\n".join(doc_md_list)
                 sup_plain += "\n\nДокументы:\n" + "\n".join(doc_plain_list)
             
@@ -1039,16 +2331,16 @@ def send_post_to_telegram(post, target_chat_id):
                  final_sup_md = sup_md.strip()
                  final_sup_plain = sup_plain.strip()
                  if not sent_something: 
-                     logger.info(f"Отправка доп. информации (документы) С ССЫЛКОЙ НА ПОСТ {post_link}...")
+                     logger.info("Отправка доп. информации (документы) С ССЫЛКОЙ НА ПОСТ %s...", post_link)
                      final_sup_md = f"{first_text_md.strip()}\n{final_sup_md}"
                      final_sup_plain = f"{first_text_plain.strip()}\n{final_sup_plain}"
                  else: 
-                      logger.info(f"Отправка доп. информации (документы) поста {post_link}...")
+                      logger.info("Отправка доп. информации (документы) поста %s...", post_link)
                  sent_sup_msg = safe_send_message(target_chat_id, final_sup_md, final_sup_plain, disable_web_page_preview=True) 
                  if sent_sup_msg:
                      sent_something = True
                      last_sent_message_id = sent_sup_msg.message_id
-                     logger.info(f"Доп. информация (документы) поста {post_link} отправлена, message_id: {last_sent_message_id}")
+                     logger.info("Доп. информация (документы) поста %s отправлена, message_id: %s", post_link, last_sent_message_id)
                  else:
                      logger.error(f"Не удалось отправить доп. инфо (документы) поста {post_link}.")
 
@@ -1061,14 +2353,14 @@ def send_post_to_telegram(post, target_chat_id):
                  if sent_link_msg:
                      sent_something = True
                      last_sent_message_id = sent_link_msg.message_id
-                     logger.info(f"Fallback-сообщение для поста {post_link} отправлено, message_id: {last_sent_message_id}")
+                     logger.info("Fallback-сообщение для поста %s отправлено, message_id: %s", post_link, last_sent_message_id)
                  else:
                      logger.error(f"Не удалось отправить даже fallback-сообщение для поста {post_link}.")
              else:
                  logger.error(f"Fallback-сообщение для поста {post_link} пустое, отправка отменена.")
 
         if sent_something:
-            logger.info(f"Обработка поста {post_link} успешно завершена.");
+            logger.info("Обработка поста %s успешно завершена.", post_link);
             return True
         else:
             logger.error(f"Не удалось отправить никакую информацию для поста {post_link} (ошибки см. выше).");
@@ -1080,85 +2372,241 @@ def send_post_to_telegram(post, target_chat_id):
     finally:
         pass
 
-def check_and_send_vk_posts(group_id, group_key, target_chat_id):
-    logger.info(f"Проверка группы {group_key} (ID: {group_id}) -> {target_chat_id}...")
-    group_owner_id = int(f"-{group_id}")
-    processed_posts = load_posts_state(group_key)
-    max_history = getattr(config, 'MAX_POST_HISTORY', 1000)
-    if len(processed_posts) > max_history:
-         try:
-             valid_ids = [int(k) for k, v in processed_posts.items() if k.lstrip('-').isdigit()]
-             processed_posts = {k: v for k, v in processed_posts.items() if k.lstrip('-').isdigit()}
-             sorted_ids = sorted(valid_ids, reverse=True)
-             processed_posts = {str(pid): processed_posts[str(pid)] for pid in sorted_ids[:max_history]}
-             logger.debug(f"История {group_key} сокращена до {len(processed_posts)}.")
-         except Exception as e_sort: logger.warning(f"Не удалось сократить историю {group_key}: {e_sort}")
+def send_post_to_telegram(post, target_chat_id, group_info=None):
+    return deliver_prepared_post(prepare_post(post, group_info), target_chat_id)
+
+# Посты группы готовятся заранее (до POST_PIPELINE_DEPTH впереди текущего), а отправляются строго по порядку ID
+POST_PIPELINE_DEPTH = getattr(config, 'POST_PIPELINE_DEPTH', 3)
+post_prepare_pool = ThreadPoolExecutor(max_workers=POST_PIPELINE_DEPTH, thread_name_prefix="PostPrepare")
 
+# --- Пакетный опрос стен групп через VK execute ---
+VK_EXECUTE_BATCH_SIZE = 25 # Максимум вызовов API внутри одного execute
+
+def fetch_vk_walls_batch(group_counts):
+    """
+    Запрашивает стены нескольких групп, упаковывая до 25 вызовов wall.get в один запрос execute.
+    Принимает словарь {group_id: количество постов}.
+    Возвращает словарь {group_id: ответ wall.get или исключение}, исключение затем пробрасывается
+    в check_and_send_vk_posts и обрабатывается там так же, как при одиночном запросе.
+    """
+    results = {}
+    group_ids = list(group_counts)
+    if (remaining := vk_session.backoff_remaining('wall.get')) > 0:
+        logger.warning(f"wall.get на паузе после превышения лимита VK API ({remaining:.0f} сек.), пакетный запрос пропущен.")
+        return {group_id: VkRateLimitBackoff('wall.get', remaining) for group_id in group_ids}
+    for batch_start in range(0, len(group_ids), VK_EXECUTE_BATCH_SIZE):
+        batch_ids = group_ids[batch_start:batch_start + VK_EXECUTE_BATCH_SIZE]
+        logger.debug("Пакетный запрос wall.get для %s групп: %s", len(batch_ids), batch_ids)
+        pool_results = {}
+        try:
+            with vk_api.VkRequestsPool(vk_session) as pool:
+                for group_id in batch_ids:
+                    pool_results[group_id] = pool.method('wall.get', {
+                        'owner_id': -int(group_id), 'count': group_counts[group_id], 'extended': 1, 'filter': 'owner'
+                    })
+        except Exception as e:
+            logger.error(f"Ошибка пакетного запроса execute для групп {batch_ids}: {e}")
+            for group_id in batch_ids: results[group_id] = e
+            continue
+
+        for group_id, request_result in pool_results.items():
+            if request_result.ok:
+                results[group_id] = request_result.result
+            elif request_result.error:
+                results[group_id] = vk_api.ApiError(vk_session, 'wall.get', {'owner_id': -int(group_id)}, False, request_result.error)
+                if results[group_id].code in RateLimitedVkApi.BACKOFF_BASE_SECONDS and vk_session.backoff_remaining('wall.get') <= 0:
+                    vk_session.register_rate_limit_error('wall.get', results[group_id].code)
+            else:
+                results[group_id] = vk_api.VkApiError(f"Нет ответа execute для группы {group_id}")
+    return results
+
+def fetch_wall_until_cursor(group_owner_id, first_response, cursor):
+    """
+    Догружает страницы стены через offset, пока не будет достигнута отметка последнего просмотренного поста.
+    Тихие группы обходятся одним коротким запросом, а после всплеска публикаций посты догружаются без пропусков.
+    """
+    if not cursor or 'items' not in first_response: return first_response
+    cursor_post_id = cursor.get('post_id', 0)
+    page_size = min(getattr(config, 'VK_POSTS_COUNT', 20), 100)
+    max_pages = getattr(config, 'VK_MAX_CATCHUP_PAGES', 5)
+
+    items = list(first_response['items'])
+    groups = list(first_response.get('groups', []))
+    profiles = list(first_response.get('profiles', []))
+    seen_ids = {p.get('id') for p in items}
+    total_count = first_response.get('count', len(items))
+    reached = lambda page: not page or any(p.get('id', 0) <= cursor_post_id for p in page if not p.get('is_pinned'))
+
+    last_page = items
+    pages_fetched = 0
+    while not reached(last_page) and len(items) < total_count and pages_fetched < max_pages:
+        logger.debug("Отметка %s для owner_id=%s не достигнута, запрос offset=%s, count=%s", cursor_post_id, group_owner_id, len(items), page_size)
+        page_response = vk.wall.get(owner_id=group_owner_id, offset=len(items), count=page_size, extended=1, filter='owner')
+        pages_fetched += 1
+        last_page = [p for p in page_response.get('items', []) if p.get('id') not in seen_ids]
+        items.extend(last_page); seen_ids.update(p.get('id') for p in last_page)
+        groups.extend(page_response.get('groups', [])); profiles.extend(page_response.get('profiles', []))
+        total_count = page_response.get('count', total_count)
+
+    if not reached(last_page):
+        logger.warning(f"Отметка {cursor_post_id} для owner_id={group_owner_id} не достигнута за {pages_fetched} доп. страниц (VK_MAX_CATCHUP_PAGES={max_pages}). Часть старых постов может быть пропущена.")
+    elif pages_fetched:
+        logger.info("Для owner_id=%s догружено %s доп. страниц до отметки %s.", group_owner_id, pages_fetched, cursor_post_id)
+    return {**first_response, 'count': total_count, 'items': items, 'groups': groups, 'profiles': profiles}
+
+def check_and_send_vk_posts(group_id, group_key, target_chat_id, prefetched_response=None):
+    logger.info("Проверка группы %s (ID: %s) -> %s...", group_key, group_id, target_chat_id)
+    group_owner_id = int(f"-{group_id}")
     new_posts_found = 0
+    cursor = post_state_store.get_cursor(group_key)
+    cursor_post_id = cursor.get('post_id', 0) if cursor else 0
+    new_cursor = None # (ID, дата) последнего поста, до которого стена просмотрена
     try:
-        posts_to_fetch = getattr(config, 'VK_POSTS_COUNT', 20)
-        logger.debug(f"Запрос {posts_to_fetch} постов для owner_id={group_owner_id}")
-        response = vk.wall.get(owner_id=group_owner_id, count=posts_to_fetch, extended=1, filter='owner')
-        logger.debug(f"Ответ VK API для {group_key} получен (items: {'items' in response})")
+        if isinstance(prefetched_response, Exception):
+            raise prefetched_response
+        elif prefetched_response is not None:
+            response = prefetched_response
+            logger.debug("Используется ответ пакетного запроса для %s", group_key)
+        else:
+            posts_to_fetch = get_wall_fetch_count(group_key)
+            logger.debug("Запрос %s постов для owner_id=%s", posts_to_fetch, group_owner_id)
+            response = vk.wall.get(owner_id=group_owner_id, count=posts_to_fetch, extended=1, filter='owner')
+        logger.debug("Ответ VK API для %s получен (items: %s)", group_key, 'items' in response)
 
         if 'items' not in response:
             error_detail = response.get('error', {}).get('error_msg', str(response))
             logger.error(f"VK API для группы {group_id} без 'items'. Детали: {error_detail}"); return
 
-        posts = [p for p in response['items'] if not p.get('marked_as_ads') and p.get('post_type') == 'post']
-        logger.debug(f"Получено {len(response['items'])}, после фильтрации {len(posts)} постов для {group_key}.")
+        response = fetch_wall_until_cursor(group_owner_id, response, cursor)
+        group_info_cache.update_from_response(response)
+        posts = [p for p in response['items'] if not p.get('marked_as_ads') and p.get('post_type') == 'post' and p.get('id', 0) > cursor_post_id]
+        posts.sort(key=lambda p: p.get('id', 0))
+        logger.debug("Получено %s, после фильтрации и отметки %s осталось %s постов для %s.", len(response['items']), cursor_post_id, len(posts), group_key)
 
-        for post in reversed(posts):
+        current_filter_matcher = filter_matcher # Один и тот же автомат на всю проверку группы
+        # Решение по каждому посту принимается сразу, а состояние записывается по порядку, по мере завершения обработки
+        planned_posts = []
+        for post in posts:
             post_id = str(post.get('id'))
             post_link = f"https://vk.com/wall{group_owner_id}_{post_id}"
-            logger.debug(f"Проверка поста {post_link} ({group_key})...")
-
+            logger.debug("Проверка поста %s (%s)...", post_link, group_key)
             if post.get('owner_id') != group_owner_id:
-                 logger.debug(f"Пост {post_link} пропущен (не со стены группы, owner_id: {post.get('owner_id')}).")
-                 continue
+                 logger.debug("Пост %s пропущен (не со стены группы, owner_id: %s).", post_link, post.get('owner_id'))
+                 planned_posts.append((post, None)); continue
+            if processed_status := post_state_store.get_status(group_key, post_id):
+                 logger.debug("Пост %s уже обработан (%s). Пропуск.", post_link, processed_status)
+                 planned_posts.append((post, None)); continue
+            if matched_filter := current_filter_matcher.search(post.get('text', '')):
+                logger.info("Пост %s (%s) отфильтрован по слову '%s'.", post_link, group_key, matched_filter)
+                planned_posts.append((post, 'filtered')); continue
+            if post.get('copy_history'):
+                 logger.info("Пост %s (%s) - репост, пропуск.", post_link, group_key)
+                 planned_posts.append((post, 'repost_skipped')); continue
+            planned_posts.append((post, 'send'))
 
-            if post_id in processed_posts:
-                 logger.debug(f"Пост {post_link} уже обработан ({processed_posts[post_id]}). Пропуск.")
-                 continue
+        posts_to_prepare = iter([post for post, action in planned_posts if action == 'send'])
+        prepared_futures = {}
+        def prepare_ahead():
+            while len(prepared_futures) < POST_PIPELINE_DEPTH and (next_post := next(posts_to_prepare, None)):
+                prepared_futures[next_post.get('id')] = post_prepare_pool.submit(prepare_post, next_post, group_info_cache.get(group_owner_id))
 
-            post_text_lower = post.get('text','').lower()
-            # Используем копию filter_words для итерации, если планируется его изменение в другом потоке
-            current_filter_words = list(filter_words) 
-            if current_filter_words and any(word.lower() in post_text_lower for word in current_filter_words):
-                logger.info(f"Пост {post_link} ({group_key}) отфильтрован по словам.")
-                processed_posts[post_id] = f"filtered_{time.time()}"; continue
+        try:
+            prepare_ahead()
+            for post, action in planned_posts:
+                post_id = str(post.get('id'))
+                post_link = f"https://vk.com/wall{group_owner_id}_{post_id}"
+                if action in ('filtered', 'repost_skipped'):
+                    post_state_store.mark_processed(group_key, post_id, action, post.get('date'))
+                elif action == 'send':
+                    prepared = prepared_futures.pop(post.get('id')).result()
+                    prepare_ahead()
+                    logger.info("Новый пост %s (%s). Отправка в %s...", post_link, group_key, target_chat_id)
+                    if deliver_prepared_post(prepared, target_chat_id):
+                        post_state_store.mark_processed(group_key, post_id, 'sent', post.get('date')); new_posts_found += 1
+                        logger.info("Пост %s успешно отправлен.", post_link)
+                    else:
+                        logger.warning(f"Отправка поста {post_link} ({group_key}) не удалась.")
+                        post_state_store.mark_processed(group_key, post_id, 'failed', post.get('date'))
+                new_cursor = (post.get('id'), post.get('date'))
+        finally:
+            for future in prepared_futures.values(): future.cancel()
 
-            if post.get('copy_history'):
-                 logger.info(f"Пост {post_link} ({group_key}) - репост, пропуск.")
-                 processed_posts[post_id] = f"repost_skipped_{time.time()}"; continue
-
-            logger.info(f"Новый пост {post_link} ({group_key}). Отправка в {target_chat_id}...")
-            if send_post_to_telegram(post, target_chat_id):
-                processed_posts[post_id] = f"sent_{time.time()}"; new_posts_found += 1
-                logger.info(f"Пост {post_link} успешно отправлен.")
-                time.sleep(getattr(config, 'DELAY_BETWEEN_POSTS', 3))
-            else:
-                logger.warning(f"Отправка поста {post_link} ({group_key}) не удалась.")
-                processed_posts[post_id] = f"failed_{time.time()}"
+        # Все посты стены обработаны: отметка сдвигается на самый новый пост ответа (включая рекламу и пропущенные типы)
+        if newest_post := max((p for p in response['items'] if not p.get('is_pinned') or p.get('id', 0) > cursor_post_id), key=lambda p: p.get('id', 0), default=None):
+            new_cursor = (newest_post.get('id'), newest_post.get('date'))
 
     except vk_api.ApiError as e:
         logger.error(f"Ошибка VK API группы {group_id} (код {e.code}): {e}")
-        if e.code == 29: logger.warning("Лимит VK API достигнут. Пауза..."); time.sleep(300)
+        if e.code in (6, 29): logger.warning(f"Лимит VK API достигнут (группа {group_id}, код {e.code}). Группа будет проверена позже.")
         elif e.code == 5: send_error_to_admin(f"Ошибка авторизации VK (группа {group_id})? Проверьте токен.", is_critical=True)
         elif e.code == 15: logger.warning(f"Доступ к контенту запрещен (группа {group_id}, код 15): {e}")
         elif e.code == 100: logger.error(f"Ошибка параметров VK API (группа {group_id}, код 100): {e}")
+    except VkRateLimitBackoff as e: logger.warning(f"Проверка группы {group_id} отложена: {e}")
     except requests.exceptions.RequestException as e: logger.error(f"Сетевая ошибка при запросе к VK API ({group_id}): {e}")
     except Exception as e: logger.exception(f"Непредвиденная ошибка при проверке группы {group_id}: {e}")
     finally:
-        save_posts_state(group_key, processed_posts)
-        logger.info(f"Проверка группы {group_key} завершена. Отправлено новых постов: {new_posts_found}.")
+        if new_cursor and new_cursor[0] and new_cursor[0] > cursor_post_id:
+            try: post_state_store.set_cursor(group_key, new_cursor[0], new_cursor[1])
+            except Exception as e_cursor: logger.error(f"Не удалось сохранить отметку последнего поста для {group_key}: {e_cursor}")
+        logger.info("Проверка группы %s завершена. Отправлено новых постов: %s.", group_key, new_posts_found)
+    return new_posts_found
+
+# --- Адаптивный планировщик опроса групп ---
+class GroupPollScheduler:
+    """
+    Очередь с приоритетом по времени следующей проверки групп.
+    Интервал опроса группы подбирается по частоте её публикаций за последние rate_window_days дней (из POST_STATE_DB):
+    активные группы проверяются чаще, "спящие" - реже, в пределах [min_interval, max_interval].
+    """
+    def __init__(self, min_interval, max_interval, default_interval, rate_window_days, rate_factor):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.default_interval = default_interval
+        self.rate_window_days = rate_window_days
+        self.rate_factor = rate_factor
+        self.heap = [] # (время следующей проверки, порядковый номер, группа)
+        self.scheduled_keys = set()
+        self.counter = itertools.count()
+
+    def schedule(self, group, delay):
+        heapq.heappush(self.heap, (time.time() + delay, next(self.counter), group))
+        self.scheduled_keys.add(group[1])
+
+    def is_scheduled(self, group):
+        return group[1] in self.scheduled_keys
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, group = heapq.heappop(self.heap)
+            self.scheduled_keys.discard(group[1])
+            due.append(group)
+        return due
+
+    def seconds_until_next(self, now, default):
+        return max(0, self.heap[0][0] - now) if self.heap else default
+
+    def compute_interval(self, group_key, new_posts_count):
+        if new_posts_count: return self.min_interval # Группа публикует прямо сейчас - проверяем как можно чаще
+        try: posts_in_window = post_state_store.count_recent_posts(group_key, self.rate_window_days)
+        except Exception as e:
+            logger.warning(f"Не удалось получить частоту публикаций группы {group_key}: {e}")
+            return min(max(self.default_interval, self.min_interval), self.max_interval)
+        if not posts_in_window: return self.max_interval
+        mean_gap = self.rate_window_days * 86400 / posts_in_window
+        return min(max(mean_gap * self.rate_factor, self.min_interval), self.max_interval)
+
+    def reschedule(self, group, new_posts_count):
+        interval = self.compute_interval(group[1], new_posts_count)
+        self.schedule(group, interval)
+        logger.info("Группа %s: следующая проверка через %.0f сек.", group[1], interval)
 
 def admin_only(func):
     def wrapped(message):
         admin_id_str = str(getattr(config, 'ADMIN_CHAT_ID', None))
         user_chat_id_str = str(message.chat.id)
         command_name = func.__name__
-        logger.debug(f"Попытка вызова команды /{command_name} пользователем chat_id={user_chat_id_str}, user={message.from_user.username or message.from_user.id}")
+        logger.debug("Попытка вызова команды /%s пользователем chat_id=%s, user=%s", command_name, user_chat_id_str, message.from_user.username or message.from_user.id)
 
         if not admin_id_str or user_chat_id_str != admin_id_str:
             logger.warning(f"Доступ к команде /{command_name} запрещен для chat_id={user_chat_id_str}")
@@ -1166,7 +2614,7 @@ def admin_only(func):
                 try: bot.reply_to(message, "⛔ Доступ запрещен. Эта команда только для администратора.", parse_mode=None)
                 except Exception: pass
             return
-        logger.info(f"Администратор ({user_chat_id_str}) вызвал команду /{command_name}")
+        logger.info("Администратор (%s) вызвал команду /%s", user_chat_id_str, command_name)
         return func(message)
     wrapped.__name__ = func.__name__; wrapped.__doc__ = func.__doc__; return wrapped
 
@@ -1186,6 +2634,7 @@ def send_welcome(message):
 `/set_loglevel [DEBUG|INFO|WARNING|ERROR]` - Установить уровень логирования для файла.
 `/clear_videos` - Очистить папку скачанных видео (`vk_videos`).
 `/clear_photos` - Очистить папку временных фото (`vk_photos_temp`).
+`/stats` - Показать счетчики работы бота (лимиты VK API и др.).
 `/help` или `/start` - Показать это справочное сообщение.
 
 Настройки бота задаются в файле `config.py`.
@@ -1198,16 +2647,18 @@ def send_welcome(message):
 @bot.message_handler(commands=['filter'])
 @admin_only
 def handle_filter(message):
-    global filter_words
     try:
         if len(parts := message.text.split(maxsplit=1)) > 1 and (new_filter := parts[1].strip().lower()):
             escaped_new_filter = new_filter.replace('`','\\`')
             reply = ""
-            if new_filter not in filter_words:
-                filter_words.append(new_filter)
-                save_filter_words()
+            with filter_words_lock:
+                added = new_filter not in filter_words
+                if added:
+                    set_filter_words(filter_words + [new_filter])
+                    save_filter_words()
+            if added:
                 reply = f"✅ Фильтр `{escaped_new_filter}` добавлен."
-                logger.info(f"Фильтр добавлен администратором: '{new_filter}'")
+                logger.info("Фильтр добавлен администратором: '%s'", new_filter)
             else:
                 reply = f"⚠️ Фильтр `{escaped_new_filter}` уже существует."
 
@@ -1224,16 +2675,18 @@ def handle_filter(message):
 @bot.message_handler(commands=['remove'])
 @admin_only
 def handle_remove(message):
-    global filter_words
     try:
         if len(parts := message.text.split(maxsplit=1)) > 1 and (filter_to_remove := parts[1].strip().lower()):
             escaped_filter_to_remove = filter_to_remove.replace('`','\\`')
             reply = ""
-            if filter_to_remove in filter_words:
-                filter_words.remove(filter_to_remove)
-                save_filter_words()
+            with filter_words_lock:
+                removed = filter_to_remove in filter_words
+                if removed:
+                    set_filter_words([f for f in filter_words if f != filter_to_remove])
+                    save_filter_words()
+            if removed:
                 reply = f"✅ Фильтр `{escaped_filter_to_remove}` удален."
-                logger.info(f"Фильтр удален администратором: '{filter_to_remove}'")
+                logger.info("Фильтр удален администратором: '%s'", filter_to_remove)
             else:
                 reply = f"⚠️ Фильтр `{escaped_filter_to_remove}` не найден в списке."
 
@@ -1279,7 +2732,7 @@ def handle_get_log(message):
                 else: bot.reply_to(message,"⚠️ Количество строк должно быть положительным.", parse_mode=None); return
             except ValueError: bot.reply_to(message,"⚠️ Неверный формат. Укажите число строк: `/log 50`", parse_mode='Markdown'); return
 
-        logger.info(f"Администратор запросил последние {count} строк лога.")
+        logger.info("Администратор запросил последние %s строк лога.", count)
         if not os.path.exists(log_file_path): bot.reply_to(message,"⚠️ Файл лога не найден.", parse_mode=None); return
 
         try:
@@ -1293,7 +2746,7 @@ def handle_get_log(message):
             backup_index = 1
             while needed > 0 and os.path.exists(f"{log_file_path}.{backup_index}"):
                  backup_file = f"{log_file_path}.{backup_index}"
-                 logger.debug(f"Чтение бэкапа лога: {backup_file} (нужно еще {needed} строк)")
+                 logger.debug("Чтение бэкапа лога: %s (нужно еще %s строк)", backup_file, needed)
                  try:
                      with open(backup_file, 'r', encoding='utf-8') as bf:
                          backup_lines = bf.readlines()
@@ -1360,13 +2813,14 @@ def handle_set_loglevel(message):
             if new_level_name in allowed_levels:
                 new_level = allowed_levels[new_level_name]
                 rotating_handler.setLevel(new_level)
+                sync_root_log_level()
                 if new_level == logging.DEBUG:
                     rotating_handler.setFormatter(log_formatter_debug)
-                    logger.info(f"Уровень логирования файла изменен на DEBUG (с детальным форматом).")
+                    logger.info("Уровень логирования файла изменен на DEBUG (с детальным форматом).")
                     bot.reply_to(message, f"✅ Уровень логирования файла установлен на `{new_level_name}` (детальный формат).", parse_mode='Markdown')
                 else:
                     rotating_handler.setFormatter(log_formatter_info)
-                    logger.info(f"Уровень логирования файла изменен на {new_level_name} (стандартный формат).")
+                    logger.info("Уровень логирования файла изменен на %s (стандартный формат).", new_level_name)
                     bot.reply_to(message, f"✅ Уровень логирования файла установлен на `{new_level_name}` (стандартный формат).", parse_mode='Markdown')
             else:
                 bot.reply_to(message, f"⚠️ Неверный уровень логирования. Доступные: {', '.join(allowed_levels.keys())}. Текущий: `{current_level_name}`.", parse_mode='Markdown')
@@ -1380,11 +2834,11 @@ def handle_set_loglevel(message):
 @bot.message_handler(commands=['clear_videos'])
 @admin_only
 def handle_clear_videos(message):
-    logger.info(f"Администратор инициировал очистку папки {DOWNLOAD_DIR}.")
+    logger.info("Администратор инициировал очистку кэша видео %s.", DOWNLOAD_DIR)
     try:
-        clear_download_folder(DOWNLOAD_DIR)
-        bot.reply_to(message, f"✅ Папка `{DOWNLOAD_DIR}` успешно очищена.", parse_mode='Markdown')
-        logger.info(f"Папка {DOWNLOAD_DIR} очищена по команде администратора.")
+        removed = video_cache.clear()  # идущие сейчас скачивания (.incoming) не удаляются
+        bot.reply_to(message, f"✅ Кэш видео `{DOWNLOAD_DIR}` очищен: удалено файлов {removed}.", parse_mode='Markdown')
+        logger.info("Кэш видео %s очищен по команде администратора.", DOWNLOAD_DIR)
     except Exception as e:
         logger.error(f"Ошибка при выполнении /clear_videos: {e}", exc_info=True)
         try: bot.reply_to(message, f"❌ Произошла ошибка при очистке папки `{DOWNLOAD_DIR}`: {e}", parse_mode='Markdown')
@@ -1396,11 +2850,11 @@ def handle_clear_videos(message):
 @admin_only
 def handle_clear_photos(message):
     folder_to_clear = PHOTO_DOWNLOAD_DIR
-    logger.info(f"Администратор инициировал очистку папки {folder_to_clear}.")
+    logger.info("Администратор инициировал очистку кэша фото %s.", folder_to_clear)
     try:
-        clear_download_folder(folder_to_clear)
-        bot.reply_to(message, f"✅ Папка `{folder_to_clear}` успешно очищена.", parse_mode='Markdown')
-        logger.info(f"Папка {folder_to_clear} очищена по команде администратора.")
+        removed = photo_cache.clear()  # фото, которые скачиваются сейчас (.incoming), не удаляются
+        bot.reply_to(message, f"✅ Кэш фото `{folder_to_clear}` очищен: удалено файлов {removed}.", parse_mode='Markdown')
+        logger.info("Кэш фото %s очищен по команде администратора.", folder_to_clear)
     except Exception as e:
         logger.error(f"Ошибка при выполнении /clear_photos: {e}", exc_info=True)
         try: bot.reply_to(message, f"❌ Произошла ошибка при очистке папки `{folder_to_clear}`: {e}", parse_mode='Markdown')
@@ -1408,6 +2862,47 @@ def handle_clear_photos(message):
              try: bot.reply_to(message, f"❌ Произошла ошибка при очистке папки {folder_to_clear}: {e}", parse_mode=None)
              except Exception: pass
 
+def collect_runtime_stats():
+    """Счетчики производительности для /stats и лога цикла."""
+    vk_stats = vk_session.get_stats()
+    lines = [
+        f"VK API: вызовов {vk_stats['calls']}, ждали лимита {vk_stats['throttled']} ({vk_stats['wait_seconds']:.1f} сек.), ждут сейчас {vk_stats['waiting']}",
+        f"VK API: ошибок 6/29: {vk_stats['error_6']}/{vk_stats['error_29']}, отклонено на паузе {vk_stats['backoff_rejected']}, на паузе: {', '.join(vk_stats['methods_in_backoff']) or 'нет'}",
+    ]
+    url_stats = url_cache.get_stats()
+    lines.append(f"Кэш ссылок: попаданий {url_stats['hits']}, неудачных из кэша {url_stats['negative_hits']}, промахов {url_stats['misses']}, записей {url_stats['size']}")
+    file_stats = telegram_file_cache.get_stats()
+    file_lookups = file_stats['hits'] + file_stats['misses']
+    file_hit_rate = 100.0 * file_stats['hits'] / file_lookups if file_lookups else 0.0
+    lines.append(f"Кэш file_id: попаданий {file_stats['hits']} из {file_lookups} ({file_hit_rate:.0f}%), сохранено {file_stats['stored']}, отклонено Telegram {file_stats['invalidated']}, записей {file_stats['size']}")
+    http_stats = http_client.get_stats()
+    lines.append(f"HTTP: запросов {http_stats['requests']}, новых соединений {http_stats['connections']} к {http_stats['hosts']} хостам, переиспользовано {http_stats['reuse_percent']:.0f}%")
+    send_stats = telegram_send_scheduler.get_stats()
+    lines.append(f"Telegram: запросов {send_stats['requests']}, ждали лимита {send_stats['throttled']} ({send_stats['wait_seconds']:.1f} сек.), ответов 429 {send_stats['error_429']} (retry_after всего {send_stats['retry_after_seconds']:.0f} сек.), чатов {send_stats['chats']}")
+    with markdown_check_lock: md_stats = dict(markdown_check_stats)
+    lines.append(f"Markdown: проверено {md_stats['checked']}, отправлено без MD сразу {md_stats['retries_avoided']} (повторов избежано), ошибок разбора от Telegram {md_stats['api_parse_errors']}")
+    upload_stats = telegram_upload_stats.get_stats()
+    lines.append(f"Загрузка видео: {upload_stats['uploads']} файлов, {upload_stats['bytes'] / (1024 * 1024):.1f} MB, одновременно до {upload_stats['max_in_flight']}")
+    if webhook_server:
+        hook_stats = webhook_server.get_stats()
+        lines.append(f"Webhook: получено {hook_stats['received']}, обработано {hook_stats['processed']}, ошибок {hook_stats['errors']}, в работе {hook_stats['in_flight']}, отклонено: занято {hook_stats['rejected_busy']}, без секрета {hook_stats['rejected_auth']}, некорректных {hook_stats['bad_requests']}")
+    engine_stats = ytdlp_engine_pool.get_stats()
+    lines.append(f"yt-dlp: выдач {engine_stats['checkouts']}, создано экземпляров {engine_stats['created']}, ожидали свободный {engine_stats['waited']}")
+    for cache_name, media_cache in (("видео", video_cache), ("фото", photo_cache), ("миниатюр", thumbnail_cache)):
+        cache_stats = media_cache.get_stats()
+        lines.append(f"Кэш {cache_name}: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, сохранено {cache_stats['stored']}, вытеснено {cache_stats['evicted']}, занято {cache_stats['size_bytes'] / (1024 * 1024):.1f} MB")
+    return lines
+
+@bot.message_handler(commands=['stats'])
+@admin_only
+def handle_stats(message):
+    try:
+        bot.reply_to(message, "📊 Статистика:\n" + "\n".join(collect_runtime_stats()), parse_mode=None)
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении /stats: {e}", exc_info=True)
+        try: bot.reply_to(message, f"❌ Произошла ошибка при получении статистики: {e}", parse_mode=None)
+        except Exception: pass
+
 def vk_check_loop():
     logger.info("Запуск основного цикла проверки VK...")
     check_interval = getattr(config, 'VK_CHECK_INTERVAL_SECONDS', 60)
@@ -1416,6 +2911,8 @@ def vk_check_loop():
     admin_chat_id = getattr(config, 'ADMIN_CHAT_ID', None)
     target_chat_id = getattr(config, 'TARGET_TELEGRAM_CHAT_ID', None)
     delay_between_groups = getattr(config, 'DELAY_BETWEEN_GROUPS', 5)
+    batch_fetch = getattr(config, 'VK_BATCH_FETCH', True)
+    adaptive_polling = getattr(config, 'VK_ADAPTIVE_POLLING', True)
 
     if not primary_group_id_str and not secondary_groups:
         logger.critical("Критическая ошибка конфигурации: Не указаны ID групп VK. Бот остановлен.")
@@ -1426,135 +2923,335 @@ def vk_check_loop():
     if not admin_chat_id:
         logger.warning("ADMIN_CHAT_ID не указан в config.py. Уведомления об ошибках и посты из вторичных групп не будут отправляться.")
 
+    groups_to_check = [] # (ID группы, ключ состояния, чат назначения)
+    if primary_group_id_str and target_chat_id:
+        try:
+            primary_group_id_int = int(primary_group_id_str)
+            groups_to_check.append((primary_group_id_int, f"primary_{primary_group_id_int}", target_chat_id))
+        except ValueError:
+            logger.error(f"Некорректный PRIMARY_VK_GROUP_ID: '{primary_group_id_str}'.")
+            send_error_to_admin(f"Ошибка конфигурации: Некорректный PRIMARY_VK_GROUP_ID '{primary_group_id_str}'. Проверка основной группы пропущена.", is_critical=True)
+
+    if isinstance(secondary_groups, dict) and admin_chat_id:
+         for key, group_id_str in secondary_groups.items():
+             try:
+                 groups_to_check.append((int(group_id_str), str(key), admin_chat_id))
+             except ValueError:
+                 logger.error(f"Некорректный ID '{group_id_str}' для ключа '{key}' в SECONDARY_VK_GROUPS.")
+                 send_error_to_admin(f"Ошибка конфигурации: Некорректный ID '{group_id_str}' для вторичной группы '{key}'. Группа пропущена.")
+    elif not isinstance(secondary_groups, dict) and secondary_groups:
+         logger.warning("Формат SECONDARY_VK_GROUPS некорректен. Должен быть словарь.")
+         send_error_to_admin("Ошибка конфигурации: Неверный формат SECONDARY_VK_GROUPS.")
+    elif not secondary_groups:
+         logger.info("Вторичные группы (SECONDARY_VK_GROUPS) не настроены.")
+
+    scheduler = None
+    if adaptive_polling:
+        scheduler = GroupPollScheduler(
+            min_interval=getattr(config, 'VK_POLL_MIN_INTERVAL_SECONDS', 60),
+            max_interval=getattr(config, 'VK_POLL_MAX_INTERVAL_SECONDS', 1800),
+            default_interval=check_interval,
+            rate_window_days=getattr(config, 'VK_POLL_RATE_WINDOW_DAYS', 7),
+            rate_factor=getattr(config, 'VK_POLL_RATE_FACTOR', 0.25),
+        )
+        for group in groups_to_check: scheduler.schedule(group, 0)
+        logger.info("Адаптивный опрос включен: интервалы от %s до %s сек.", scheduler.min_interval, scheduler.max_interval)
+
+    last_prune_time = 0
     while True:
         loop_start_time = time.time()
-        logger.info(f"--- Начало цикла проверки VK ({time.strftime('%Y-%m-%d %H:%M:%S')}) ---")
-        memory_handler.buffer.clear(); logger.debug("Буфер ошибок в памяти очищен.")
+        logger.info("--- Начало цикла проверки VK (%s) ---", time.strftime('%Y-%m-%d %H:%M:%S'))
+        wait_for_log_queue(); take_buffered_errors(); logger.debug("Буфер ошибок в памяти очищен.")
+        due_groups = []
 
         try:
-            clear_download_folder(DOWNLOAD_DIR)
-            clear_download_folder(PHOTO_DOWNLOAD_DIR) 
-
-            if primary_group_id_str and target_chat_id:
-                logger.info(f"Начало проверки основной группы: {primary_group_id_str}")
+            video_cache.enforce_quota()
+            photo_cache.enforce_quota()
+            thumbnail_cache.enforce_quota()
+            if loop_start_time - last_prune_time >= 3600:
+                try: post_state_store.prune(getattr(config, 'POST_HISTORY_DAYS', 90)); last_prune_time = loop_start_time
+                except Exception as e_prune: logger.error(f"Не удалось очистить старую историю постов: {e_prune}")
+
+            due_groups = scheduler.pop_due(loop_start_time) if scheduler else list(groups_to_check)
+            logger.info("Групп к проверке в этом цикле: %s из %s.", len(due_groups), len(groups_to_check))
+
+            prefetched_responses = {}
+            if batch_fetch and due_groups:
+                logger.info("Пакетный запрос стен %s групп (до %s на один execute)...", len(due_groups), VK_EXECUTE_BATCH_SIZE)
+                prefetched_responses = fetch_vk_walls_batch({g[0]: get_wall_fetch_count(g[1]) for g in due_groups})
+
+            groups_processed_count = 0
+            for group_index, group in enumerate(due_groups):
+                group_id_int, key, group_chat_id = group
+                logger.info("Начало проверки группы: %s (ID: %s)", key, group_id_int)
+                new_posts_count = 0
                 try:
-                    primary_group_id_int = int(primary_group_id_str)
-                    check_and_send_vk_posts(primary_group_id_int, f"primary_{primary_group_id_int}", target_chat_id)
-                    logger.info(f"Завершение проверки основной группы: {primary_group_id_str}. Пауза {delay_between_groups} сек...")
+                    new_posts_count = check_and_send_vk_posts(group_id_int, key, group_chat_id, prefetched_response=prefetched_responses.get(group_id_int)) or 0
+                    groups_processed_count += 1
+                    logger.info("Завершение проверки группы: %s (ID: %s).", key, group_id_int)
+                except Exception as e_group:
+                    logger.exception(f"Непредвиденная ошибка при проверке группы {key} ({group_id_int}): {e_group}")
+                finally:
+                    if scheduler: scheduler.reschedule(group, new_posts_count)
+                if not batch_fetch and group_index < len(due_groups) - 1:
+                    logger.debug("Пауза %s сек перед следующей группой...", delay_between_groups)
                     time.sleep(delay_between_groups)
-                except ValueError:
-                    logger.error(f"Некорректный PRIMARY_VK_GROUP_ID: '{primary_group_id_str}'.")
-                    send_error_to_admin(f"Ошибка конфигурации: Некорректный PRIMARY_VK_GROUP_ID '{primary_group_id_str}'. Проверка основной группы пропущена.", is_critical=True)
-                except Exception as e_primary:
-                    logger.exception(f"Непредвиденная ошибка при проверке основной группы {primary_group_id_str}: {e_primary}")
-
-            if isinstance(secondary_groups, dict) and admin_chat_id:
-                 logger.info(f"Начало проверки {len(secondary_groups)} вторичных групп...")
-                 groups_processed_count = 0
-                 for key, group_id_str in secondary_groups.items():
-                     logger.info(f"Начало проверки вторичной группы: {key} (ID: {group_id_str})")
-                     try:
-                         group_id_int = int(group_id_str)
-                         check_and_send_vk_posts(group_id_int, str(key), admin_chat_id)
-                         groups_processed_count += 1
-                         logger.info(f"Завершение проверки вторичной группы: {key} (ID: {group_id_str}).")
-                         if groups_processed_count < len(secondary_groups):
-                             logger.debug(f"Пауза {delay_between_groups} сек перед следующей вторичной группой...")
-                             time.sleep(delay_between_groups)
-                     except ValueError:
-                         logger.error(f"Некорректный ID '{group_id_str}' для ключа '{key}' в SECONDARY_VK_GROUPS.")
-                         send_error_to_admin(f"Ошибка конфигурации: Некорректный ID '{group_id_str}' для вторичной группы '{key}'. Группа пропущена.")
-                     except Exception as e_secondary:
-                         logger.exception(f"Непредвиденная ошибка при проверке вторичной группы {key} ({group_id_str}): {e_secondary}")
-                 logger.info(f"Завершена проверка {groups_processed_count} из {len(secondary_groups)} вторичных групп.")
-            elif not isinstance(secondary_groups, dict) and secondary_groups:
-                 logger.warning("Формат SECONDARY_VK_GROUPS некорректен. Должен быть словарь.")
-                 send_error_to_admin("Ошибка конфигурации: Неверный формат SECONDARY_VK_GROUPS.")
-            elif not secondary_groups:
-                 logger.info("Вторичные группы (SECONDARY_VK_GROUPS) не настроены.")
-
-            if memory_handler.buffer:
-                logger.info(f"Обнаружено {len(memory_handler.buffer)} ошибок в буфере. Отправка сводки админу...")
-                send_error_summary_to_admin(list(memory_handler.buffer))
-                memory_handler.buffer.clear()
+            logger.info("Завершена проверка %s из %s групп.", groups_processed_count, len(due_groups))
+            url_cache.save()
+            telegram_file_cache.save()
+            if logger.isEnabledFor(logging.DEBUG):
+                for stats_line in collect_runtime_stats(): logger.debug("Статистика: %s", stats_line)
+
+            wait_for_log_queue()
+            if buffered_errors := take_buffered_errors():
+                logger.info("Обнаружено %s ошибок в буфере. Отправка сводки админу...", len(buffered_errors))
+                send_error_summary_to_admin(buffered_errors)
             else:
                 logger.debug("Буфер ошибок пуст, сводка не требуется.")
 
             loop_duration = time.time() - loop_start_time
-            wait_time = max(0, check_interval - loop_duration)
-            logger.info(f"--- Цикл проверки VK завершен за {loop_duration:.2f} сек. Следующий запуск через ~{wait_time:.0f} сек. ---")
+            if scheduler: wait_time = scheduler.seconds_until_next(time.time(), default=check_interval)
+            else: wait_time = max(0, check_interval - loop_duration)
+            logger.info("--- Цикл проверки VK завершен за %.2f сек. Следующий запуск через ~%.0f сек. ---", loop_duration, wait_time)
             time.sleep(wait_time)
 
         except Exception as e_loop:
             logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА в основном цикле vk_check_loop: {e_loop}", exc_info=True)
             send_error_to_admin(f"КРИТИЧЕСКАЯ ОШИБКА в основном цикле проверки VK: {e_loop}. Бот может работать нестабильно.", is_critical=True)
-            if memory_handler.buffer:
+            if scheduler:
+                for group in due_groups:
+                    if not scheduler.is_scheduled(group): scheduler.schedule(group, check_interval)
+            wait_for_log_queue()
+            if buffered_errors := take_buffered_errors():
                 logger.warning("Отправка накопленных ошибок перед аварийной паузой...")
-                send_error_summary_to_admin(list(memory_handler.buffer)); memory_handler.buffer.clear()
+                send_error_summary_to_admin(buffered_errors)
             logger.info("Аварийная пауза 300 секунд после критической ошибки в цикле...")
             time.sleep(300)
 
-if __name__ == '__main__':
-    logger.info("================ ЗАПУСК БОТА ================")
-    admin_chat_id = getattr(config, 'ADMIN_CHAT_ID', None)
-    if admin_chat_id:
-        try:
-            bot.send_message(admin_chat_id, "🚀 Бот успешно запущен!", parse_mode=None)
-            logger.info(f"Уведомление о запуске отправлено администратору ({admin_chat_id}).")
-        except Exception as e_start:
-            logger.error(f"Не удалось отправить уведомление о запуске администратору ({admin_chat_id}): {e_start}")
-    else:
-        logger.warning("ADMIN_CHAT_ID не указан в config.py. Уведомление о запуске не отправлено.")
+# --- Получение обновлений Telegram: long polling или webhook ---
+class WebhookHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
 
-    load_filter_words()
+    def handle_error(self, request, client_address):
+        logger.debug("Webhook: соединение с %s прервано.", client_address[0], exc_info=True)
 
-    for dir_path in [DOWNLOAD_DIR, PHOTO_DOWNLOAD_DIR]: 
-        if not os.path.exists(dir_path):
-            try:
-                os.makedirs(dir_path)
-                logger.info(f"Создана папка: {dir_path}")
-            except OSError as e:
-                logger.critical(f"Не удалось создать папку {dir_path}: {e}. Работа зависимых функций будет невозможна.")
-                send_error_to_admin(f"Критическая ошибка: Не удалось создать папку {dir_path}.", is_critical=True)
-
-    vk_thread = threading.Thread(target=vk_check_loop, name="VKCheckLoop", daemon=True)
-    vk_thread.start()
-    logger.info("Поток проверки постов VK запущен в фоновом режиме.")
+class WebhookServer:
+    """
+    Встроенный HTTP(S)-сервер для webhook Telegram (можно поставить за reverse proxy). Каждое соединение обслуживается
+    своим потоком с таймаутом REQUEST_TIMEOUT_SECONDS (включая TLS-рукопожатие), поэтому молчащий клиент не блокирует
+    остальных. Поток соединения проверяет путь и секрет, разбирает Update и передает его в пул из workers потоков.
+    Пока в обработке и очереди уже workers + queue_size обновлений, сервер отвечает 503, и Telegram повторяет доставку позже.
+    """
+    MAX_BODY_BYTES = 1024 * 1024
+    REQUEST_TIMEOUT_SECONDS = 10
+
+    def __init__(self, public_url, listen, port, path=None, secret_token=None, ssl_cert=None, ssl_key=None,
+                 self_signed=False, workers=4, queue_size=100):
+        self.public_url = public_url
+        self.listen, self.port = listen, int(port)
+        self.path = path or urlparse(public_url).path or '/'
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self.ssl_cert, self.ssl_key, self.self_signed = ssl_cert, ssl_key, self_signed
+        self.workers = max(1, int(workers))
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="WebhookHandler")
+        self.slots = threading.BoundedSemaphore(self.workers + max(0, int(queue_size)))
+        self.httpd = None
+        self.lock = threading.Lock()
+        self.stats = {'received': 0, 'processed': 0, 'errors': 0, 'rejected_busy': 0, 'rejected_auth': 0, 'bad_requests': 0, 'in_flight': 0}
+
+    def _count(self, key, delta=1):
+        with self.lock: self.stats[key] += delta
+
+    def submit(self, update):
+        if not self.slots.acquire(blocking=False):
+            self._count('rejected_busy')
+            return False
+        with self.lock: self.stats['received'] += 1; self.stats['in_flight'] += 1
+        self.pool.submit(self._process, update)
+        return True
 
-    logger.info("Запуск основного цикла опроса Telegram (polling)...")
+    def _process(self, update):
+        try:
+            bot.process_new_updates([update])
+            self._count('processed')
+        except Exception as e:
+            self._count('errors')
+            logger.error(f"Ошибка обработки обновления {update.update_id} из webhook: {e}", exc_info=True)
+        finally:
+            self._count('in_flight', -1)
+            self.slots.release()
+
+    def _make_handler(self):
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            timeout = server.REQUEST_TIMEOUT_SECONDS
+
+            def setup(self):
+                # Рукопожатие TLS выполняется здесь, в потоке соединения и с таймаутом, а не в accept() сервера
+                self.request.settimeout(self.timeout)
+                if isinstance(self.request, ssl.SSLSocket): self.request.do_handshake()
+                super().setup()
+
+            def log_message(self, format, *args):
+                if logger.isEnabledFor(logging.DEBUG): logger.debug("Webhook %s: %s", self.address_string(), format % args)
+
+            def _reply(self, code):
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                if self.path.split('?', 1)[0] != server.path: return self._reply(404)
+                if not hmac.compare_digest(self.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode(), server.secret_token.encode()):
+                    server._count('rejected_auth')
+                    logger.warning("Webhook: запрос от %s без верного секрета отклонен.", self.client_address[0])
+                    return self._reply(403)
+                try: length = int(self.headers.get('Content-Length') or 0)
+                except ValueError: length = 0
+                if not 0 < length <= server.MAX_BODY_BYTES:
+                    server._count('bad_requests')
+                    return self._reply(413 if length else 400)
+                try: update = types.Update.de_json(self.rfile.read(length).decode('utf-8'))
+                except (ValueError, KeyError, TypeError) as e:
+                    server._count('bad_requests')
+                    logger.warning(f"Webhook: не удалось разобрать обновление: {e}")
+                    return self._reply(400)
+                self._reply(200 if server.submit(update) else 503)
+
+        return WebhookRequestHandler
+
+    def _bind(self):
+        httpd = WebhookHTTPServer((self.listen, self.port), self._make_handler())
+        if self.ssl_cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.ssl_cert, self.ssl_key)
+            httpd.socket = context.wrap_socket(httpd.socket, server_side=True, do_handshake_on_connect=False)
+        logger.info("Webhook-сервер слушает %s://%s:%s%s", 'https' if self.ssl_cert else 'http', self.listen, self.port, self.path)
+        return httpd
+
+    def serve(self):
+        """Регистрирует webhook в Telegram и обслуживает запросы до остановки. Ошибки set_webhook поднимаются наружу."""
+        if self.httpd is None: self.httpd = self._bind()
+        bot.threaded = False  # обработчики команд выполняются в ограниченном пуле webhook, а не в пуле telebot
+        certificate = open(self.ssl_cert, 'rb') if self.ssl_cert and self.self_signed else None
+        try: bot.set_webhook(url=self.public_url, certificate=certificate, max_connections=self.workers, secret_token=self.secret_token)
+        finally:
+            if certificate: certificate.close()
+        logger.info("Webhook зарегистрирован в Telegram: %s", self.public_url)
+        try: self.httpd.serve_forever()
+        except KeyboardInterrupt: logger.info("Webhook-сервер остановлен по Ctrl+C.")
+
+    def close(self):
+        if self.httpd is not None: self.httpd.server_close(); self.httpd = None
+        self.pool.shutdown(wait=True)
+
+    def get_stats(self):
+        with self.lock: return dict(self.stats)
+
+webhook_server = None
+
+def receive_updates_polling():
+    bot.remove_webhook()  # getUpdates не работает, пока у бота зарегистрирован webhook (ответ 409)
+    bot.polling(none_stop=True, interval=0, timeout=30)
+
+def run_update_loop(receive_updates, mode_name):
+    """Запускает receive_updates и перезапускает его после сетевых ошибок и ошибок Telegram API с паузами."""
+    logger.info("Запуск основного цикла получения обновлений Telegram (%s)...", mode_name)
     retries = 0
     max_retries = 5
     while True:
         try:
-            bot.polling(none_stop=True, interval=0, timeout=30)
-            logger.info("bot.polling завершился штатно.")
+            receive_updates()
+            logger.info("%s завершился штатно.", mode_name)
             break
         except requests.exceptions.ReadTimeout as e:
-            logger.warning(f"Таймаут чтения от Telegram API: {e}. Перезапуск polling через 5 секунд...")
+            logger.warning(f"Таймаут чтения от Telegram API: {e}. Перезапуск {mode_name} через 5 секунд...")
             time.sleep(5); retries = 0
         except requests.exceptions.ConnectionError as e:
-            logger.warning(f"Ошибка соединения с Telegram API: {e}. Перезапуск polling через 60 секунд...")
+            logger.warning(f"Ошибка соединения с Telegram API: {e}. Перезапуск {mode_name} через 60 секунд...")
             time.sleep(60); retries = 0
         except ApiTelegramException as e:
-             logger.error(f"Ошибка Telegram API в polling (код {e.error_code}): {e}.")
+             logger.error(f"Ошибка Telegram API в {mode_name} (код {e.error_code}): {e}.")
              if "Unauthorized" in str(e) or e.error_code == 401:
                   logger.critical(f"Критическая ошибка авторизации Telegram (401): {e}. Неверный токен? Бот остановлен.")
                   send_error_to_admin(f"КРИТИЧЕСКАЯ ОШИБКА АВТОРИЗАЦИИ TELEGRAM (401): {str(e)}. Проверьте TELEGRAM_BOT_TOKEN. Бот остановлен.", is_critical=True)
                   break
              elif e.error_code == 409:
-                  logger.warning(f"Конфликт polling (409): {e}. Возможно, запущен другой экземпляр бота? Перезапуск через 60 секунд...")
+                  logger.warning(f"Конфликт {mode_name} (409): {e}. Возможно, запущен другой экземпляр бота? Перезапуск через 60 секунд...")
                   time.sleep(60); retries = 0
              else:
                   logger.warning(f"Неизвестная ошибка Telegram API ({e.error_code}). Пауза 30 секунд...")
                   time.sleep(30); retries += 1
         except Exception as e:
-            logger.critical(f"КРИТИЧЕСКАЯ НЕПРЕДВИДЕННАЯ ОШИБКА в bot.polling: {e}", exc_info=True)
-            send_error_to_admin(f"КРИТИЧЕСКАЯ НЕПРЕДВИДЕННАЯ ОШИБКА POLLING: {str(e)}. Бот остановлен.", is_critical=True)
+            logger.critical(f"КРИТИЧЕСКАЯ НЕПРЕДВИДЕННАЯ ОШИБКА в {mode_name}: {e}", exc_info=True)
+            send_error_to_admin(f"КРИТИЧЕСКАЯ НЕПРЕДВИДЕННАЯ ОШИБКА {mode_name.upper()}: {str(e)}. Бот остановлен.", is_critical=True)
             break
 
         if retries >= max_retries:
-            logger.critical(f"Достигнуто максимальное количество ({max_retries}) быстрых перезапусков polling из-за ошибок API. Бот остановлен.")
-            send_error_to_admin(f"Критическая ошибка: Polling перезапускался {max_retries} раз подряд из-за ошибок API. Бот остановлен.", is_critical=True)
+            logger.critical(f"Достигнуто максимальное количество ({max_retries}) быстрых перезапусков {mode_name} из-за ошибок API. Бот остановлен.")
+            send_error_to_admin(f"Критическая ошибка: {mode_name} перезапускался {max_retries} раз подряд из-за ошибок API. Бот остановлен.", is_critical=True)
             break
 
+if __name__ == '__main__':
+    logger.info("================ ЗАПУСК БОТА ================")
+    admin_chat_id = getattr(config, 'ADMIN_CHAT_ID', None)
+    if admin_chat_id:
+        try:
+            bot.send_message(admin_chat_id, "🚀 Бот успешно запущен!", parse_mode=None)
+            logger.info("Уведомление о запуске отправлено администратору (%s).", admin_chat_id)
+        except Exception as e_start:
+            logger.error(f"Не удалось отправить уведомление о запуске администратору ({admin_chat_id}): {e_start}")
+    else:
+        logger.warning("ADMIN_CHAT_ID не указан в config.py. Уведомление о запуске не отправлено.")
+
+    load_filter_words()
+    url_cache.load()
+    telegram_file_cache.load()
+
+    try:
+        if imported_count := post_state_store.import_legacy_json(post_state_prefix, getattr(config, 'POST_CURSOR_FILE', 'posts_cursor.json')):
+            logger.info("Старое состояние постов (JSON) перенесено в %s: %s записей.", post_state_db_path, imported_count)
+    except Exception as e_import:
+        logger.error(f"Ошибка переноса старого состояния постов в {post_state_db_path}: {e_import}")
+
+    for dir_path in [DOWNLOAD_DIR, PHOTO_DOWNLOAD_DIR]: 
+        if not os.path.exists(dir_path):
+            try:
+                os.makedirs(dir_path)
+                logger.info("Создана папка: %s", dir_path)
+            except OSError as e:
+                logger.critical(f"Не удалось создать папку {dir_path}: {e}. Работа зависимых функций будет невозможна.")
+                send_error_to_admin(f"Критическая ошибка: Не удалось создать папку {dir_path}.", is_critical=True)
+
+    vk_thread = threading.Thread(target=vk_check_loop, name="VKCheckLoop", daemon=True)
+    vk_thread.start()
+    logger.info("Поток проверки постов VK запущен в фоновом режиме.")
+
+    if str(getattr(config, 'TELEGRAM_UPDATE_MODE', 'polling')).lower() == 'webhook':
+        webhook_url = getattr(config, 'WEBHOOK_URL', None)
+        if not webhook_url:
+            logger.critical("TELEGRAM_UPDATE_MODE = 'webhook', но WEBHOOK_URL не задан в config.py. Используется polling.")
+        else:
+            webhook_server = WebhookServer(
+                webhook_url,
+                listen=getattr(config, 'WEBHOOK_LISTEN', '0.0.0.0'),
+                port=getattr(config, 'WEBHOOK_PORT', 8443),
+                path=getattr(config, 'WEBHOOK_PATH', None),
+                secret_token=getattr(config, 'WEBHOOK_SECRET_TOKEN', None),
+                ssl_cert=getattr(config, 'WEBHOOK_SSL_CERT', None),
+                ssl_key=getattr(config, 'WEBHOOK_SSL_KEY', None),
+                self_signed=getattr(config, 'WEBHOOK_SELF_SIGNED', False),
+                workers=getattr(config, 'WEBHOOK_HANDLER_WORKERS', 4),
+                queue_size=getattr(config, 'WEBHOOK_QUEUE_SIZE', 100),
+            )
+    if webhook_server:
+        try: run_update_loop(webhook_server.serve, 'webhook')
+        finally: webhook_server.close()
+    else:
+        run_update_loop(receive_updates_polling, 'polling')
+
+    url_cache.save()
+    telegram_file_cache.save()
+    ytdlp_engine_pool.close()
     logger.info("================ БОТ ОСТАНОВЛЕН ================")
\ No newline at end of file
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Сравнение подготовки текста поста: прежний многопроходный prepare_text (несколько re.sub, цепочки .replace)
+# против однопроходного render_post_text Manacost на корпусе реальных постов со стены VK.
+#
+# Корпус - JSON-файл с ответом wall.get (или списком постов), либо посты запрашиваются у группы через VK API
+# (--group, нужен config.py) и при указании --save сохраняются для повторных запусков. Сеть во время замера
+# не используется: vk.cc ссылки считаются уже развернутыми (подставляются сами в себя).
+#
+# Перед замером результаты сравниваются на случайных строках из "склеенных" фрагментов (URL сразу после слова
+# или e-mail, соседние ссылки, упоминания и символы разметки) - там прежний prepare_text вел себя неочевидно.
+# Без корпуса выполняется только эта проверка.
+#
+#   python bench_prepare_text.py --group 66834402 --count 100 --save wall_corpus.json
+#   python bench_prepare_text.py -n 200 wall_corpus.json
+#   python bench_prepare_text.py --adjacent 20000
+import argparse
+import json
+import random
+import re
+import statistics
+import time
+
+import Manacost
+
+
+def legacy_prepare_text(text, expanded_urls):
+    """prepare_text до перехода на однопроходный разбор (без логирования)."""
+    if not text: return ""
+    processed_text = text
+    for actual_vk_cc_url in dict.fromkeys(Manacost.find_vk_cc_urls(processed_text)):
+        full_url = expanded_urls.get(actual_vk_cc_url, actual_vk_cc_url)
+        if full_url != actual_vk_cc_url:
+            processed_text = re.sub(re.escape(actual_vk_cc_url), full_url.replace('\\', '\\\\'), processed_text)
+
+    def escape_md_brackets(match):
+        link_text_escaped = match.group(2).replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]')
+        url_escaped = match.group(1).replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        return f'[{link_text_escaped}]({url_escaped})'
+    processed_text = re.sub(r'\[(https?://[^\|\]]+)\|([^\]]+)\]', escape_md_brackets, processed_text)
+
+    def escape_mention(match):
+        escaped = match.group(1).replace('\\', '\\\\').replace('[', '\\[').replace(']', '\\]')
+        return escaped.replace('_', '\\_').replace('*', '\\*').replace('`', '\\`')
+    processed_text = re.sub(r'\[(?:id|club)\d+\|([^\]]+)\]', escape_mention, processed_text)
+
+    url_pattern_for_escape = re.compile(
+        r'(\bhttps?://(?:www\.)?[a-zA-Z0-9@:%._\+~#=/-]{2,256}\.[a-zA-Z0-9()]{1,6}\b(?:[-a-zA-Z0-9()@:%_\+.~#?&/=]*))'
+        r'|(\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b)'
+        r'|(\[[^\]]+\]\([^)]+\))'
+    )
+    parts = []
+    last_end = 0
+    for match in url_pattern_for_escape.finditer(processed_text):
+        pre_text = re.sub(r'(?<![\\`*_])([*_`])(?![`*_])', r'\\\1', processed_text[last_end:match.start()])
+        parts.append(re.sub(r'^\.', r'\\.', pre_text, flags=re.MULTILINE))
+        parts.append(match.group(0))
+        last_end = match.end()
+    post_text = re.sub(r'(?<![\\`*_])([*_`])(?![`*_])', r'\\\1', processed_text[last_end:])
+    parts.append(re.sub(r'^\.', r'\\.', post_text, flags=re.MULTILINE))
+    return "".join(parts).strip()
+
+
+ADJACENT_FRAGMENTS = (
+    'word', 'x', '9', ' ', '\n', '.', '_', '*', '`', '\\', '__', '**', '(', ')', '[', ']', '@', '%', '-',
+    'https://vk.cc/Ab1', 'https://vk.cc/Zz', 'http://site.com/a_b', 'https://ex.org', 'a@b.ru', 'mail.me@ya.ru',
+    '[https://x.com/p|te_xt]', '[id1|na_me]', '[club2|c*b]', '[t](http://u.ru)',
+)
+ADJACENT_EXPANDED = {'https://vk.cc/Ab1': 'https://exp.com/p_q?x=1', 'https://vk.cc/Zz': 'https://long.example.com/a_b_c'}
+
+
+def check_adjacent_tokens(samples, seed=1):
+    """Случайные строки из соседних токенов: список (текст, прежний результат, новый результат) для расхождений."""
+    rng = random.Random(seed)
+    mismatches = []
+    for _ in range(samples):
+        text = ''.join(rng.choice(ADJACENT_FRAGMENTS) for _ in range(rng.randint(1, 8)))
+        expanded = {url: ADJACENT_EXPANDED.get(url, url) for url in Manacost.find_vk_cc_urls(text)}
+        legacy, new = legacy_prepare_text(text, expanded), Manacost.render_post_text(text, expanded)[0]
+        if legacy != new: mismatches.append((text, legacy, new))
+    return mismatches
+
+
+def load_corpus(path):
+    with open(path, 'r', encoding='utf-8') as f: data = json.load(f)
+    posts = data.get('items', []) if isinstance(data, dict) else data
+    return [p['text'] if isinstance(p, dict) else str(p) for p in posts if (p.get('text') if isinstance(p, dict) else p)]
+
+
+def fetch_corpus(group_id, count, save_path=None):
+    posts = []
+    while len(posts) < count:
+        page = Manacost.vk.wall.get(owner_id=-abs(int(group_id)), offset=len(posts), count=min(100, count - len(posts)), filter='owner')
+        if not page.get('items'): break
+        posts.extend(page['items'])
+    if save_path:
+        with open(save_path, 'w', encoding='utf-8') as f: json.dump(posts, f, ensure_ascii=False)
+    return [p['text'] for p in posts if p.get('text')]
+
+
+def bench(render, texts, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        for text, expanded in texts: render(text, expanded)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(name, timings, posts):
+    us = [t * 1e6 / posts for t in timings]
+    print(f"{name:<28} медиана {statistics.median(us):8.1f} мкс/пост | среднее {statistics.mean(us):8.1f} мкс/пост")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость подготовки текста поста: прежний prepare_text против render_post_text.")
+    parser.add_argument('-n', '--iterations', type=int, default=50, help="число проходов по корпусу (по умолчанию 50)")
+    parser.add_argument('--group', help="ID группы VK, посты которой взять в корпус")
+    parser.add_argument('--count', type=int, default=100, help="сколько постов запросить у группы (по умолчанию 100)")
+    parser.add_argument('--save', help="сохранить запрошенные посты в JSON-файл")
+    parser.add_argument('--adjacent', type=int, default=5000, help="число случайных строк для проверки соседних токенов (по умолчанию 5000)")
+    parser.add_argument('corpus', nargs='?', help="JSON-файл с ответом wall.get или списком постов")
+    args = parser.parse_args()
+    Manacost.stream_handler.setLevel('CRITICAL')
+
+    mismatches = check_adjacent_tokens(args.adjacent)
+    print(f"Соседние токены: строк {args.adjacent}, расхождений с прежним результатом: {len(mismatches)}")
+    for text, legacy, new in mismatches[:5]: print(f"  {text!r}\n    прежний: {legacy!r}\n    новый:   {new!r}")
+
+    if args.corpus: texts = load_corpus(args.corpus)
+    elif args.group: texts = fetch_corpus(args.group, args.count, args.save)
+    else: return
+    if not texts: parser.error("в корпусе нет постов с текстом")
+
+    corpus = [(text, {url: url for url in Manacost.find_vk_cc_urls(text)}) for text in texts]
+    mismatches = sum(1 for text, expanded in corpus if legacy_prepare_text(text, expanded) != Manacost.render_post_text(text, expanded)[0])
+    print(f"Постов: {len(corpus)}, символов: {sum(len(t) for t in texts)}, проходов: {args.iterations}, расхождений с прежним результатом: {mismatches}")
+    report("прежний prepare_text", bench(legacy_prepare_text, corpus, args.iterations), len(corpus))
+    report("render_post_text", bench(Manacost.render_post_text, corpus, args.iterations), len(corpus))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Сравнение накладных расходов на видео: новый yt_dlp.YoutubeDL на каждый вызов (как было раньше)
+# против выдачи экземпляра из ytdlp_engine_pool Manacost.
+#
+# Без аргументов измеряется только подготовка движка (создание экземпляра и получение экстрактора VK),
+# сеть не используется. С URL видео дополнительно выполняется extract_info(download=False) -
+# тогда видна и выгода от переиспользования соединений и cookie.
+#
+#   python bench_ytdlp_engine.py -n 50
+#   python bench_ytdlp_engine.py -n 5 https://vk.com/video-87011294_456249654
+import argparse
+import statistics
+import time
+
+import yt_dlp
+
+import Manacost
+
+
+def run_once(ydl, urls):
+    ydl.get_info_extractor('VK')
+    for url in urls:
+        ydl.extract_info(url, download=False)
+
+
+def bench_fresh(iterations, urls):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        with yt_dlp.YoutubeDL(dict(Manacost.YTDLP_BASE_OPTIONS)) as ydl:
+            run_once(ydl, urls)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def bench_pool(iterations, urls):
+    pool = Manacost.YtDlpEnginePool(Manacost.YTDLP_BASE_OPTIONS, 1)
+    timings = []
+    try:
+        for _ in range(iterations):
+            started = time.perf_counter()
+            with pool.checkout(outtmpl='%(id)s.%(ext)s') as ydl:
+                run_once(ydl, urls)
+            timings.append(time.perf_counter() - started)
+    finally:
+        pool.close()
+    return timings
+
+
+def report(name, timings):
+    ms = [t * 1000 for t in timings]
+    print(f"{name:<22} первый {ms[0]:8.1f} мс | медиана {statistics.median(ms):8.1f} мс | среднее {statistics.mean(ms):8.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Накладные расходы yt-dlp на одно видео: новый экземпляр против пула.")
+    parser.add_argument('-n', '--iterations', type=int, default=20, help="число повторов (по умолчанию 20)")
+    parser.add_argument('urls', nargs='*', help="URL видео для extract_info(download=False)")
+    args = parser.parse_args()
+    Manacost.stream_handler.setLevel('CRITICAL')
+
+    print(f"Повторов: {args.iterations}, URL: {len(args.urls) or 'нет (только подготовка движка)'}")
+    report("новый YoutubeDL", bench_fresh(args.iterations, args.urls))
+    report("ytdlp_engine_pool", bench_pool(args.iterations, args.urls))
+
+
+if __name__ == '__main__':
+    main()
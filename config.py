@@ -33,8 +33,11 @@ SECONDARY_VK_GROUPS = {
 }
 
 # --- Имена файлов ---
-# Файл для хранения ID последних отправленных постов для каждой группы
-# Имена будут формироваться как "posts_state_{key}.json", где key - ключ из *_VK_GROUP_ID
+# База SQLite с историей обработанных постов и отметками групп
+POST_STATE_DB = "posts_state.db"
+
+# Старые файлы состояния "posts_state_{key}.json" (где key - ключ из *_VK_GROUP_ID)
+# однократно импортируются в POST_STATE_DB при первом запуске
 POST_STATE_FILE_PREFIX = "posts_state"
 
 # Файл для хранения списка слов-фильтров
@@ -51,3 +54,134 @@ VK_CHECK_INTERVAL_SECONDS = 120
 
 # Максимальное количество постов, запрашиваемых из VK за один раз
 VK_POSTS_COUNT = 15 
+
+# Пакетный опрос групп: до 25 вызовов wall.get упаковываются в один запрос execute.
+# При False группы опрашиваются по одной с паузой DELAY_BETWEEN_GROUPS между ними
+VK_BATCH_FETCH = True
+
+# Для групп с отметкой сначала запрашивается короткая проба (закреплённый пост + самый новый).
+# Если отметка не достигнута, посты догружаются страницами по VK_POSTS_COUNT, но не более VK_MAX_CATCHUP_PAGES страниц
+VK_PROBE_COUNT = 2
+VK_MAX_CATCHUP_PAGES = 5
+
+# Сколько дней хранить записи об обработанных постах в POST_STATE_DB
+POST_HISTORY_DAYS = 90
+
+# Время жизни кэша названий групп VK (в секундах). Кэш заполняется из ответа wall.get
+GROUP_INFO_CACHE_TTL_SECONDS = 21600
+
+# Адаптивный опрос: каждая группа проверяется с собственным интервалом, подобранным по частоте её публикаций
+# за последние VK_POLL_RATE_WINDOW_DAYS дней (интервал = средний промежуток между постами * VK_POLL_RATE_FACTOR).
+# Интервал ограничен значениями VK_POLL_MIN_INTERVAL_SECONDS и VK_POLL_MAX_INTERVAL_SECONDS.
+# При False все группы проверяются раз в VK_CHECK_INTERVAL_SECONDS
+VK_ADAPTIVE_POLLING = True
+VK_POLL_MIN_INTERVAL_SECONDS = 60
+VK_POLL_MAX_INTERVAL_SECONDS = 1800
+VK_POLL_RATE_WINDOW_DAYS = 7
+VK_POLL_RATE_FACTOR = 0.25
+
+# Общий лимит запросов к VK API (запросов в секунду и допустимая серия подряд).
+# При ошибках 6/29 на паузу ставится только вызвавший их метод, а не весь поток проверки
+VK_API_RATE_PER_SECOND = 3
+VK_API_BURST = 3
+
+# Кэш развернутых коротких ссылок (vk.cc): файл, максимальное число записей,
+# время жизни удачных записей и время жизни неудачных попыток (в секундах)
+URL_CACHE_FILE = "url_cache.json"
+URL_CACHE_MAX_ENTRIES = 5000
+URL_CACHE_TTL_SECONDS = 2592000
+URL_CACHE_NEGATIVE_TTL_SECONDS = 600
+
+# Параллельное разворачивание ссылок поста: количество потоков и общий лимит времени на пост (в секундах).
+# Ссылки, не успевшие развернуться, остаются исходными
+LINK_EXPAND_WORKERS = 6
+LINK_EXPAND_TIME_BUDGET_SECONDS = 15
+
+# Сколько первых байт страницы читать при поиске HTML-редиректа (meta refresh / redirect_url).
+# Полный разбор страницы выполняется, только если маркер не найден в этом фрагменте
+URL_SNIFF_BYTES = 16384
+
+# Фоновая предзагрузка вложений поста: потоки для скачивания видео (с миниатюрами)
+# и потоки для скачивания фото при fallback-отправке медиагруппы файлами
+ATTACHMENT_PREFETCH_WORKERS = 3
+PHOTO_DOWNLOAD_WORKERS = 4
+
+# Кэш file_id Telegram для уже загруженных видео и фото: файл и максимальное число записей.
+# Повторная отправка того же медиа идет по file_id без скачивания и загрузки
+TELEGRAM_FILE_ID_CACHE_FILE = "telegram_file_ids.json"
+TELEGRAM_FILE_ID_CACHE_MAX_ENTRIES = 20000
+
+# Квоты локального кэша скачанных видео (DOWNLOAD_DIR) и фото (PHOTO_DOWNLOAD_DIR) в мегабайтах.
+# Сверх квоты удаляются давно не использованные файлы; папки больше не очищаются каждый цикл
+VIDEO_CACHE_MAX_MB = 2048
+PHOTO_CACHE_MAX_MB = 256
+
+# Сколько экземпляров yt-dlp держать для скачивания видео (создаются по требованию и переиспользуются)
+YTDLP_ENGINE_POOL_SIZE = 3
+
+# Сколько новых постов группы готовить заранее (разворачивание ссылок, скачивание видео),
+# пока отправляется текущий. Отправка все равно идет строго по порядку публикации
+POST_PIPELINE_DEPTH = 3
+
+# Общий HTTP-клиент для фото, миниатюр и разворачивания ссылок: число хостов с отдельным пулом,
+# соединений на хост, повторы при сетевых ошибках и ответах 5xx, пауза между повторами (множитель, сек.)
+# и таймауты соединения и чтения (сек.)
+HTTP_POOL_HOSTS = 20
+HTTP_POOL_MAXSIZE = 10
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 15
+
+# Кэш готовых миниатюр видео (JPEG до 320px и 200 KB): папка и квота в мегабайтах.
+# Для уменьшения превью VK нужен Pillow или ffmpeg; ffmpeg также берет кадр из видео, если превью нет
+THUMBNAIL_CACHE_DIR = "vk_thumbs"
+THUMBNAIL_CACHE_MAX_MB = 50
+
+# Fallback-отправка альбома файлами: фото до PHOTO_SPOOL_MAX_KB держатся в памяти, большие - во временных
+# файлах в PHOTO_DOWNLOAD_DIR; сколько раз повторять скачивание фото, которые не удалось получить.
+# Скачанные фото также сохраняются в кэш фото и при повторной отправке альбома берутся из него
+PHOTO_SPOOL_MAX_KB = 2048
+PHOTO_FALLBACK_RETRIES = 1
+
+# Размер куска (в KB), которым видеофайл читается с диска при потоковой загрузке в Telegram.
+# Тело запроса не собирается в памяти целиком, поэтому память не растет с размером видео
+TELEGRAM_UPLOAD_CHUNK_KB = 256
+
+# Лимиты отправки в Telegram (все safe_send_* идут через общий планировщик): общий лимит бота в секунду и серия подряд,
+# лимит на личный чат (сообщений в секунду) и на группу/канал (сообщений в минуту), допустимая серия в один чат.
+# После ответа 429 чат ждет retry_after из ответа; сколько раз повторять такой запрос
+TELEGRAM_GLOBAL_RATE_PER_SECOND = 30
+TELEGRAM_GLOBAL_BURST = 30
+TELEGRAM_PRIVATE_CHAT_RATE_PER_SECOND = 1
+TELEGRAM_GROUP_CHAT_RATE_PER_MINUTE = 20
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_429_MAX_RETRIES = 3
+
+# Получение команд администратора: "polling" (долгий опрос getUpdates) или "webhook" (Telegram сам присылает
+# обновления на встроенный HTTP(S)-сервер бота; сервер можно поставить за reverse proxy)
+TELEGRAM_UPDATE_MODE = "polling"
+
+# Webhook: публичный адрес для Telegram (https://, порты 443/80/88/8443), адрес и порт встроенного сервера
+# и путь запроса (None - путь из WEBHOOK_URL). Секрет приходит в заголовке X-Telegram-Bot-Api-Secret-Token;
+# если WEBHOOK_SECRET_TOKEN не задан, при каждом запуске генерируется случайный
+WEBHOOK_URL = None                # Пример: "https://bot.example.com/telegram-webhook"
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = None
+WEBHOOK_SECRET_TOKEN = None
+
+# Сертификат и ключ для HTTPS во встроенном сервере (None - простой HTTP, TLS на стороне reverse proxy).
+# Самоподписанный сертификат передается Telegram при регистрации webhook (WEBHOOK_SELF_SIGNED = True)
+WEBHOOK_SSL_CERT = None
+WEBHOOK_SSL_KEY = None
+WEBHOOK_SELF_SIGNED = False
+
+# Обработка обновлений webhook: число потоков и сколько обновлений может ждать в очереди.
+# Если очередь заполнена, сервер отвечает 503 и Telegram повторяет доставку позже
+WEBHOOK_HANDLER_WORKERS = 4
+WEBHOOK_QUEUE_SIZE = 100
+
+# Адрес Bot API (None - https://api.telegram.org): локальный Bot API сервер или fake_telegram_server.py
+# для проверки бота без Telegram, например "http://127.0.0.1:8081"
+TELEGRAM_API_URL = None
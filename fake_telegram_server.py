@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Локальная заглушка Telegram Bot API для проверки бота без Telegram (в config.py: TELEGRAM_API_URL = "http://127.0.0.1:8081").
+#
+# Отвечает на любой метод /bot<токен>/<метод>: запоминает адрес из setWebhook, отдает накопленные обновления в getUpdates,
+# на send*/reply возвращает сообщение-заглушку и печатает, что бот отправил. Строки, введенные в консоли, становятся
+# сообщениями от --user-id (по умолчанию ADMIN_CHAT_ID): если webhook зарегистрирован, они отправляются на него
+# с заголовком X-Telegram-Bot-Api-Secret-Token (с повторами при ответах не 200, как у Telegram), иначе ждут getUpdates.
+#
+#   python fake_telegram_server.py --port 8081
+#   > /stats
+import argparse
+import email.parser
+import itertools
+import json
+import queue
+import ssl
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+try: import config
+except ImportError: config = None
+
+
+class FakeTelegram:
+    def __init__(self, user_id):
+        self.user_id = int(user_id)
+        self.webhook_url = None
+        self.secret_token = None
+        self.updates = queue.Queue()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def make_message(self, chat_id, text=None, from_bot=False):
+        chat_id = int(chat_id)
+        user = {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'} if from_bot else \
+               {'id': self.user_id, 'is_bot': False, 'first_name': 'Admin', 'username': 'admin'}
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()), 'from': user,
+                   'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup', 'title': 'Fake chat'}}
+        if text is not None: message['text'] = text
+        if text and text.startswith('/') and not from_bot:
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    def call(self, method, params):
+        method = method.lower()
+        if method == 'getme': return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        if method == 'setwebhook':
+            self.webhook_url, self.secret_token = params.get('url') or None, params.get('secret_token')
+            print(f"[fake] webhook: {self.webhook_url or 'снят'}")
+            return True
+        if method == 'deletewebhook':
+            if self.webhook_url: print("[fake] webhook снят")
+            self.webhook_url = self.secret_token = None
+            return True
+        if method == 'getwebhookinfo': return {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': self.updates.qsize()}
+        if method == 'getupdates': return self.get_updates(float(params.get('timeout') or 0))
+        if method.startswith('send') or method.startswith('edit'):
+            text = params.get('text') or params.get('caption')
+            print(f"[fake] {method} -> {params.get('chat_id')}: {text if text is not None else '<медиа>'}")
+            if method == 'sendmediagroup':
+                media = json.loads(params.get('media') or '[]')
+                return [self.make_message(params.get('chat_id', 0), from_bot=True) for _ in media]
+            return self.make_message(params.get('chat_id', 0), text, from_bot=True)
+        return True
+
+    def get_updates(self, timeout):
+        try: updates = [self.updates.get(timeout=timeout) if timeout else self.updates.get_nowait()]
+        except queue.Empty: return []
+        while not self.updates.empty(): updates.append(self.updates.get_nowait())
+        return updates
+
+    def post_text(self, text, retries=3):
+        update = {'update_id': next(self.update_ids), 'message': self.make_message(self.user_id, text)}
+        if not self.webhook_url:
+            self.updates.put(update)
+            return
+        body = json.dumps(update, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.secret_token: headers['X-Telegram-Bot-Api-Secret-Token'] = self.secret_token
+        context = ssl._create_unverified_context()
+        for attempt in range(retries + 1):
+            request = urllib.request.Request(self.webhook_url, data=body, headers=headers, method='POST')
+            try:
+                with urllib.request.urlopen(request, timeout=10, context=context) as response: status = response.status
+            except urllib.error.HTTPError as e: status = e.code
+            except OSError as e: status = f"ошибка соединения ({e})"
+            print(f"[fake] webhook update {update['update_id']}: {status}")
+            if status == 200: return
+            time.sleep(2 ** attempt)
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args): pass
+
+        def read_params(self):
+            parsed = urlparse(self.path)
+            params = dict(parse_qsl(parsed.query))
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/x-www-form-urlencoded'): params.update(parse_qsl(body.decode('utf-8')))
+            elif content_type.startswith('application/json') and body: params.update(json.loads(body))
+            elif content_type.startswith('multipart/form-data'):
+                message = email.parser.BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + body)
+                for part in message.get_payload() if message.is_multipart() else []:
+                    if part.get_filename() is None and part.get_param('name', header='content-disposition'):
+                        params[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True).decode('utf-8')
+            return parsed.path, params
+
+        def handle_api(self):
+            path, params = self.read_params()
+            parts = path.strip('/').split('/')
+            if len(parts) != 2 or not parts[0].startswith('bot'):
+                self.respond(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                return
+            self.respond(200, {'ok': True, 'result': fake.call(parts[1], params)})
+
+        def respond(self, code, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = handle_api
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API: строки из консоли - сообщения боту.")
+    parser.add_argument('--host', default='127.0.0.1', help="адрес (по умолчанию 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8081, help="порт (по умолчанию 8081)")
+    parser.add_argument('--user-id', default=getattr(config, 'ADMIN_CHAT_ID', None), help="ID отправителя сообщений (по умолчанию ADMIN_CHAT_ID)")
+    args = parser.parse_args()
+    if not args.user_id: parser.error("укажите --user-id")
+
+    fake = FakeTelegram(args.user_id)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(fake))
+    threading.Thread(target=server.serve_forever, name="FakeTelegram", daemon=True).start()
+    print(f"[fake] Bot API на http://{args.host}:{args.port}, сообщения от {args.user_id}. Вводите команды (Ctrl+D - выход).")
+    try:
+        for line in sys.stdin:
+            if line.strip(): fake.post_text(line.strip())
+    except KeyboardInterrupt: pass
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()